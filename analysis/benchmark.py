@@ -0,0 +1,314 @@
+# Benchmark of the histogrammer's execution modes on synthetic ggNtuples (see synthetic_ntuples.py), without EOS access
+# - Writes --n_files synthetic files of --n_events events into --bench_dir (kept for the next runs, unless the setup changes), then runs each mode over them:
+#     run            : run(), serial
+#     adaptive       : run(), with the adaptive cut ordering (see MonoPhotonHistogrammer.set_adaptive_cut_order())
+#     prefilter      : run(), with the adaptive cut ordering and the scalar pre-filter (see MonoPhotonHistogrammer.set_prefilter())
+#     variations     : run(), with the parameter variations of analysis_spec.default_variations filled in the same loop (see MonoPhotonHistogrammer.set_variations())
+#     rehist         : rehist(), from the selection sidecars (see selection_sidecar.py). The sidecars are written before the timing.
+#     staged         : run(), with the input files staged through a local StagingArea (see staging.py)
+#     columnar       : run_columnar(), reading the ROOT files (needs uproot)
+#     columnar_cache : run_columnar(), reading the columnar cache (see columnar_cache.py). The cache is written before the timing.
+#     jobs           : one task per input file on --jobs processes, merged afterwards (run_histograms.py --jobs)
+#     jobs_shared    : as jobs, with the histograms accumulated in shared memory (run_histograms.py --jobs --shared_histograms)
+# - Each mode runs --repeat times, in a fresh process each time (so that the peak memory is the mode's own). Reported per mode, from the best repetition:
+#   events/s (events / wall time of the whole mode), peak RSS in MB (the largest process of the mode), and MB read (ROOT bytes read; for columnar_cache, the cache files).
+# - The output histograms of every mode are compared to those of the run mode, bin by bin (see compare_histograms()): all modes promise the same histograms.
+#   The benchmark fails (exit code 1) on any difference beyond --histogram_tolerance. Needs the run mode in --modes.
+# - The results are compared to a stored baseline (--baseline, written with --update_baseline). The benchmark fails (exit code 1) if a mode is slower than the baseline by more
+#   than --tolerance, or uses more memory or reads more bytes by more than --tolerance. Baselines are only comparable on the same machine and setup (checked).
+#
+# Example:
+#   python benchmark.py --bench_dir /tmp/monophoton_bench --update_baseline
+#   (change the histogrammer)
+#   python benchmark.py --bench_dir /tmp/monophoton_bench
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import socket
+import argparse
+import resource
+import multiprocessing
+from ROOT import TFile
+
+from MonoPhoton.DASAnalysis import synthetic_ntuples
+from MonoPhoton.DASAnalysis.staging import StagingArea
+from MonoPhoton.DASAnalysis.task_scheduler import run_tasks
+from MonoPhoton.DASAnalysis.histogram_cache import merge_histogram_files
+from MonoPhoton.DASAnalysis.metrics import metrics_path
+from MonoPhoton.DASAnalysis.analysis_spec import default_variations
+sys.path.append(os.path.expandvars("$CMSSW_BASE/src/MonoPhoton/DASAnalysis/analysis"))
+import run_histograms
+from monophoton_histogrammer import MonoPhotonHistogrammer
+
+all_modes = ["run", "adaptive", "prefilter", "variations", "rehist", "staged", "columnar", "columnar_cache", "jobs", "jobs_shared"]
+
+# The synthetic files are run as one data subsample (no event weights)
+subsample = "Data_synthetic"
+
+# Compared to the baseline: (metric, +1 if larger is better, -1 if smaller is better)
+compared_metrics = [("events_per_second", 1), ("peak_rss_mb", -1), ("mb_read", -1)]
+
+# run_histograms_args(): command line arguments of run_histograms.py, for its task functions (--jobs modes)
+def run_histograms_args(args, **overrides):
+	run_args = argparse.Namespace(spec=args.spec, trigger_turnons=False, adaptive_cuts=False, adaptive_warmup=2000, cut_order=None, prefilter=False, variations=None, sidecar_dir=None, rehist=False, stage_dir=None, stage_quota=50., read_ahead=2, stage_latency=0., cache_dir=None, catalogue=None, columnar=False, columnar_cache=None, max_events=-1)
+	for name, value in overrides.iteritems():
+		setattr(run_args, name, value)
+	return run_args
+
+# make_histogrammer(): histogrammer over the synthetic files
+def make_histogrammer(input_files, args, output_path):
+	histogrammer = run_histograms.make_histogrammer(subsample, run_histograms_args(args))
+	for input_file in input_files:
+		histogrammer.add_file(input_file)
+	histogrammer.set_output_path(output_path)
+	return histogrammer
+
+# run_mode(): run one mode over the input files, in the current process. Returns the metrics of the output (see metrics.py).
+def run_mode(mode, input_files, args, mode_dir):
+	output_path = "{}/subsample_histograms_{}.root".format(mode_dir, subsample)
+	if mode in ["run", "adaptive", "prefilter", "variations", "rehist", "staged", "columnar", "columnar_cache"]:
+		histogrammer = make_histogrammer(input_files, args, output_path)
+		if mode in ["adaptive", "prefilter"]:
+			histogrammer.set_adaptive_cut_order()
+		if mode == "prefilter":
+			histogrammer.set_prefilter()
+		if mode == "variations":
+			histogrammer.set_variations(default_variations)
+		if mode == "staged":
+			histogrammer.set_staging(StagingArea("{}/stage".format(mode_dir), read_ahead=2))
+		histogrammer.start()
+		if mode in ["run", "adaptive", "prefilter", "variations", "staged"]:
+			histogrammer.run()
+		elif mode == "rehist":
+			histogrammer.rehist("{}/sidecars".format(args.bench_dir))
+		else:
+			histogrammer.run_columnar(cache_dir="{}/columnar_cache".format(args.bench_dir) if mode == "columnar_cache" else None)
+		histogrammer.finish()
+	else:
+		task_dir = "{}/tasks".format(mode_dir)
+		os.makedirs(task_dir)
+		run_args = run_histograms_args(args, output_dir=mode_dir)
+		tasks = [(subsample, input_file, run_args, "{}/synthetic_{}".format(task_dir, i_file)) for i_file, input_file in enumerate(input_files)]
+		if mode == "jobs":
+			file_histograms = run_tasks(run_histograms.run_file_task, tasks, args.jobs)
+			merge_histogram_files(file_histograms, output_path)
+		else:
+			layout_histogrammer = make_histogrammer([], args, output_path)
+			layout_histogrammer.start()
+			shared_histograms = run_histograms.run_shared_tasks(tasks, [subsample], layout_histogrammer.output_histograms(), args.jobs)
+			histograms, n_events = shared_histograms.histograms(0)
+			output_file = TFile(output_path, "RECREATE")
+			for histogram in histograms:
+				histogram.Write()
+			output_file.Close()
+		run_histograms.merge_task_metrics(subsample, [task[3] for task in tasks], run_args)
+	with open(metrics_path(output_path), 'r') as f:
+		return json.load(f)
+
+# benchmark_mode(): one repetition of a mode, in a child process. Returns {"events", "seconds", "events_per_second", "peak_rss_mb", "mb_read"}, or None if the mode is not available.
+def benchmark_mode(mode, input_files, args):
+	mode_dir = "{}/modes/{}".format(args.bench_dir, mode)
+	if os.path.isdir(mode_dir):
+		shutil.rmtree(mode_dir)
+	os.makedirs(mode_dir)
+	result_path = "{}/result.json".format(mode_dir)
+
+	def child():
+		start = time.time()
+		try:
+			metrics = run_mode(mode, input_files, args, mode_dir)
+		except ImportError as error:
+			print "[benchmark] WARNING : Mode {} is not available: {}".format(mode, error)
+			return
+		seconds = time.time() - start
+		mb_read = metrics["bytes_read"] / 1.e6
+		if mode == "columnar_cache":
+			mb_read = sum(os.path.getsize(path) for path in glob.glob("{}/columnar_cache/*/*.npy".format(args.bench_dir))) / 1.e6
+		peak_rss_mb = max(metrics["peak_rss_mb"], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+		with open(result_path, 'w') as f:
+			json.dump({"events": metrics["events"], "seconds": seconds, "events_per_second": metrics["events"] / seconds, "peak_rss_mb": peak_rss_mb, "mb_read": mb_read}, f)
+
+	process = multiprocessing.Process(target=child)
+	process.start()
+	process.join()
+	if process.exitcode != 0:
+		raise RuntimeError("[benchmark] ERROR : Mode {} failed (exit code {})".format(mode, process.exitcode))
+	if not os.path.isfile(result_path):
+		return None
+	with open(result_path, 'r') as f:
+		return json.load(f)
+
+# setup(): what the results depend on, besides the code. Baselines with a different setup are not compared.
+def setup(args, config):
+	return {"host": socket.gethostname(), "n_files": args.n_files, "n_events": args.n_events, "jobs": args.jobs, "seed": args.seed, "spec": args.spec, "config": config}
+
+# read_histograms(): {name : (bin labels, [(content, error)] including under- and overflow)} of the histograms in a ROOT file
+def read_histograms(path):
+	f = TFile.Open(path, "READ")
+	histograms = {}
+	for key in f.GetListOfKeys():
+		histogram = key.ReadObj()
+		if not histogram.InheritsFrom("TH1"):
+			continue
+		labels = [histogram.GetXaxis().GetBinLabel(i) for i in xrange(1, histogram.GetNbinsX() + 1)] if histogram.GetXaxis().GetLabels() else None
+		histograms[histogram.GetName()] = (labels, [(histogram.GetBinContent(i), histogram.GetBinError(i)) for i in xrange(histogram.GetNbinsX() + 2)])
+	f.Close()
+	return histograms
+
+# compare_histograms(): differences of the histograms of a mode w.r.t. the reference (read_histograms() of both), as messages
+# - Contents and errors must agree within a relative tolerance (floating point sums in a different order, e.g. columnar or merged files)
+# - Every reference histogram must be there. Extra histograms are allowed (e.g. the variation histograms).
+# - Cutflows in a different cut order (adaptive, prefilter) are only compared in their first bin (all events) and last bin (all steps passed)
+def compare_histograms(histograms, reference, tolerance):
+	differences = []
+	for name, (reference_labels, reference_bins) in sorted(reference.iteritems()):
+		if not name in histograms:
+			differences.append("{} is missing".format(name))
+			continue
+		labels, bins = histograms[name]
+		if len(bins) != len(reference_bins):
+			differences.append("{} has {} bins instead of {}".format(name, len(bins) - 2, len(reference_bins) - 2))
+			continue
+		compared_bins = xrange(len(bins))
+		if labels != reference_labels:
+			if labels and reference_labels and sorted(labels[1:]) == sorted(reference_labels[1:]):
+				compared_bins = [1, len(bins) - 2]
+			else:
+				differences.append("{} has bin labels {} instead of {}".format(name, labels, reference_labels))
+				continue
+		for i in compared_bins:
+			for value, reference_value, quantity in zip(bins[i], reference_bins[i], ["content", "error"]):
+				if abs(value - reference_value) > tolerance * max(abs(value), abs(reference_value)):
+					differences.append("{} bin {} {}: {!r} instead of {!r}".format(name, i, quantity, value, reference_value))
+					break
+	return differences
+
+# compare(): regressions of the results w.r.t. the baseline, as messages
+def compare(results, baseline, tolerance):
+	regressions = []
+	for mode, result in sorted(results.iteritems()):
+		if not mode in baseline["modes"]:
+			print "[benchmark] INFO : No baseline for mode {}".format(mode)
+			continue
+		for metric, direction in compared_metrics:
+			reference = baseline["modes"][mode][metric]
+			if reference <= 0:
+				continue
+			change = (result[metric] - reference) / reference
+			if direction * change < -tolerance:
+				regressions.append("{} {}: {:.1f} vs. {:.1f} in the baseline ({:+.0%})".format(mode, metric, result[metric], reference, change))
+	return regressions
+
+def print_table(results, baseline):
+	print "{:<16} {:>10} {:>10} {:>12} {:>10} {:>10}".format("mode", "events", "ev/s", "baseline", "RSS [MB]", "MB read")
+	for mode in all_modes:
+		if not mode in results:
+			continue
+		result = results[mode]
+		reference = baseline["modes"][mode]["events_per_second"] if baseline and mode in baseline["modes"] else float("nan")
+		print "{:<16} {:>10} {:>10.0f} {:>12.0f} {:>10.0f} {:>10.1f}".format(mode, result["events"], result["events_per_second"], reference, result["peak_rss_mb"], result["mb_read"])
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark the histogrammer execution modes on synthetic ggNtuples')
+	parser.add_argument('--bench_dir', type=str, default="/tmp/monophoton_benchmark", help='Directory of the synthetic files, caches and outputs')
+	parser.add_argument('--modes', type=str, default=",".join(all_modes), help='Modes to run (comma-separated): {}'.format(", ".join(all_modes)))
+	parser.add_argument('--n_files', type=int, default=4)
+	parser.add_argument('--n_events', type=int, default=20000, help='Events per synthetic file')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--config', type=str, help='JSON file overriding parameters of synthetic_ntuples.default_config')
+	parser.add_argument('--spec', type=str, help='Analysis spec (default: analysis_spec.default_spec)')
+	parser.add_argument('--jobs', type=int, default=4, help='Number of processes of the jobs modes')
+	parser.add_argument('--repeat', type=int, default=3, help='Repetitions of each mode (the best one is kept)')
+	parser.add_argument('--baseline', type=str, help='Baseline JSON (default: <bench_dir>/baseline.json)')
+	parser.add_argument('--update_baseline', action='store_true', help='Store the results as the new baseline, instead of comparing')
+	parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed fractional regression of each metric w.r.t. the baseline')
+	parser.add_argument('--histogram_tolerance', type=float, default=1.e-9, help='Allowed relative difference of the histogram bins of each mode w.r.t. the run mode')
+	args = parser.parse_args()
+	args.bench_dir = os.path.abspath(args.bench_dir)
+	baseline_path = args.baseline or "{}/baseline.json".format(args.bench_dir)
+	modes = args.modes.split(",")
+	for mode in modes:
+		if not mode in all_modes:
+			print "[benchmark] ERROR : Unknown mode {}".format(mode)
+			sys.exit(1)
+
+	# Synthetic input files, rewritten if the setup changed
+	config = synthetic_ntuples.load_config(args.config)
+	bench_setup = setup(args, config)
+	input_dir = "{}/inputs".format(args.bench_dir)
+	input_setup_path = "{}/setup.json".format(input_dir)
+	input_setup = dict((key, bench_setup[key]) for key in ["n_files", "n_events", "seed", "config"])
+	overwrite = True
+	if os.path.isfile(input_setup_path):
+		with open(input_setup_path, 'r') as f:
+			overwrite = json.load(f) != input_setup
+	input_files = synthetic_ntuples.write_ntuples(input_dir, args.n_files, args.n_events, config=config, seed=args.seed, overwrite=overwrite)
+	with open(input_setup_path, 'w') as f:
+		json.dump(input_setup, f, indent=1, sort_keys=True)
+	if "columnar_cache" in modes:
+		if overwrite and os.path.isdir("{}/columnar_cache".format(args.bench_dir)):
+			shutil.rmtree("{}/columnar_cache".format(args.bench_dir))
+		try:
+			cache_histogrammer = MonoPhotonHistogrammer()
+			for input_file in input_files:
+				cache_histogrammer.add_file(input_file)
+			cache_histogrammer.write_columnar_cache("{}/columnar_cache".format(args.bench_dir))
+		except ImportError as error:
+			print "[benchmark] WARNING : Couldn't write the columnar cache: {}".format(error)
+
+	if "rehist" in modes:
+		sidecar_histogrammer = make_histogrammer(input_files, args, "{}/sidecars/subsample_histograms_{}.root".format(args.bench_dir, subsample))
+		if not sidecar_histogrammer.has_sidecars("{}/sidecars".format(args.bench_dir)):
+			sidecar_histogrammer.set_sidecar_dir("{}/sidecars".format(args.bench_dir))
+			sidecar_histogrammer.start()
+			sidecar_histogrammer.run()
+
+	results = {}
+	for mode in modes:
+		repetitions = [result for result in (benchmark_mode(mode, input_files, args) for i in xrange(args.repeat)) if result]
+		if repetitions:
+			results[mode] = max(repetitions, key=lambda result: result["events_per_second"])
+			print "[benchmark] INFO : {}: {:.0f} events/s".format(mode, results[mode]["events_per_second"])
+
+	# Same histograms as the run mode
+	histogram_differences = []
+	if "run" in results:
+		output_name = "subsample_histograms_{}.root".format(subsample)
+		reference = read_histograms("{}/modes/run/{}".format(args.bench_dir, output_name))
+		for mode in results:
+			if mode != "run":
+				histogram_differences.extend("{}: {}".format(mode, difference) for difference in compare_histograms(read_histograms("{}/modes/{}/{}".format(args.bench_dir, mode, output_name)), reference, args.histogram_tolerance))
+		for difference in histogram_differences:
+			print "[benchmark] ERROR : Histograms differ from the run mode: {}".format(difference)
+		if not histogram_differences:
+			print "[benchmark] INFO : All modes have the same histograms as the run mode"
+	else:
+		print "[benchmark] WARNING : The run mode was not run, not comparing the histograms"
+
+	baseline = None
+	if os.path.isfile(baseline_path):
+		with open(baseline_path, 'r') as f:
+			baseline = json.load(f)
+		if baseline["setup"] != json.loads(json.dumps(bench_setup)):
+			print "[benchmark] WARNING : The baseline {} was made with a different setup, not comparing".format(baseline_path)
+			baseline = None
+	print_table(results, baseline)
+
+	if args.update_baseline:
+		if baseline:
+			results = dict(baseline["modes"], **results) # Keep the baseline of the modes that were not run
+		with open(baseline_path, 'w') as f:
+			json.dump({"setup": bench_setup, "modes": results, "time": time.time()}, f, indent=1, sort_keys=True)
+		print "[benchmark] INFO : Wrote baseline {}".format(baseline_path)
+	elif baseline:
+		regressions = compare(results, baseline, args.tolerance)
+		for regression in regressions:
+			print "[benchmark] ERROR : Regression: {}".format(regression)
+		if regressions:
+			sys.exit(1)
+		print "[benchmark] INFO : No regressions w.r.t. {} (tolerance {:.0%})".format(baseline_path, args.tolerance)
+	if histogram_differences:
+		sys.exit(1)
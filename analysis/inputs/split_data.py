@@ -1,19 +1,63 @@
-# Split up the data input txt file into subjobs of 40 files each
+# Split the input files of a sample into condor jobs with a target wall time, and write them to inputs/jobs.json, which input_samples.py loads (the jobs replace the subsamples of the sample).
+# - Uses the per-file entries and cluster boundaries from the file catalogue (refreshed here), so files can be split into entry ranges.
+# - Uses the throughput measured by earlier runs (throughput_<subsample>.json, written by run_histograms.py --run into its output directory).
+# - Each job gets the shortest condor JobFlavour that fits its estimated run time (see python/job_splitter.py).
+# Examples:
+#   python split_data.py --sample data --parent Data_2015D --inputs Data_2015D_all.txt
+#   python split_data.py --sample GJets --target_minutes 30
 import os
 import sys
-import math
+import argparse
 
-input_files = []
-with open("Data_2015D_all.txt", 'r') as f:
-	for line in f:
-		input_files.append(line)
+from MonoPhoton.DASAnalysis import input_samples
+from MonoPhoton.DASAnalysis.file_catalogue import FileCatalogue, default_catalogue_path, default_remote_max_age
+from MonoPhoton.DASAnalysis.job_splitter import split_jobs, save_jobs, load_throughputs, default_events_per_second
 
-files_per_job = 100
-n_subjobs = int(math.ceil(1. * len(input_files) / files_per_job))
-for i_subjob in xrange(n_subjobs):
-	with open("Data_2015D_subjob{}.txt".format(i_subjob), 'w') as f:
-		for di_file in xrange(files_per_job):
-			i_file = i_subjob * files_per_job + di_file
-			if i_file >= len(input_files):
-				break
-			f.write(input_files[i_file])
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Split the input files of a sample into condor jobs with a target wall time')
+	parser.add_argument('--sample', type=str, required=True, help='Sample whose subsamples are replaced by the jobs (e.g. data)')
+	parser.add_argument('--inputs', type=str, help='Input file list (e.g. Data_2015D_all.txt). Default: inputs/<subsample>.txt of each subsample of the sample.')
+	parser.add_argument('--parent', type=str, help='Name of the subsample made of the --inputs files (e.g. Data_2015D); the jobs are called <parent>_job<i>')
+	parser.add_argument('--target_minutes', type=float, default=60., help='Target wall time per job')
+	parser.add_argument('--catalogue', type=str, default=default_catalogue_path, help='File catalogue with the entries per file')
+	parser.add_argument('--refresh_catalogue', action='store_true', help='Check every xrootd file of the catalogue for changes (xrdfs), instead of only those checked more than --catalogue_max_age days ago')
+	parser.add_argument('--catalogue_max_age', type=float, default=default_remote_max_age / 86400., help='Days after which an xrootd file of the catalogue is checked for changes again')
+	parser.add_argument('--throughput_dirs', type=str, default=os.path.expandvars("$CMSSW_BASE/../data/histograms/"), help='Directories with throughput_*.json measurements (comma-separated)')
+	parser.add_argument('--jobs', type=int, default=8, help='Number of processes for scanning new files into the catalogue')
+	args = parser.parse_args()
+
+	# {parent subsample : [input files]}
+	parent_files = {}
+	if args.inputs:
+		if not args.parent:
+			print "[split_data] ERROR : --inputs needs --parent"
+			sys.exit(1)
+		with open(args.inputs, 'r') as f:
+			parent_files[args.parent] = [line.strip() for line in f if line.strip()]
+	else:
+		for subsample in input_samples.unsplit_subsamples[args.sample]:
+			with open(input_samples.get_input_txt(subsample), 'r') as f:
+				parent_files[subsample] = [line.strip() for line in f if line.strip()]
+
+	catalogue = FileCatalogue(args.catalogue)
+	failed_files = catalogue.refresh(parent_files, n_jobs=args.jobs, remote_max_age=0. if args.refresh_catalogue else args.catalogue_max_age * 86400.)
+	if failed_files:
+		print "[split_data] ERROR : Couldn't scan {} input files into the catalogue {}:\n\t{}".format(len(failed_files), args.catalogue, "\n\t".join(failed_files))
+		sys.exit(1)
+	throughputs = load_throughputs(args.throughput_dirs.split(","))
+
+	jobs = []
+	for parent in sorted(parent_files):
+		if not parent in throughputs:
+			print "[split_data] WARNING : No throughput measurement for {}, assuming {} Hz".format(parent, default_events_per_second)
+		parent_jobs = split_jobs(parent, catalogue.files_info(parent_files[parent]), throughputs.get(parent, default_events_per_second), args.target_minutes * 60.)
+		if not parent_jobs:
+			print "[split_data] WARNING : {} : no input files with entries, no jobs".format(parent)
+			continue
+		print "[split_data] INFO : {} : {} files -> {} jobs, longest {:.0f} min".format(parent, len(parent_files[parent]), len(parent_jobs), max(job["estimated_seconds"] for job in parent_jobs) / 60.)
+		jobs.extend(parent_jobs)
+
+	save_jobs(input_samples.jobs_json, args.sample, jobs)
+	print "[split_data] INFO : Wrote {} jobs for sample {} to {}".format(len(jobs), args.sample, input_samples.jobs_json)
+	for flavour in sorted(set(job["flavour"] for job in jobs)):
+		print "[split_data] INFO : \t{} : {} jobs".format(flavour, len([job for job in jobs if job["flavour"] == flavour]))
@@ -1,9 +1,14 @@
 import os
 import sys
+import json
+import copy
+import hashlib
 import array
 import math
 import time
 import datetime
+import itertools
+import numpy as np
 
 from ROOT import * # This is slightly bad practice, but saves having to type "ROOT." in front of every ROOT object
 
@@ -16,11 +21,367 @@ gStyle.SetOptStat(0) # Don't draw stat boxes for histograms
 gStyle.SetOptTitle(0) # Don't draw histogram title on plots
 
 # import photon trigger enum
-from MonoPhoton.DASAnalysis.photon_triggers import PhotonTriggers
+from MonoPhoton.DASAnalysis.photon_triggers import PhotonTriggers, signal_trigger_mask, backup_trigger_mask
+
+# Photon ID word (one bit per ID criterion) and effective area tables
+from MonoPhoton.DASAnalysis.photon_id import PhotonIDBits, photon_id_mask, photon_selections, pass_photon_selection, photon_id_word, photon_id_words, effective_area_bin, ea_charged, ea_neutral, ea_photon
+
+# Buffered histogram filling (TH1::FillN)
+from MonoPhoton.DASAnalysis.histogram_buffers import make_fill_buffers, flush_fill_buffers
+
+# Declarative analysis spec: regions, photon candidates and histograms
+from MonoPhoton.DASAnalysis.analysis_spec import default_spec, event_variable_names, photon_variable_names, CompiledExpression
+
+# Hash of the selection code and config, for the per-file histogram cache
+from MonoPhoton.DASAnalysis.histogram_cache import selection_hash, source_files
+
+# Input files restricted to entry ranges, from the job splitter
+from MonoPhoton.DASAnalysis.job_splitter import split_entry_range
+
+# Performance metrics (timings, throughput, memory)
+from MonoPhoton.DASAnalysis.metrics import RunMetrics, metrics_path
+
+# Columnar (chunked NumPy) reading, from ROOT or from the columnar cache, for run_columnar()
+from MonoPhoton.DASAnalysis.columnar import RootChunkReader, delta_phi
+from MonoPhoton.DASAnalysis.columnar_cache import CachedChunkReader, load_cache_meta, convert_file
+
+# Selection sidecars (regions passed and chosen photons of each entry), for rehist()
+from MonoPhoton.DASAnalysis.selection_sidecar import pass_bits_dtype, load_sidecar, load_sidecar_meta, write_sidecar
+
+# BranchAccessRecorder: stands in for the TChain while tracing, and records the names of the branches that the analysis code reads
+class BranchAccessRecorder:
+    def __init__(self, data):
+        self._recorded_data = data
+        self.accessed = set()
+
+    def __getattr__(self, name):
+        self.accessed.add(name)
+        return getattr(self._recorded_data, name)
+
+# NullHistogram: swallows fills while tracing, so that the real histograms are untouched
+class NullHistogram:
+    def Fill(self, *args):
+        pass
+
+    def fill(self, *args):
+        pass
+
+    def fill_array(self, *args):
+        pass
+
+# SpecNamespace: namespace for evaluating the expressions of the analysis spec (see analysis_spec.py)
+# - Holds the spec parameters. Variables are looked up in the event (or chunk) context on first use, for the given photon candidate.
+class SpecNamespace(dict):
+    def __init__(self, context, photon_candidate, parameters):
+        dict.__init__(self, parameters)
+        self._context = context
+        self._photon_candidate = photon_candidate
+
+    def __missing__(self, name):
+        if name in event_variable_names:
+            value = self._context.event_variable(name)
+        elif name in photon_variable_names:
+            value = self._context.photon_variable(name, self._photon_candidate)
+        else:
+            raise KeyError(name)
+        self[name] = value
+        return value
+
+# EventContext: quantities shared by the selections of one event (photon candidates, trigger decisions, lepton vetoes, jet-MET delta phi, spec variables and expressions), computed on first use and memoized.
+# - A new context is made for each event in process_event(), so every region reuses the same results.
+# - The lepton vetoes depend on the chosen photon, so the lepton-photon delta R is cached per (lepton, photon) pair.
+class EventContext:
+    # Spec variables (see analysis_spec.py): name : function(context) or function(context, photon index)
+    event_variable_functions = {
+        "one":               lambda event: 1.,
+        "pfmet":             lambda event: event._data.pfMET,
+        "pfmet_phi":         lambda event: event._data.pfMETPhi,
+        "met_filters":       lambda event: event._data.metFilters,
+        "signal_triggers":   lambda event: event.pass_signal_triggers(),
+        "backup_triggers":   lambda event: event.pass_backup_triggers(),
+        "njets":             lambda event: event._data.nJet,
+        "has_jet":           lambda event: event._data.nJet > 0,
+        "leading_jet_pt":    lambda event: event._data.jetPt[0] if event._data.nJet > 0 else -1.,
+        "leading_jet_eta":   lambda event: event._data.jetEta[0] if event._data.nJet > 0 else -999.,
+        "dphi_jet_met_pass": lambda event: event.pass_dphi_jet_MET(),
+    }
+    photon_variable_functions = {
+        "photon_pt":         lambda event, i: event._data.phoEt[i],
+        "photon_eta":        lambda event, i: event._data.phoEta[i],
+        "photon_SCeta":      lambda event, i: event._data.phoSCEta[i],
+        "photon_phi":        lambda event, i: event._data.phoPhi[i],
+        "photon_SCphi":      lambda event, i: event._data.phoSCPhi[i],
+        "dphi_photon_met":   lambda event, i: event.dphi_photon_MET(i),
+        "n_electrons":       lambda event, i: event.n_electrons(i),
+        "n_muons":           lambda event, i: event.n_muons(i),
+    }
+
+    def __init__(self, histogrammer):
+        self._histogrammer = histogrammer
+        self._data = histogrammer._data
+        self._cache = {}
+        self._lepton_photon_dR = {}
+        self._namespaces = {}
+        self._expressions = {}
+
+    # photon(): index of the chosen photon of a spec photon candidate, or -1
+    def photon(self, candidate):
+        key = ("photon", candidate)
+        if not key in self._cache:
+            required, vetoed, choose = self._histogrammer._photon_candidates[candidate]
+            if choose == "first":
+                self._cache[key] = self.first_photon(required, vetoed)
+            else:
+                self._cache[key] = self.last_photon(required, vetoed)
+        return self._cache[key]
+
+    # set_photon(): set the chosen photon of a photon candidate, instead of running the photon ID (see MonoPhotonHistogrammer.rehist())
+    def set_photon(self, candidate, i_photon):
+        self._cache[("photon", candidate)] = i_photon
+
+    # namespace(): namespace for evaluating spec expressions for the given photon candidate
+    def namespace(self, candidate):
+        if not candidate in self._namespaces:
+            self._namespaces[candidate] = SpecNamespace(self, candidate, self._histogrammer._parameters)
+        return self._namespaces[candidate]
+
+    # evaluate(): value of a compiled spec expression. Expressions not using photon variables are shared by all photon candidates.
+    def evaluate(self, expression, candidate):
+        key = (expression.expression, candidate if expression.photon_dependent else None)
+        if not key in self._expressions:
+            self._expressions[key] = expression.evaluate(self.namespace(candidate))
+        return self._expressions[key]
+
+    # variation_parameters(): the varied parameters (see MonoPhotonHistogrammer.set_variations()), as arrays over the variations
+    def variation_parameters(self):
+        return self._histogrammer._variation_parameters
+
+    # evaluate_variations(): value of a compiled spec expression in each parameter variation, as an array over the variations. Expressions not using varied parameters are evaluated once, as in evaluate().
+    def evaluate_variations(self, expression, candidate):
+        if not expression.expression in self._histogrammer._varied_expressions:
+            return self.evaluate(expression, candidate)
+        key = (expression.expression, candidate if expression.photon_dependent else None, "variations")
+        if not key in self._expressions:
+            namespace_key = (candidate, "variations")
+            if not namespace_key in self._namespaces:
+                self._namespaces[namespace_key] = SpecNamespace(self, candidate, dict(self._histogrammer._parameters, **self.variation_parameters()))
+            self._expressions[key] = expression.evaluate(self._namespaces[namespace_key])
+        return self._expressions[key]
+
+    def event_variable(self, name):
+        key = ("event_variable", name)
+        if not key in self._cache:
+            self._cache[key] = self.event_variable_functions[name](self)
+        return self._cache[key]
+
+    def photon_variable(self, name, candidate):
+        return self.photon_variable_functions[name](self, self.photon(candidate))
+
+    def pass_signal_triggers(self):
+        if not "signal_triggers" in self._cache:
+            self._cache["signal_triggers"] = self._histogrammer.pass_signal_triggers()
+        return self._cache["signal_triggers"]
+
+    def pass_backup_triggers(self):
+        if not "backup_triggers" in self._cache:
+            self._cache["backup_triggers"] = self._histogrammer.pass_backup_triggers()
+        return self._cache["backup_triggers"]
+
+    # photon_id_words(): ID word of each photon in the event (see photon_id.py), computed once for all selections
+    def photon_id_words(self):
+        if not "photon_id_words" in self._cache:
+            self._cache["photon_id_words"] = [self._histogrammer.photon_id_word(i) for i in xrange(self._data.nPho)]
+        return self._cache["photon_id_words"]
+
+    # first_photon(), last_photon(): index of the first/last photon passing the (required bits, vetoed bits) photon selection, or -1
+    def first_photon(self, required, vetoed):
+        for i, word in enumerate(self.photon_id_words()):
+            if pass_photon_selection(word, required, vetoed):
+                return i
+        return -1
+
+    def last_photon(self, required, vetoed):
+        i_photon = -1
+        for i, word in enumerate(self.photon_id_words()):
+            if pass_photon_selection(word, required, vetoed):
+                i_photon = i
+        return i_photon
+
+    # loose_electrons(), loose_muons(): indices of the leptons passing the loose ID and pT > 10 GeV, before the photon overlap removal
+    def loose_electrons(self):
+        if not "loose_electrons" in self._cache:
+            self._cache["loose_electrons"] = [i for i in xrange(self._data.nEle) if self._histogrammer.electron_id_loose(i) and self._data.elePt[i] > 10.]
+        return self._cache["loose_electrons"]
+
+    def loose_muons(self):
+        if not "loose_muons" in self._cache:
+            self._cache["loose_muons"] = [i for i in xrange(self._data.nMu) if self._histogrammer.muon_id_loose(i) and self._data.muPt[i] > 10.]
+        return self._cache["loose_muons"]
+
+    # lepton_photon_dR(): delta R between lepton i_lepton of the given flavor ("ele" or "mu") and photon i_photon
+    def lepton_photon_dR(self, flavor, i_lepton, i_photon):
+        key = (flavor, i_lepton, i_photon)
+        if not key in self._lepton_photon_dR:
+            lepton_eta = getattr(self._data, flavor + "Eta")[i_lepton]
+            lepton_phi = getattr(self._data, flavor + "Phi")[i_lepton]
+            self._lepton_photon_dR[key] = math.sqrt((lepton_eta - self._data.phoEta[i_photon])**2 + (math.acos(math.cos(lepton_phi - self._data.phoPhi[i_photon])))**2)
+        return self._lepton_photon_dR[key]
+
+    # n_electrons(), n_muons(): number of loose leptons away from the photon (dR > 0.5), for the lepton vetoes
+    def n_electrons(self, i_photon):
+        key = ("n_electrons", i_photon)
+        if not key in self._cache:
+            self._cache[key] = len([i for i in self.loose_electrons() if self.lepton_photon_dR("ele", i, i_photon) > 0.5])
+        return self._cache[key]
+
+    def n_muons(self, i_photon):
+        key = ("n_muons", i_photon)
+        if not key in self._cache:
+            self._cache[key] = len([i for i in self.loose_muons() if self.lepton_photon_dR("mu", i, i_photon) > 0.5])
+        return self._cache[key]
+
+    # pass_dphi_jet_MET(): MET away from the leading 4 jets
+    def pass_dphi_jet_MET(self):
+        if not "dphi_jet_MET" in self._cache:
+            self._cache["dphi_jet_MET"] = True
+            for i in xrange(min(4, self._data.nJet)):
+                if math.acos(math.cos(self._data.jetPhi[i] - self._data.pfMETPhi)) < 0.5 and self._data.jetPt[i] > 30.:
+                    self._cache["dphi_jet_MET"] = False
+                    break
+        return self._cache["dphi_jet_MET"]
+
+    def dphi_photon_MET(self, i_photon):
+        key = ("dphi_photon_MET", i_photon)
+        if not key in self._cache:
+            self._cache[key] = math.acos(math.cos(self._data.phoPhi[i_photon] - self._data.pfMETPhi))
+        return self._cache[key]
+
+# ChunkContext: the EventContext of run_columnar(), over a chunk of events from RootChunkReader.
+# - Variables and expressions are per-event NumPy arrays, photon candidates are per-event photon indices (-1 if none).
+class ChunkContext(EventContext):
+    event_variable_functions = {
+        "one":               lambda chunk: np.ones(chunk.n_events),
+        "pfmet":             lambda chunk: chunk.events["pfMET"],
+        "pfmet_phi":         lambda chunk: chunk.events["pfMETPhi"],
+        "met_filters":       lambda chunk: chunk.events["metFilters"],
+        "signal_triggers":   lambda chunk: chunk._histogrammer.columnar_signal_triggers(chunk.events),
+        "backup_triggers":   lambda chunk: chunk._histogrammer.columnar_backup_triggers(chunk.events),
+        "njets":             lambda chunk: chunk.events["nJet"],
+        "has_jet":           lambda chunk: chunk.events["nJet"] > 0,
+        "leading_jet_pt":    lambda chunk: chunk.events["jetPt"].take(np.zeros(chunk.n_events, dtype=np.int64), default=-1.),
+        "leading_jet_eta":   lambda chunk: chunk.events["jetEta"].take(np.zeros(chunk.n_events, dtype=np.int64), default=-999.),
+        "dphi_jet_met_pass": lambda chunk: chunk.pass_dphi_jet_MET(),
+    }
+    photon_variable_functions = {
+        "photon_pt":         lambda chunk, i: chunk.events["phoEt"].take(i, default=0.),
+        "photon_eta":        lambda chunk, i: chunk.events["phoEta"].take(i, default=0.),
+        "photon_SCeta":      lambda chunk, i: chunk.events["phoSCEta"].take(i, default=0.),
+        "photon_phi":        lambda chunk, i: chunk.events["phoPhi"].take(i, default=0.),
+        "photon_SCphi":      lambda chunk, i: chunk.events["phoSCPhi"].take(i, default=0.),
+        "dphi_photon_met":   lambda chunk, i: delta_phi(chunk.events["phoPhi"].take(i, default=0.), chunk.events["pfMETPhi"]),
+        "n_electrons":       lambda chunk, i: chunk.n_electrons(i),
+        "n_muons":           lambda chunk, i: chunk.n_muons(i),
+    }
+
+    def __init__(self, histogrammer, events):
+        EventContext.__init__(self, histogrammer)
+        self.events = events
+        self.n_events = len(events["pfMET"])
+
+    def photon(self, candidate):
+        key = ("photon", candidate)
+        if not key in self._cache:
+            required, vetoed, choose = self._histogrammer._photon_candidates[candidate]
+            photon_mask = pass_photon_selection(self.events["phoIDWord"].content, required, vetoed)
+            if choose == "first":
+                self._cache[key] = self.events["phoEt"].first_index(photon_mask)
+            else:
+                self._cache[key] = self.events["phoEt"].last_index(photon_mask)
+        return self._cache[key]
+
+    def photon_variable(self, name, candidate):
+        key = ("photon_variable", name, candidate)
+        if not key in self._cache:
+            self._cache[key] = self.photon_variable_functions[name](self, self.photon(candidate))
+        return self._cache[key]
+
+    # variation_parameters(): as arrays of shape (variations, 1), so that expressions evaluate to (variations, events)
+    def variation_parameters(self):
+        return dict((name, values[:, np.newaxis]) for name, values in self._histogrammer._variation_parameters.iteritems())
+
+    # n_electrons(), n_muons(): number of loose leptons away from the photon in each event, for the lepton vetoes
+    def n_electrons(self, i_photon):
+        electrons = self.events["elePt"]
+        photon_eta = electrons.broadcast(self.events["phoEta"].take(i_photon, default=0.))
+        photon_phi = electrons.broadcast(self.events["phoPhi"].take(i_photon, default=0.))
+        dR_el_ph = np.sqrt((self.events["eleEta"].content - photon_eta)**2 + delta_phi(self.events["elePhi"].content, photon_phi)**2)
+        return electrons.count(self.loose_electrons() & (dR_el_ph > 0.5))
+
+    def n_muons(self, i_photon):
+        muons = self.events["muPt"]
+        photon_eta = muons.broadcast(self.events["phoEta"].take(i_photon, default=0.))
+        photon_phi = muons.broadcast(self.events["phoPhi"].take(i_photon, default=0.))
+        dR_mu_ph = np.sqrt((self.events["muEta"].content - photon_eta)**2 + delta_phi(self.events["muPhi"].content, photon_phi)**2)
+        return muons.count(self.loose_muons() & (dR_mu_ph > 0.5))
+
+    # loose_electrons(), loose_muons(): flat masks of the leptons passing the loose ID and pT > 10 GeV
+    def loose_electrons(self):
+        if not "loose_electrons" in self._cache:
+            self._cache["loose_electrons"] = self._histogrammer.columnar_electron_id_loose(self.events) & (self.events["elePt"].content > 10.)
+        return self._cache["loose_electrons"]
+
+    def loose_muons(self):
+        if not "loose_muons" in self._cache:
+            self._cache["loose_muons"] = self._histogrammer.columnar_muon_id_loose(self.events) & (self.events["muPt"].content > 10.)
+        return self._cache["loose_muons"]
+
+    # pass_dphi_jet_MET(): MET away from the leading 4 jets
+    def pass_dphi_jet_MET(self):
+        if not "dphi_jet_MET" in self._cache:
+            jets = self.events["jetPt"]
+            bad_jet = (jets.local_index < 4) & (delta_phi(self.events["jetPhi"].content, jets.broadcast(self.events["pfMETPhi"])) < 0.5) & (jets.content > 30.)
+            self._cache["dphi_jet_MET"] = ~jets.any(bad_jet)
+        return self._cache["dphi_jet_MET"]
 
 class MonoPhotonHistogrammer:
-    def __init__(self, tree_name="ggNtuplizer/EventTree", is_data=True):
+    # Branches read by the selections and fill_histograms(). All other branches are switched off in run() (see activate_branches()), and read by run_columnar().
+    # If you add a new variable to the analysis, add its branch here (trace_branches() can be used to check the list).
+    analysis_branches = [
+        "nPho", "phoEt", "phoEta", "phoPhi", "phoSCEta", "phoSCPhi", "phoHoverE", "phoSigmaIEtaIEtaFull5x5", "phohasPixelSeed", "phoPFChIso", "phoPFNeuIso", "phoPFPhoIso",
+        "nEle", "elePt", "eleEta", "elePhi", "eleSCEta", "elePFChIso", "elePFNeuIso", "elePFPhoIso", "eleSigmaIEtaIEtaFull5x5", "eledEtaAtVtx", "eledPhiAtVtx", "eleHoverE", "eleEoverPInv", "eleD0", "eleDz", "eleMissHits", "eleConvVeto",
+        "nMu", "muPt", "muEta", "muPhi", "muIsPFMuon", "muIsGlobalMuon", "muIsTrackerMuon", "muPFChIso", "muPFNeuIso", "muPFPhoIso", "muPFPUIso",
+        "nJet", "jetPt", "jetEta", "jetPhi",
+        "pfMET", "pfMETPhi", "HLTPho", "metFilters", "rho",
+    ]
+
+    # Scalar pre-filter (see set_prefilter()): the spec variables computed from prefilter_branches only, which are read in bulk with TTree::Draw()
+    prefilter_branches = ["pfMET", "HLTPho", "metFilters"]
+    prefilter_variables = ["one", "pfmet", "met_filters", "signal_triggers", "backup_triggers"]
+
+    def __init__(self, tree_name="ggNtuplizer/EventTree", is_data=True, spec=None):
+        self._tree_name = tree_name
         self._data = TChain(tree_name)
+        self._input_files = []
+        self._entry_ranges = [] # [(first entry, last entry or None)], one per input file
+        self._active_branches = None
+        self._trigger_turnons = False
+        self._bytes_read = 0
+        self._events_removed_by_skim = 0 # Events of the original ntuples that are not in the (skimmed) input files, see add_skim_normalization()
+        self._staging = None # Local staging area for the input files, see set_staging()
+        self._checkpoint_path = None # See set_checkpoint()
+        self._adaptive_warmup_events = 0 # Adaptive cut ordering, see set_adaptive_cut_order()
+        self._cut_order_path = None
+        self._prefilter_block_size = 0 # Scalar pre-filter, see set_prefilter()
+        self._prefilter_block = None
+        self._entries_skipped = 0
+        self._current_tree = (None, -1) # (TChain, tree number) of the per-file metrics, see track_input_file()
+        self._staged_file_index = None # Input file read by staged_entries_to_process()
+        self._sidecar_dir = None # Selection sidecars, see set_sidecar_dir()
+        self._sidecar_record = None
+        self._catalogue = None # File catalogue for the fingerprints of remote input files, see set_catalogue()
+        self._variations = [] # Parameter variations, see set_variations()
+        self._metrics = RunMetrics() # Timings, throughput and memory, written next to the output file by finish() (see metrics.py)
+        self._spec = spec if spec is not None else default_spec # Regions and histograms, see analysis_spec.py
         self._is_data = is_data # True if running over real data, false if running over MC
         print "[MonoPhotonHistogrammer::__init__] INFO : self._is_data = {}".format(self._is_data)
 
@@ -28,19 +389,63 @@ class MonoPhotonHistogrammer:
     ### Main functions ###
     ######################
 
-    # start(): performs the initial setup, such as creating histograms
+    # start(): performs the initial setup, such as compiling the analysis spec and creating histograms
     def start(self):
         print "[MonoPhotonHistogrammer::start] INFO : In start()."
 
         self._selections = [] # [selection_name]
         self._histograms = {} # {selection_name : {histogram_name : histogram}}
 
-        # Make a list of the selections. We'll run multiple selections at once: one for the actual signal region, plus other selections for things like trigger efficiency estimation or control regions for validating background estimations.
-        self._selections.append("trigger_numerator")
-        self._selections.append("trigger_denominator")
-        self._selections.append("sr")
-        self._selections.append("cr_electronfakes")
-        self._selections.append("cr_jetfakes")
+        # Compile the spec (see analysis_spec.py). We'll run multiple selections at once: one for the actual signal region, plus other selections for things like trigger efficiency estimation or control regions for validating background estimations.
+        # Each distinct expression is compiled once, and evaluated at most once per event however many regions use it (see EventContext.evaluate()).
+        self._compiled_expressions = {}
+        self._parameters = dict((name, float(value)) for name, value in self._spec["parameters"].iteritems())
+        # Parameter variations (see set_variations()): {varied parameter : array of its value in each variation}
+        variation_names = [variation["name"] for variation in self._variations]
+        if len(set(variation_names)) != len(variation_names):
+            raise ValueError("[MonoPhotonHistogrammer::start] ERROR : Duplicate variation names in {}".format(variation_names))
+        for variation in self._variations:
+            unknown_parameters = set(variation["parameters"]) - set(self._parameters)
+            if unknown_parameters:
+                raise ValueError("[MonoPhotonHistogrammer::start] ERROR : Variation {} changes unknown parameters {}".format(variation["name"], sorted(unknown_parameters)))
+        varied_parameters = set(name for variation in self._variations for name in variation["parameters"])
+        self._variation_parameters = dict((name, np.array([float(variation["parameters"].get(name, self._parameters[name])) for variation in self._variations])) for name in varied_parameters)
+        self._photon_candidates = {} # {name : (required bits, vetoed bits, "first" or "last")}
+        for name, photon in self._spec["photons"].iteritems():
+            self._photon_candidates[name] = self.compile_photon_candidate(photon)
+        self._regions = [] # See compile_region()
+        for region in self._spec["regions"]:
+            if not region["photon"] in self._photon_candidates:
+                raise ValueError("[MonoPhotonHistogrammer::start] ERROR : Region {} uses unknown photon candidate {}".format(region["name"], region["photon"]))
+            self._regions.append(self.compile_region(region))
+            self._selections.append(region["name"])
+        for i_region, region in enumerate(self._regions):
+            region["bit"] = 1 << i_region # Selection sidecars
+
+        # Scalar pre-filter: entries can only be skipped with the adaptive cut order (the photon candidate is the first step otherwise), if every region has a pre-filter cut,
+        # and a weight known without the full event (for the weighted cutflows of the skipped entries)
+        if self._prefilter_block_size > 0 and self._adaptive_warmup_events == 0:
+            print "[MonoPhotonHistogrammer::start] WARNING : The pre-filter needs the adaptive cut order. Running without the pre-filter."
+            self._prefilter_block_size = 0
+        if self._prefilter_block_size > 0:
+            for region in self._regions:
+                if not any(step["cut"] is not None and self.is_prefilter_expression(step["cut"]) for step in region["steps"]) or not (region["constant_weight"] is not None or region["weight"].photon_dependent or self.is_prefilter_expression(region["weight"])):
+                    print "[MonoPhotonHistogrammer::start] WARNING : Region {} has no pre-filter cut, or a weight that needs the full event. Running without the pre-filter.".format(region["name"])
+                    self._prefilter_block_size = 0
+                    break
+        self._histogram_specs = [] # [{"name", "variable", "require", "weighted"}]
+        for histogram in self._spec["histograms"]:
+            self._histogram_specs.append({
+                "name": histogram["name"],
+                "variable": self.compile_expression(histogram["variable"]),
+                "require": self.compile_expression(histogram["require"]) if "require" in histogram else None,
+                "weighted": histogram.get("weighted", True),
+                "variation_names": ["{}_{}".format(histogram["name"], variation_name) for variation_name in variation_names],
+            })
+        # The expressions using varied parameters, and the regions using them in a cut or in the weight
+        self._varied_expressions = set(expression for expression, compiled in self._compiled_expressions.iteritems() if set(compiled.code.co_names) & varied_parameters)
+        for region in self._regions:
+            region["varied"] = any(step["cut"].expression in self._varied_expressions for step in region["steps"] if step["cut"] is not None) or region["weight"].expression in self._varied_expressions
 
         # Create histograms
         # Old code: it used to make coarse, variable-width histograms. Now, make fine-binned histograms here, and rebin later if needed
@@ -48,99 +453,661 @@ class MonoPhotonHistogrammer:
         #met_bins = array.array("d", [0., 130., 150., 170., 190., 250., 400., 700.0, 1000.0])
         for selection in self._selections:
             self._histograms[selection] = {}
-
-            self._histograms[selection]["events_passed"] = TH1D("{}_events_passed".format(selection), "{}_events_passed".format(selection), 1, 0.5, 1.5)
-
-            self._histograms[selection]["events_passed_weighted"] = TH1D("{}_events_passed_weighted".format(selection), "{}_events_passed_weighted".format(selection), 1, 0.5, 1.5)
-
-            self._histograms[selection]["photon_pt"] = TH1D("{}_photon_pt".format(selection), "{}_photon_pt".format(selection), 200, 0., 1000.)
-            self._histograms[selection]["photon_pt"].GetXaxis().SetTitle("#gamma p_{T} [GeV]")
-
-            self._histograms[selection]["photon_eta"] = TH1D("{}_photon_eta".format(selection), "{}_photon_eta".format(selection), 60, -1.5, 1.5)
-            self._histograms[selection]["photon_eta"].GetXaxis().SetTitle("#gamma #eta")
-
-            self._histograms[selection]["photon_SCeta"] = TH1D("{}_photon_SCeta".format(selection), "{}_photon_SCeta".format(selection), 60, -1.5, 1.5)
-            self._histograms[selection]["photon_SCeta"].GetXaxis().SetTitle("#gamma #eta_{SC}")
-
-            self._histograms[selection]["photon_phi"] = TH1D("{}_photon_phi".format(selection), "{}_photon_phi".format(selection), 100, -1.1*math.pi, 1.1*math.pi)
-            self._histograms[selection]["photon_phi"].GetXaxis().SetTitle("#gamma #phi")
-
-            self._histograms[selection]["photon_SCphi"] = TH1D("{}_photon_SCphi".format(selection), "{}_photon_SCphi".format(selection), 120, -1.1 * math.pi, 1.1 * math.pi)
-            self._histograms[selection]["photon_SCphi"].GetXaxis().SetTitle("#gamma #phi_{SC}")
-
-            self._histograms[selection]["pfmet"] = TH1D("{}_pfmet".format(selection), "{}_photon_pfmet".format(selection), 100, 0., 1000.)
-            self._histograms[selection]["pfmet"].GetXaxis().SetTitle("PF MET [GeV]")
-
-            self._histograms[selection]["dphi_photon_met"] = TH1D("{}_dphi_photon_met".format(selection), "{}_dphi_photon_met".format(selection), 100, 0., math.pi)
-            self._histograms[selection]["dphi_photon_met"].GetXaxis().SetTitle("#Delta#phi(#gamma, PF MET)")
-
-            self._histograms[selection]["njets"] = TH1D("{}_njets".format(selection), "{}_njets".format(selection), 21, -0.5, 20.5)
-            self._histograms[selection]["njets"].GetXaxis().SetTitle("n_{jets}")
-
-            self._histograms[selection]["leading_jet_pt"] = TH1D("{}_leading_jet_pt".format(selection), "{}_leading_jet_pt".format(selection), 50, 0., 1000.)
-            self._histograms[selection]["leading_jet_pt"].GetXaxis().SetTitle("Leading jet p_{T} [GeV]")
-
-            self._histograms[selection]["leading_jet_eta"] = TH1D("{}_leading_jet_eta".format(selection), "{}_leading_jet_eta".format(selection), 50, -5., 5.)
-            self._histograms[selection]["leading_jet_eta"].GetXaxis().SetTitle("Leading jet #eta")
+            for histogram in self._spec["histograms"]:
+                name = histogram["name"]
+                if name in ["cutflow", "cutflow_weighted"]:
+                    raise ValueError("[MonoPhotonHistogrammer::start] ERROR : Histogram name {} is reserved for the cutflows".format(name))
+                title = histogram.get("title", "{region}_" + name).format(region=selection)
+                self._histograms[selection][name] = TH1D("{}_{}".format(selection, name), title, *histogram["bins"])
+                if "xtitle" in histogram:
+                    self._histograms[selection][name].GetXaxis().SetTitle(histogram["xtitle"])
+
+        # Histograms of the parameter variations, for the regions they change: <region>_<histogram>_<variation>
+        for region in self._regions:
+            if not region["varied"]:
+                continue
+            for histogram in self._spec["histograms"]:
+                for variation_name in variation_names:
+                    name = "{}_{}".format(histogram["name"], variation_name)
+                    if name in self._histograms[region["name"]]:
+                        raise ValueError("[MonoPhotonHistogrammer::start] ERROR : Histogram {} of variation {} clashes with another histogram of region {}".format(name, variation_name, region["name"]))
+                    title = "{}_{}".format(histogram.get("title", "{region}_" + histogram["name"]).format(region=region["name"]), variation_name)
+                    self._histograms[region["name"]][name] = TH1D("{}_{}".format(region["name"], name), title, *histogram["bins"])
+                    if "xtitle" in histogram:
+                        self._histograms[region["name"]][name].GetXaxis().SetTitle(histogram["xtitle"])
+
+        # Cutflows: bin 1 counts all events, bin k + 1 the events passing the first k steps of the region, in the order they are evaluated (see compile_region())
+        for region in self._regions:
+            for name in ["cutflow", "cutflow_weighted"]:
+                cutflow = TH1D("{}_{}".format(region["name"], name), "{}_{}".format(region["name"], name), len(region["steps"]) + 1, -0.5, len(region["steps"]) + 0.5)
+                cutflow.Sumw2()
+                cutflow.GetXaxis().SetBinLabel(1, "all events")
+                self._histograms[region["name"]][name] = cutflow
+            self.set_cut_order(region, region["order"])
+        if self._adaptive_warmup_events > 0 and self._cut_order_path and os.path.isfile(self._cut_order_path):
+            self.load_cut_orders()
+
+        # Trigger turn-ons for all photon triggers (see set_trigger_turnons())
+        if self._trigger_turnons:
+            if not "trigger_denominator" in self._selections:
+                raise ValueError("[MonoPhotonHistogrammer::start] ERROR : Trigger turn-ons need a trigger_denominator region in the spec")
+            self._selections.append("trigger_turnon")
+            self._histograms["trigger_turnon"] = {}
+            self._turnon_triggers = [(trigger.name[1:], 1 << trigger.value) for trigger in PhotonTriggers] # [(trigger name, HLTPho bit mask)]
+            for numerator in ["denominator"] + [name for name, mask in self._turnon_triggers]:
+                self._histograms["trigger_turnon"]["{}_photon_pt".format(numerator)] = TH1D("trigger_turnon_{}_photon_pt".format(numerator), "trigger_turnon_{}_photon_pt".format(numerator), 200, 0., 1000.)
+                self._histograms["trigger_turnon"]["{}_photon_pt".format(numerator)].GetXaxis().SetTitle("#gamma p_{T} [GeV]")
+
+                self._histograms["trigger_turnon"]["{}_pfmet".format(numerator)] = TH1D("trigger_turnon_{}_pfmet".format(numerator), "trigger_turnon_{}_pfmet".format(numerator), 100, 0., 1000.)
+                self._histograms["trigger_turnon"]["{}_pfmet".format(numerator)].GetXaxis().SetTitle("PF MET [GeV]")
+
+        # Fill values are buffered per histogram, and filled with TH1::FillN (see histogram_buffers.py). The buffers are flushed in finish().
+        self._fill_buffers = make_fill_buffers(self._histograms)
 
         self._events_processed = 0
+        print "[MonoPhotonHistogrammer::start] INFO : Compiled {} regions x {} histograms ({} distinct expressions).".format(len(self._regions), len(self._histogram_specs), len(self._compiled_expressions))
+        if self._variations:
+            print "[MonoPhotonHistogrammer::start] INFO : {} parameter variations of {} in regions {}.".format(len(self._variations), sorted(varied_parameters), [region["name"] for region in self._regions if region["varied"]])
         print "[MonoPhotonHistogrammer::start] INFO : Done with start()."
 
     # run(): implements the event loop
     def run(self, max_events=-1, first_event=0, nprint=-1):
         print "[MonoPhotonHistogrammer::run] INFO : In run()."
 
-        total_entries = self._data.GetEntries()
-        if max_events > 0:
-            limit_nevents = min(max_events, total_entries)
+        # Only read the branches used by the analysis
+        self.activate_branches()
+        bytes_read_start = TFile.GetFileBytesRead()
+
+        if self._staging:
+            # The number of entries is only known file by file (the files are opened as they are staged), so progress is printed per file
+            limit_nevents, entries = None, self.staged_entries_to_process(max_events)
         else:
-            limit_nevents = total_entries
+            limit_nevents, entries = self.entries_to_process(max_events)
 
         # Setup the progress timer
         # Print progress every 5%
         n_checkpoints = 20
-        print_every = int(math.ceil(1. * limit_nevents / n_checkpoints))
+        print_every = int(math.ceil(1. * limit_nevents / n_checkpoints)) if limit_nevents is not None else None
+
+        # Resume from the last checkpoint: the histograms and counters are restored, and the entries it had already processed are skipped
+        n_entries_done = 0
+        if self._checkpoint_path:
+            checkpoint_key = self.checkpoint_key(max_events)
+            if self._resume:
+                n_entries_done = self.load_checkpoint(checkpoint_key)
+                entries = itertools.islice(entries, n_entries_done, None)
+            last_checkpoint = (self._events_processed, time.time())
+
+        metrics = self._metrics
+        self._current_tree = (None, -1)
+
+        # With the scalar pre-filter, only the candidate entries come out of the loop (the others are counted in bulk, see prefilter_entries())
+        if self._prefilter_block_size > 0:
+            entries = self.prefilter_entries(entries, n_entries_done)
+        else:
+            entries = enumerate(entries, n_entries_done)
 
         self.start_timer()
-        for i in xrange(limit_nevents):
-            self.print_progress(i, first_event, limit_nevents, print_every)
-            self._data.GetEntry(i)
+        for i, entry in entries:
+            if print_every:
+                self.print_progress(i, first_event, limit_nevents, print_every)
+            io_start = time.time()
+            self._data.GetEntry(entry)
+            metrics.phases["io"] += time.time() - io_start
+            self.track_input_file()
+            metrics.count_event()
             self._events_processed += 1
+            passed_bits = self.process_event()
+            if self._sidecar_record:
+                self.record_sidecar_entry(entry, passed_bits)
+
+            # Not during the warm-up of the adaptive cut ordering, whose events only enter the cutflows once the order is known (see adapt_cut_order())
+            if self._checkpoint_path and (self._events_processed - last_checkpoint[0] >= self._checkpoint_every_events or time.time() - last_checkpoint[1] >= self._checkpoint_every_seconds) and not any(region["warmup"] for region in self._regions):
+                self.write_checkpoint(checkpoint_key, i + 1)
+                last_checkpoint = (self._events_processed, time.time())
+
+        metrics.end_file(TFile.GetFileBytesRead())
+        if self._sidecar_record:
+            self.close_sidecar_record()
+
+        # Print performance
+        elapsed_time = time.time() - self._ts_start
+        print "[MonoPhotonHistogrammer::run] INFO : Done processing events. Processed {} events in {:.2f}s = {:.2f} Hz".format(self._events_processed, elapsed_time, self._events_processed / elapsed_time)
+        self._bytes_read = TFile.GetFileBytesRead() - bytes_read_start
+        print "[MonoPhotonHistogrammer::run] INFO : Read {:.2f} MB from {} active branches ({:.1f} kB / event)".format(self._bytes_read / 1.e6, len(self._active_branches), self._bytes_read / 1.e3 / max(self._events_processed, 1))
+        if self._prefilter_block_size > 0:
+            print "[MonoPhotonHistogrammer::run] INFO : The pre-filter skipped {} / {} events".format(self._entries_skipped, self._events_processed)
 
-            ########################
-            ### Event selections ###
-            ########################
+        print "[MonoPhotonHistogrammer::run] INFO : Done with run()."
 
-            # Signal region selection
-            pass_SR, i_ph_sr = self.pass_selection_SR()
-            if pass_SR:
-                self.fill_histograms("sr", i_ph_sr, event_weight=1.)
+    # track_input_file(): start a new per-file metrics record (and selection sidecar record) when the TChain has moved on to another input file
+    def track_input_file(self):
+        if self._data.GetTreeNumber() != self._current_tree[1] or not self._data is self._current_tree[0]:
+            self._current_tree = (self._data, self._data.GetTreeNumber())
+            self._metrics.start_file(self._data.GetCurrentFile().GetName(), TFile.GetFileBytesRead())
+            if self._sidecar_dir:
+                self.start_sidecar_record()
+
+    # prefilter_entries(): enumerate(entries, first_index), without the entries that fail the scalar pre-filter (see set_prefilter())
+    # - The entries are taken in blocks of up to self._prefilter_block_size entries of one input file, and the pre-filter of each block is evaluated at once (see prefilter_block()).
+    # - The skipped entries are counted as processed and in the cutflows by flush_prefilter(), at the end of each block and before checkpoints.
+    def prefilter_entries(self, entries, first_index):
+        entries = iter(entries)
+        i = first_index
+        entry = next(entries, None)
+        while entry is not None:
+            # The TChain can change between blocks (staged input files)
+            data = self._data
+            local_entry = data.LoadTree(entry)
+            self.track_input_file()
+            block_start = entry
+            block_stop = min(entry - local_entry + data.GetTree().GetEntries(), entry + self._prefilter_block_size)
+            self._prefilter_block = self.prefilter_block(block_start, block_stop)
+            candidates = self._prefilter_block["candidates"]
+            skipped = self._prefilter_block["skipped"]
+            while entry is not None and self._data is data and block_start <= entry < block_stop:
+                if candidates[entry - block_start]:
+                    yield i, entry
+                else:
+                    skipped[entry - block_start] = True
+                i += 1
+                entry = next(entries, None)
+            self.flush_prefilter()
+        self._prefilter_block = None
+
+    # prefilter_block(): read the pre-filter branches of the TChain entries [block_start, block_stop) with TTree::Draw(), and evaluate the pre-filter cuts of every region on them
+    # - Returns {"candidates": entries passing the pre-filter cuts of at least one region, "skipped": skipped entries not counted yet, "steps_passed" and "weights": per region, for the cutflows}
+    # - HLTPho is read as a double, so trigger words above 2^53 are not exact: their entries are always candidates.
+    def prefilter_block(self, block_start, block_stop):
+        self._data.SetEstimate(block_stop - block_start + 1)
+        n_entries = self._data.Draw(":".join(self.prefilter_branches), "", "goff", block_stop - block_start, block_start)
+        events = {}
+        for i_branch, branch in enumerate(self.prefilter_branches):
+            values = self._data.GetVal(i_branch)
+            values.SetSize(n_entries)
+            events[branch] = np.frombuffer(values, dtype=np.float64, count=n_entries).copy()
+        inexact = events["HLTPho"] >= 2.**53
+        events["HLTPho"] = np.where(inexact, 0., events["HLTPho"]).astype(np.uint64)
+        chunk = ChunkContext(self, events)
+
+        candidates = inexact
+        steps_passed = {}
+        weights = {}
+        for region in self._regions:
+            region_mask = np.ones(n_entries, dtype=bool)
+            steps_passed[region["name"]] = np.zeros(n_entries, dtype=np.int64)
+            for i_step in region["prefilter_steps"]:
+                region_mask = region_mask & np.broadcast_to(chunk.evaluate(region["steps"][i_step]["cut"], region["photon"]), region_mask.shape)
+                steps_passed[region["name"]] += region_mask
+            candidates = candidates | region_mask
+            # Entries passing the pre-filter cuts in a parameter variation are candidates too
+            if region["varied"]:
+                variations_mask = np.ones((len(self._variations), n_entries), dtype=bool)
+                for i_step in region["prefilter_steps"]:
+                    variations_mask = variations_mask & np.broadcast_to(chunk.evaluate_variations(region["steps"][i_step]["cut"], region["photon"]), variations_mask.shape)
+                candidates = candidates | variations_mask.any(axis=0)
+            # The skipped entries fail before the photon candidate, so they are left out of the weighted cutflow if the weight depends on the photon (see count_cutflow())
+            if region["constant_weight"] is not None:
+                weights[region["name"]] = np.full(n_entries, region["constant_weight"])
+            elif region["weight"].photon_dependent:
+                weights[region["name"]] = np.zeros(n_entries)
+            else:
+                weights[region["name"]] = np.broadcast_to(np.asarray(chunk.evaluate(region["weight"], region["photon"]), dtype=np.float64), region_mask.shape)
+        return {"candidates": candidates, "skipped": np.zeros(n_entries, dtype=bool), "steps_passed": steps_passed, "weights": weights}
+
+    # flush_prefilter(): count the entries skipped by the pre-filter so far as processed, and in the cutflows of the regions
+    def flush_prefilter(self):
+        block = self._prefilter_block
+        if block is None or not block["skipped"].any():
+            return
+        skipped = block["skipped"]
+        n_skipped = int(np.count_nonzero(skipped))
+        self._events_processed += n_skipped
+        self._entries_skipped += n_skipped
+        self._metrics.count_event(n_skipped)
+        if self._sidecar_record:
+            self._sidecar_record["entries_seen"] += n_skipped
+        for region in self._regions:
+            steps_passed = block["steps_passed"][region["name"]][skipped]
+            weights = block["weights"][region["name"]][skipped]
+            n_bins = len(region["steps"]) + 1
+            for exits, counts in zip(region["cutflow_exits"], [np.bincount(steps_passed, minlength=n_bins), np.bincount(steps_passed, weights=weights, minlength=n_bins), np.bincount(steps_passed, weights=weights * weights, minlength=n_bins)]):
+                for n_passed in xrange(n_bins):
+                    exits[n_passed] += counts[n_passed]
+        skipped[:] = False
+
+    # process_event(): runs the regions of the spec on the currently loaded event, and fills the histograms of the regions it passes. Returns the bits (region["bit"]) of the regions passed.
+    # - The time spent in the cuts of each region and in the filling is added to the metrics
+    def process_event(self):
+        self._event = EventContext(self)
+        phases = self._metrics.phases
+        selections = self._metrics.selections
+
+        passed_bits = 0
+        for region in self._regions:
+            selection_start = time.time()
+            passed = self.pass_region(region)
+            variations_passed = self.pass_region_variations(region) if region["varied"] else None
+            fill_start = time.time()
+            selections[region["name"]] = selections.get(region["name"], 0.) + fill_start - selection_start
+            phases["selection"] += fill_start - selection_start
+            if passed:
+                passed_bits |= region["bit"]
+                self.fill_region(region)
+            if variations_passed is not None:
+                self.fill_histograms_variations(region, variations_passed)
+            if passed or variations_passed is not None:
+                phases["fill"] += time.time() - fill_start
+        return passed_bits
+
+    # fill_region(): fill the histograms of a region passed by the current event (self._event), with the region weight
+    def fill_region(self, region):
+        self.fill_histograms(region, self._event.evaluate(region["weight"], region["photon"]))
+
+        # Trigger turn-ons, with the trigger_denominator region as the reference
+        if self._trigger_turnons and region["name"] == "trigger_denominator":
+            self.fill_trigger_turnons(self._data.HLTPho, self._event.photon_variable("photon_pt", region["photon"]), self._data.pfMET)
+
+    # start_sidecar_record(): start recording the regions passed and the chosen photons of the entries of the current input file, for its selection sidecar (see set_sidecar_dir())
+    def start_sidecar_record(self):
+        if self._sidecar_record:
+            self.close_sidecar_record()
+        i_file = self._staged_file_index if self._staging else self._data.GetTreeNumber()
+        n_entries = self._data.GetTree().GetEntries()
+        self._sidecar_record = {
+            "input_file": self._input_files[i_file],
+            "tree_offset": self._data.GetChainOffset(),
+            "entries_seen": 0,
+            "pass_bits": np.zeros(n_entries, dtype=pass_bits_dtype(len(self._regions))),
+            "photons": dict((candidate, np.full(n_entries, -1, dtype=np.int16)) for candidate in self._photon_candidates),
+            "cutflows": self.cutflow_totals(),
+        }
+
+    # record_sidecar_entry(): record the regions passed by the current event (TChain entry), and their photons
+    def record_sidecar_entry(self, entry, passed_bits):
+        record = self._sidecar_record
+        record["entries_seen"] += 1
+        if passed_bits:
+            local_entry = entry - record["tree_offset"]
+            record["pass_bits"][local_entry] = passed_bits
+            for region in self._regions:
+                if passed_bits & region["bit"]:
+                    record["photons"][region["photon"]][local_entry] = self._event.photon(region["photon"])
+
+    # close_sidecar_record(): write the selection sidecar of the recorded input file, if all its entries were processed (not for entry ranges, max_events or resumed runs)
+    # - The cutflows of the file are the difference of the cutflow totals; they are left out if the adaptive cut ordering was warming up (the warm-up events are counted later).
+    def close_sidecar_record(self):
+        record = self._sidecar_record
+        self._sidecar_record = None
+        if record["entries_seen"] != len(record["pass_bits"]):
+            print "[MonoPhotonHistogrammer::close_sidecar_record] INFO : Not all entries of {} were processed, no selection sidecar".format(record["input_file"])
+            return
+        cutflows = None
+        cutflow_totals = self.cutflow_totals()
+        if record["cutflows"] is not None and cutflow_totals is not None:
+            cutflows = {}
+            for region in self._regions:
+                start_exits = record["cutflows"][region["name"]]["exits"]
+                end_exits = cutflow_totals[region["name"]]["exits"]
+                cutflows[region["name"]] = {"labels": cutflow_totals[region["name"]]["labels"], "exits": [[end - start for start, end in zip(start_values, end_values)] for start_values, end_values in zip(start_exits, end_exits)]}
+        write_sidecar(self._sidecar_dir, record["input_file"], self.region_hash(), [region["name"] for region in self._regions], record["pass_bits"], record["photons"], cutflows, self._catalogue)
+
+    # cutflow_totals(): {region : {"labels", "exits"}}, the cutflow counts so far (flushed or not, see flush_cutflows()), or None during the warm-up of the adaptive cut ordering
+    def cutflow_totals(self):
+        if any(region["warmup"] is not None for region in self._regions):
+            return None
+        return dict((region["name"], {
+            "labels": [step["label"] for step in region["ordered_steps"]],
+            "exits": [[flushed + current for flushed, current in zip(flushed_values, current_values)] for flushed_values, current_values in zip(region["cutflow_flushed"], region["cutflow_exits"])],
+        }) for region in self._regions)
+
+    # rehist(): alternative to run(), which fills the histograms from the selection sidecars of the input files (see set_sidecar_dir()) instead of running the selection.
+    # - Only the entries that passed a region are read, with the photon candidates stored in the sidecar. The cutflows are taken from the sidecars (for whole input files).
+    # - Fills the same histograms as run(), also for spec histograms that changed since the sidecars were written. All input files need an up-to-date sidecar (see has_sidecars()).
+    def rehist(self, sidecar_dir, max_events=-1):
+        print "[MonoPhotonHistogrammer::rehist] INFO : In rehist()."
+        if self._variations:
+            raise ValueError("[MonoPhotonHistogrammer::rehist] ERROR : The selection sidecars only hold the nominal selection, so parameter variations need run()")
+        self.activate_branches()
+        bytes_read_start = TFile.GetFileBytesRead()
+        region_hash = self.region_hash()
+        self._data.GetEntries() # Loads the tree offsets
+        tree_offsets = self._data.GetTreeOffset()
+        metrics = self._metrics
+        self._current_tree = (None, -1)
+        for region in self._regions:
+            region["warmup"] = None # No selection to time
 
-            # Electron fake selection: different photon selection with pixel seed required
-            pass_CR_electronfakes, i_ph_electronfakes = self.pass_selection_CR_electronfakes()
-            if pass_CR_electronfakes:
-                r_electronfakes = 0.0184
-                self.fill_histograms("cr_electronfakes", i_ph_electronfakes, event_weight=r_electronfakes)
+        self.start_timer()
+        n_filled = 0
+        for i_file, input_file in enumerate(self._input_files):
+            sidecar = load_sidecar(sidecar_dir, input_file, region_hash, self._catalogue)
+            if sidecar is None:
+                raise ValueError("[MonoPhotonHistogrammer::rehist] ERROR : No up-to-date selection sidecar for {} in {}".format(input_file, sidecar_dir))
+            meta, pass_bits, photons = sidecar
+            path, first_entry, last_entry = split_entry_range(input_file)
+            if last_entry is None or last_entry > meta["entries"]:
+                last_entry = meta["entries"]
+            if max_events > 0:
+                last_entry = min(last_entry, first_entry + max_events - self._events_processed)
+            if last_entry <= first_entry:
+                break
+            self._data.LoadTree(tree_offsets[i_file] + first_entry)
+            self.track_input_file()
+            for local_entry in np.flatnonzero(pass_bits[first_entry:last_entry]) + first_entry:
+                io_start = time.time()
+                self._data.GetEntry(tree_offsets[i_file] + local_entry)
+                fill_start = time.time()
+                metrics.phases["io"] += fill_start - io_start
+                self._event = EventContext(self)
+                for region in self._regions:
+                    if pass_bits[local_entry] & region["bit"]:
+                        self._event.set_photon(region["photon"], int(photons[region["photon"]][local_entry]))
+                        self.fill_region(region)
+                metrics.phases["fill"] += time.time() - fill_start
+                n_filled += 1
+            metrics.count_event(last_entry - first_entry)
+            self._events_processed += last_entry - first_entry
+            if first_entry == 0 and last_entry == meta["entries"]:
+                self.add_sidecar_cutflows(input_file, meta)
+        metrics.end_file(TFile.GetFileBytesRead())
 
-            # Jet fake selection: different photon selection with very loose && !loose isolation
-            pass_CR_jetfakes, i_ph_jetfakes = self.pass_selection_CR_jetfakes()
-            if pass_CR_jetfakes:
-                r_qcd = 0.079 + 0.00014 * self._data.phoEt[i_ph_jetfakes]
-                self.fill_histograms("cr_jetfakes", i_ph_jetfakes, event_weight=r_qcd)
+        elapsed_time = time.time() - self._ts_start
+        print "[MonoPhotonHistogrammer::rehist] INFO : Done processing events. Filled {} of {} events in {:.2f}s = {:.2f} Hz".format(n_filled, self._events_processed, elapsed_time, self._events_processed / elapsed_time)
+        self._bytes_read = TFile.GetFileBytesRead() - bytes_read_start
+        print "[MonoPhotonHistogrammer::rehist] INFO : Read {:.2f} MB from {} active branches".format(self._bytes_read / 1.e6, len(self._active_branches))
+        print "[MonoPhotonHistogrammer::rehist] INFO : Done with rehist()."
+
+    # add_sidecar_cutflows(): add the cutflows of an input file, from its sidecar, to the cutflow counts. Regions whose cutflow order differs from the sidecar's (cut order, pre-filter) are left out.
+    def add_sidecar_cutflows(self, input_file, meta):
+        for region in self._regions:
+            cutflow = meta["cutflows"][region["name"]] if meta["cutflows"] else None
+            if cutflow is None or cutflow["labels"] != [step["label"] for step in region["ordered_steps"]]:
+                print "[MonoPhotonHistogrammer::add_sidecar_cutflows] WARNING : No cutflow of region {} in the sidecar of {} (or in a different cut order)".format(region["name"], input_file)
+                continue
+            for exits, counts in zip(region["cutflow_exits"], cutflow["exits"]):
+                for n_passed, count in enumerate(counts):
+                    exits[n_passed] += count
+
+    # has_sidecars(): all input files have an up-to-date selection sidecar in sidecar_dir, for rehist()
+    def has_sidecars(self, sidecar_dir):
+        region_hash = self.region_hash()
+        return all(load_sidecar_meta(sidecar_dir, input_file, region_hash, self._catalogue) for input_file in self._input_files)
+
+    # pass_region(): the event has the region's photon candidate, and passes all of its cuts. Must be called from process_event() (uses the per-event context self._event).
+    # - The steps are evaluated in the order of the region (see compile_region()), up to the first one failing, which is counted in the cutflow.
+    def pass_region(self, region):
+        if region["warmup"] is not None:
+            return self.pass_region_warmup(region)
+        for n_passed, step in enumerate(region["ordered_steps"]):
+            if step["cut"] is None:
+                passed = self._event.photon(region["photon"]) >= 0
+            else:
+                passed = self._event.evaluate(step["cut"], region["photon"])
+            if not passed:
+                self.count_cutflow(region, n_passed)
+                return False
+        self.count_cutflow(region, len(region["steps"]))
+        return True
+
+    # pass_region_variations(): the parameter variations (see set_variations()) in which the current event passes a region, as a boolean array over the variations, or None if it passes none
+    # - The cuts without varied parameters are shared with the nominal selection (see EventContext.evaluate()), and only the cuts using varied parameters are evaluated for all variations at once.
+    # - Not counted in the cutflows, which are those of the nominal parameters.
+    def pass_region_variations(self, region):
+        if self._event.photon(region["photon"]) < 0:
+            return None
+        variations_passed = np.ones(len(self._variations), dtype=bool)
+        for step in region["ordered_steps"]:
+            if step["cut"] is None:
+                continue
+            if step["cut"].expression in self._varied_expressions:
+                variations_passed = variations_passed & self._event.evaluate_variations(step["cut"], region["photon"])
+                if not variations_passed.any():
+                    return None
+            elif not self._event.evaluate(step["cut"], region["photon"]):
+                return None
+        return variations_passed
+
+    # count_cutflow(): count an event passing the first n_passed steps of the region
+    # - The weighted cutflow uses the region weight. Weights that depend on the photon are only defined with the photon candidate: the weighted cutflow then only counts
+    #   the events passing the photon candidate step (weight 0 for the others), and its bins before that step are left empty (see flush_cutflows()), whatever the cut order.
+    def count_cutflow(self, region, n_passed, weight=None):
+        if weight is None:
+            weight = region["constant_weight"]
+        if weight is None:
+            weight = self._event.evaluate(region["weight"], region["photon"]) if n_passed > region["photon_position"] or not region["weight"].photon_dependent else 0.
+        counts, weights, weights2 = region["cutflow_exits"]
+        counts[n_passed] += 1
+        weights[n_passed] += weight
+        weights2[n_passed] += weight * weight
+
+    # pass_region_warmup(): pass_region() for the warm-up events of the adaptive cut ordering (see set_adaptive_cut_order())
+    # - All steps are evaluated and timed (photon-dependent cuts only with a photon candidate). The results are kept, and counted in the cutflow by adapt_cut_order().
+    def pass_region_warmup(self, region):
+        results = []
+        for step in region["steps"]:
+            if step["cut"] is not None and step["cut"].photon_dependent and not results[0]:
+                results.append(None)
+                continue
+            step_start = time.time()
+            if step["cut"] is None:
+                results.append(self._event.photon(region["photon"]) >= 0)
+            else:
+                results.append(bool(self._event.evaluate(step["cut"], region["photon"])))
+            step["seconds"] += time.time() - step_start
+            step["evaluations"] += 1
+        weight = 0. # No photon candidate, for a photon-dependent weight (see count_cutflow())
+        if results[0] or not region["weight"].photon_dependent:
+            weight = self._event.evaluate(region["weight"], region["photon"])
+        region["warmup"].append((results, weight))
+        if len(region["warmup"]) >= self._adaptive_warmup_events:
+            self.adapt_cut_order(region)
+        return all(results)
+
+    # adapt_cut_order(): at the end of the warm-up, order the steps of a region by increasing cost per rejection, and count the warm-up events in the cutflow
+    # - Greedy: the next step is the one with the lowest (mean time) / (fraction of events rejected), among the warm-up events passing the steps chosen so far.
+    #   Photon-dependent cuts stay after the photon candidate. Steps rejecting no warm-up event keep their order, at the end.
+    # - The order is saved to the cut order file, if there is one, once all regions are done.
+    def adapt_cut_order(self, region):
+        steps = region["steps"]
+        costs = [step["seconds"] / max(step["evaluations"], 1) for step in steps]
+        warmup = region["warmup"]
+        events = [results for results, weight in warmup]
+        order = []
+        remaining = range(len(steps))
+        while remaining:
+            def cost_per_rejection(i_step):
+                rejected = sum(1 for results in events if results[i_step] is False)
+                return (costs[i_step] * len(events) / rejected if rejected else float("inf"), i_step)
+            available = [i_step for i_step in remaining if 0 in order or not (steps[i_step]["cut"] and steps[i_step]["cut"].photon_dependent)]
+            i_next = min(available, key=cost_per_rejection)
+            order.append(i_next)
+            remaining.remove(i_next)
+            events = [results for results in events if results[i_next]]
+        region["warmup"] = None
+        self.set_cut_order(region, order)
+        print "[MonoPhotonHistogrammer::adapt_cut_order] INFO : Region {} ({} warm-up events): {}".format(region["name"], len(warmup), " -> ".join("{} ({:.1f} us)".format(steps[i_step]["label"], 1.e6 * costs[i_step]) for i_step in order))
+
+        for results, weight in warmup:
+            n_passed = 0
+            while n_passed < len(order) and results[order[n_passed]]:
+                n_passed += 1
+            if n_passed <= region["photon_position"] and region["weight"].photon_dependent:
+                weight = 0. # See count_cutflow()
+            self.count_cutflow(region, n_passed, weight)
+
+        if self._cut_order_path and all(other_region["warmup"] is None for other_region in self._regions):
+            cut_orders = dict((other_region["name"], [step["label"] for step in other_region["ordered_steps"]]) for other_region in self._regions)
+            tmp_path = "{}.tmp{}".format(self._cut_order_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(cut_orders, f, indent=1, sort_keys=True)
+            os.rename(tmp_path, self._cut_order_path)
+            print "[MonoPhotonHistogrammer::adapt_cut_order] INFO : Wrote the cut orders to {}".format(self._cut_order_path)
+
+    # set_cut_order(): evaluate the steps of a region in the given order (step indices), and label its cutflow histograms accordingly
+    def set_cut_order(self, region, order):
+        region["order"] = order
+        region["ordered_steps"] = [region["steps"][i_step] for i_step in order]
+        region["photon_position"] = order.index(0)
+        region["prefilter_steps"] = []
+        for step in region["ordered_steps"]:
+            if step["cut"] is None or not self.is_prefilter_expression(step["cut"]):
+                break
+            region["prefilter_steps"].append(region["steps"].index(step))
+        if region["name"] in self._histograms:
+            for name in ["cutflow", "cutflow_weighted"]:
+                for i, step in enumerate(region["ordered_steps"]):
+                    self._histograms[region["name"]][name].GetXaxis().SetBinLabel(i + 2, step["label"])
+
+    # load_cut_orders(): set the cut orders of the regions from the cut order file (written by adapt_cut_order()). Regions missing from the file, or whose cuts changed, are left to the warm-up.
+    def load_cut_orders(self):
+        with open(self._cut_order_path, 'r') as f:
+            cut_orders = json.load(f)
+        for region in self._regions:
+            step_indices = dict((step["label"], i_step) for i_step, step in enumerate(region["steps"]))
+            labels = cut_orders.get(region["name"])
+            if labels is None or sorted(labels) != sorted(step_indices):
+                print "[MonoPhotonHistogrammer::load_cut_orders] WARNING : No cut order for region {} in {}".format(region["name"], self._cut_order_path)
+                continue
+            self.set_cut_order(region, [step_indices[label] for label in labels])
+            region["warmup"] = None
+        print "[MonoPhotonHistogrammer::load_cut_orders] INFO : Loaded the cut orders from {}".format(self._cut_order_path)
+
+    # run_columnar(): alternative to run(), which reads the input files in chunks of entries as NumPy arrays, and evaluates the selections as vectorized masks.
+    # - Fills the same histograms as run(), so the two can be cross-checked.
+    # - cache_dir: read the input files from the columnar cache (see columnar_cache.py and write_columnar_cache()) instead of ROOT. Files missing from the cache are read from ROOT.
+    def run_columnar(self, max_events=-1, chunk_size=100000, cache_dir=None):
+        print "[MonoPhotonHistogrammer::run_columnar] INFO : In run_columnar()."
+
+        if cache_dir:
+            reader = CachedChunkReader(self._input_files, cache_dir, tree_name=self._tree_name)
+        else:
+            reader = RootChunkReader(self._input_files, tree_name=self._tree_name)
 
-            # Trigger selections, for computing trigger efficiency
-            if self.pass_backup_triggers() and self._data.pfMET > 140. and i_ph_sr >= 0:
-                self.fill_histograms("trigger_denominator", i_ph_sr, event_weight=1.)
+        # Metrics: the chunks don't follow the input file boundaries, so the whole run is one record
+        metrics = self._metrics
+        phases = metrics.phases
+        metrics.start_file("{} input files ({})".format(len(self._input_files), "columnar cache" if cache_dir else "columnar"), TFile.GetFileBytesRead())
 
-            if self.pass_backup_triggers() and self._data.pfMET > 140. and i_ph_sr >= 0 and self.pass_signal_triggers():
-                self.fill_histograms("trigger_numerator", i_ph_sr, event_weight=1.)
+        self.start_timer()
+        chunks = reader.iterate(self.analysis_branches, chunk_size=chunk_size, max_events=max_events)
+        while True:
+            io_start = time.time()
+            try:
+                chunk_start, chunk_stop, events = next(chunks)
+            except StopIteration:
+                break
+            phases["io"] += time.time() - io_start
+            print "[MonoPhotonHistogrammer::run_columnar] INFO : Processing events {} - {}".format(chunk_start + 1, chunk_stop)
+            self._events_processed += chunk_stop - chunk_start
+            metrics.count_event(chunk_stop - chunk_start)
+            selection_start = time.time()
+            events["phoIDWord"] = self.columnar_photon_id_words(events)
+            chunk = ChunkContext(self, events)
+            phases["selection"] += time.time() - selection_start
+
+            for region in self._regions:
+                selection_start = time.time()
+                region_mask = self.columnar_pass_region(chunk, region)
+                fill_start = time.time()
+                metrics.selections[region["name"]] = metrics.selections.get(region["name"], 0.) + fill_start - selection_start
+                phases["selection"] += fill_start - selection_start
+                self.fill_histograms_columnar(region, chunk, region_mask)
+                if region["varied"]:
+                    self.fill_histograms_columnar_variations(region, chunk, self.columnar_pass_region_variations(chunk, region))
+
+                if self._trigger_turnons and region["name"] == "trigger_denominator":
+                    for hlt, photon_pt, pfmet in zip(events["HLTPho"][region_mask], chunk.photon_variable("photon_pt", region["photon"])[region_mask], events["pfMET"][region_mask]):
+                        self.fill_trigger_turnons(int(hlt), photon_pt, pfmet)
+                phases["fill"] += time.time() - fill_start
+        metrics.end_file(TFile.GetFileBytesRead())
 
-        # Print performance
         elapsed_time = time.time() - self._ts_start
-        print "[MonoPhotonHistogrammer::run] INFO : Done processing events. Processed {} events in {:.2f}s = {:.2f} Hz".format(self._events_processed, elapsed_time, self._events_processed / elapsed_time)
+        print "[MonoPhotonHistogrammer::run_columnar] INFO : Done processing events. Processed {} events in {:.2f}s = {:.2f} Hz".format(self._events_processed, elapsed_time, self._events_processed / elapsed_time)
+
+        print "[MonoPhotonHistogrammer::run_columnar] INFO : Done with run_columnar()."
+
+    # write_columnar_cache(): convert the analysis branches of the input files into the columnar cache, for run_columnar(cache_dir=...). Files with an up-to-date cache entry are skipped.
+    # - float32: store floating point branches as float32 (see columnar_cache.py)
+    def write_columnar_cache(self, cache_dir, float32=False):
+        for input_file in self._input_files:
+            if load_cache_meta(cache_dir, input_file, self.analysis_branches):
+                print "[MonoPhotonHistogrammer::write_columnar_cache] INFO : {} is already in the columnar cache".format(input_file)
+                continue
+            convert_file(cache_dir, input_file, self.analysis_branches, tree_name=self._tree_name, float32=float32)
+
+    # columnar_pass_region(): vectorized pass_region(), as a mask over the events of the chunk. All steps are evaluated on all events, and counted in the cutflow in the order of the region.
+    def columnar_pass_region(self, chunk, region):
+        region_mask = np.ones(chunk.n_events, dtype=bool)
+        steps_passed = np.zeros(chunk.n_events, dtype=np.int64)
+        for step in region["ordered_steps"]:
+            if step["cut"] is None:
+                region_mask = region_mask & (chunk.photon(region["photon"]) >= 0)
+            else:
+                region_mask = region_mask & np.broadcast_to(chunk.evaluate(step["cut"], region["photon"]), region_mask.shape)
+            steps_passed += region_mask
+        self.count_cutflow_columnar(region, chunk, steps_passed)
+        return region_mask
+
+    # columnar_pass_region_variations(): vectorized pass_region_variations(), as a mask of shape (variations, events)
+    def columnar_pass_region_variations(self, chunk, region):
+        variations_mask = np.broadcast_to(chunk.photon(region["photon"]) >= 0, (len(self._variations), chunk.n_events))
+        for step in region["ordered_steps"]:
+            if step["cut"] is not None:
+                variations_mask = variations_mask & np.broadcast_to(chunk.evaluate_variations(step["cut"], region["photon"]), variations_mask.shape)
+        return variations_mask
+
+    # count_cutflow_columnar(): count_cutflow() for the events of a chunk, given the number of steps each one passed
+    def count_cutflow_columnar(self, region, chunk, steps_passed):
+        weights = np.broadcast_to(np.asarray(chunk.evaluate(region["weight"], region["photon"]), dtype=np.float64), steps_passed.shape)
+        if region["weight"].photon_dependent:
+            weights = np.where(steps_passed > region["photon_position"], weights, 0.)
+        n_bins = len(region["steps"]) + 1
+        for exits, counts in zip(region["cutflow_exits"], [np.bincount(steps_passed, minlength=n_bins), np.bincount(steps_passed, weights=weights, minlength=n_bins), np.bincount(steps_passed, weights=weights * weights, minlength=n_bins)]):
+            for n_passed in xrange(n_bins):
+                exits[n_passed] += counts[n_passed]
+
+    # skim(): instead of filling histograms, write the events passing any region of the spec to a reduced ggNtuplizer/EventTree
+    # - Only the branches read by the analysis are kept (see activate_branches()). Call after start(), which compiles the spec.
+    # - To keep some room for changing thresholds later, skim with a spec with looser parameters than the final selection. Events passing a parameter variation (see set_variations()) are kept too.
+    # - The number of events processed (including the ones removed by earlier skims) is stored in ggNtuplizer/skim_events_processed, for the normalization of MC. hEvents is copied if given.
+    # - compression: ROOT compression setting, 100 * algorithm + level (e.g. 101 = zlib level 1, 207 = LZMA level 7, 404 = LZ4 level 4)
+    def skim(self, output_path, max_events=-1, hEvents=None, compression=404):
+        print "[MonoPhotonHistogrammer::skim] INFO : In skim()."
+        self.activate_branches()
+
+        output_file = TFile(output_path, "RECREATE", "", compression)
+        output_directory = output_file.mkdir("ggNtuplizer")
+        output_directory.cd()
+        skim_tree = self._data.CloneTree(0) # Only the active branches are cloned
+
+        limit_nevents, entries = self.entries_to_process(max_events)
+        print_every = int(math.ceil(1. * limit_nevents / 20))
 
-        print "[MonoPhotonHistogrammer::run] INFO : Done with run()."
+        self.start_timer()
+        for i, entry in enumerate(entries):
+            self.print_progress(i, 0, limit_nevents, print_every)
+            self._data.GetEntry(entry)
+            self._events_processed += 1
+            self._event = EventContext(self)
+            for region in self._regions:
+                if self.pass_region(region) or (region["varied"] and self.pass_region_variations(region) is not None):
+                    skim_tree.Fill()
+                    break
 
+        elapsed_time = time.time() - self._ts_start
+        print "[MonoPhotonHistogrammer::skim] INFO : Kept {} / {} events in {:.2f}s = {:.2f} Hz".format(skim_tree.GetEntries(), self._events_processed, elapsed_time, self._events_processed / elapsed_time)
+
+        output_directory.cd()
+        skim_tree.Write()
+        if hEvents:
+            hEvents.Write("hEvents")
+        h_skim_events_processed = TH1D("skim_events_processed", "skim_events_processed", 1, 0.5, 1.5)
+        h_skim_events_processed.SetBinContent(1, self._events_processed + self._events_removed_by_skim)
+        h_skim_events_processed.Write()
+        output_file.Close()
+        print "[MonoPhotonHistogrammer::skim] INFO : Wrote skim to {}".format(output_path)
+        print "[MonoPhotonHistogrammer::skim] INFO : Done with skim()."
 
     # finish(): saves the histograms to the output file.
     def finish(self):
@@ -148,277 +1115,291 @@ class MonoPhotonHistogrammer:
         if not self._output_path:
             self._output_path = "output_{}.root".format(time.time())
             print "[MonoPhotonHistogrammer::finish] WARNING : No output path specified! Saving to {}".format(self._output_path)
+        write_start = time.time()
         output_file = TFile(self._output_path, "RECREATE")
-        for selection in self._selections:
-            for histogram in sorted(self._histograms[selection].values(), key=lambda x: x.GetName()):
-                histogram.Write()
+        for histogram in self.output_histograms():
+            histogram.Write()
 
         # Also write a histogram containing the number of events processed
         h_nevents_processed = TH1D("events_processed", "events_processed", 1, 0.5, 1.5)
-        h_nevents_processed.SetBinContent(1, self._events_processed)
+        h_nevents_processed.SetBinContent(1, self.total_events_processed())
         h_nevents_processed.Write()
 
         output_file.Close()
+        self._metrics.phases["write"] += time.time() - write_start
+        self.write_metrics(metrics_path(self._output_path))
 
-        print "[MonoPhotonHistogrammer::finish] INFO : Done with finish()."
+        # The output is complete, so the checkpoint is not needed anymore
+        if self._checkpoint_path and os.path.isfile(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
 
-    def fill_histograms(self, selection, photon_index, event_weight=1.):
-        self._histograms[selection]["events_passed"].Fill(1)
-        self._histograms[selection]["events_passed_weighted"].Fill(1, event_weight)
-        self._histograms[selection]["photon_pt"].Fill(self._data.phoEt[photon_index], event_weight)
-        self._histograms[selection]["photon_eta"].Fill(self._data.phoEta[photon_index], event_weight)
-        self._histograms[selection]["photon_SCeta"].Fill(self._data.phoSCEta[photon_index], event_weight)
-        self._histograms[selection]["photon_phi"].Fill(self._data.phoPhi[photon_index], event_weight)
-        self._histograms[selection]["photon_SCphi"].Fill(self._data.phoSCPhi[photon_index], event_weight)
-        self._histograms[selection]["pfmet"].Fill(self._data.pfMET, event_weight)
-        self._histograms[selection]["dphi_photon_met"].Fill(math.acos(math.cos(self._data.phoPhi[photon_index] - self._data.pfMETPhi)), event_weight) # acos(cos(delta_phi)) is a trick to map delta_phi onto the interval [0, pi]. Think 2*pi==0 for opening angles.
-        self._histograms[selection]["njets"].Fill(self._data.nJet, event_weight)
-        self._histograms[selection]["leading_jet_pt"].Fill(self._data.jetPt[0], event_weight)
-        self._histograms[selection]["leading_jet_eta"].Fill(self._data.jetEta[0], event_weight)
+        print "[MonoPhotonHistogrammer::finish] INFO : Done with finish()."
 
+    # write_metrics(): write the performance metrics of the run (see metrics.py) to a JSON file
+    def write_metrics(self, path):
+        self._metrics.write(path)
+        print "[MonoPhotonHistogrammer::write_metrics] INFO : Wrote metrics to {}".format(path)
+
+    # output_histograms(): the histograms written by finish(), in the order they are written. Flushes the fill buffers and the cutflows first.
+    def output_histograms(self):
+        flush_fill_buffers(self._fill_buffers)
+        self.flush_cutflows()
+        return [histogram for selection in self._selections for histogram in sorted(self._histograms[selection].values(), key=lambda x: x.GetName())]
+
+    # total_events_processed(): content of the events_processed histogram, i.e. the events processed plus the events removed by the skim (see add_skim_normalization())
+    def total_events_processed(self):
+        return self._events_processed + self._events_removed_by_skim
+
+    # flush_cutflows(): add the cutflow counts of the regions (events by number of steps passed) to the cutflow histograms, and reset the counts
+    # - A warm-up of the adaptive cut ordering that is still going on is ended first, if it has events (see adapt_cut_order()). With end_warmup=False (checkpoints), it goes on,
+    #   and its events are left out of the cutflows until it ends.
+    # - The weighted cutflows of regions with a photon-dependent weight are only filled from the photon candidate step on (see count_cutflow())
+    def flush_cutflows(self, end_warmup=True):
+        for region in self._regions:
+            if region["warmup"] and end_warmup:
+                self.adapt_cut_order(region)
+            counts, weights, weights2 = region["cutflow_exits"]
+            for name, contents, sumw2 in [("cutflow", counts, counts), ("cutflow_weighted", weights, weights2)]:
+                cutflow = self._histograms[region["name"]][name]
+                entries = cutflow.GetEntries()
+                first_step = region["photon_position"] + 1 if name == "cutflow_weighted" and region["weight"].photon_dependent else 0
+                # Bin k + 1: events passing at least k steps
+                for k in xrange(first_step, len(contents)):
+                    cutflow.SetBinContent(k + 1, cutflow.GetBinContent(k + 1) + sum(contents[k:]))
+                    cutflow.GetSumw2().SetAt(cutflow.GetSumw2().At(k + 1) + sum(sumw2[k:]), k + 1)
+                cutflow.SetEntries(entries + sum((k + 1) * count for k, count in enumerate(counts)))
+            region["cutflow_flushed"] = [[flushed + current for flushed, current in zip(flushed_values, current_values)] for flushed_values, current_values in zip(region["cutflow_flushed"], region["cutflow_exits"])]
+            region["cutflow_exits"] = [[0] * len(counts), [0.] * len(counts), [0.] * len(counts)]
+
+    # fill_histograms(): fill the spec histograms of a region, for the current event
+    def fill_histograms(self, region, event_weight=1.):
+        buffers = self._fill_buffers[region["name"]]
+        for histogram in self._histogram_specs:
+            if histogram["require"] and not self._event.evaluate(histogram["require"], region["photon"]):
+                continue
+            buffers[histogram["name"]].fill(self._event.evaluate(histogram["variable"], region["photon"]), event_weight if histogram["weighted"] else 1.)
+
+    # fill_histograms_columnar(): same as fill_histograms(), for the events of a chunk passing region_mask
+    def fill_histograms_columnar(self, region, chunk, region_mask):
+        if not np.any(region_mask):
+            return
+        weights = np.broadcast_to(np.asarray(chunk.evaluate(region["weight"], region["photon"]), dtype=np.float64), region_mask.shape)
+        buffers = self._fill_buffers[region["name"]]
+        for histogram in self._histogram_specs:
+            fill_mask = region_mask
+            if histogram["require"]:
+                fill_mask = fill_mask & np.broadcast_to(chunk.evaluate(histogram["require"], region["photon"]), region_mask.shape)
+            values = np.broadcast_to(chunk.evaluate(histogram["variable"], region["photon"]), region_mask.shape)[fill_mask]
+            buffers[histogram["name"]].fill_array(values, weights[fill_mask] if histogram["weighted"] else 1.)
+
+    # fill_histograms_variations(): fill the variation histograms of a region, for the parameter variations passed by the current event (see pass_region_variations()), with the weight of each variation
+    def fill_histograms_variations(self, region, variations_passed):
+        weights = np.broadcast_to(self._event.evaluate_variations(region["weight"], region["photon"]), variations_passed.shape)
+        buffers = self._fill_buffers[region["name"]]
+        for histogram in self._histogram_specs:
+            fill_mask = variations_passed
+            if histogram["require"]:
+                fill_mask = fill_mask & np.broadcast_to(self._event.evaluate_variations(histogram["require"], region["photon"]), variations_passed.shape)
+            values = np.broadcast_to(self._event.evaluate_variations(histogram["variable"], region["photon"]), variations_passed.shape)
+            for i_variation in np.flatnonzero(fill_mask):
+                buffers[histogram["variation_names"][i_variation]].fill(values[i_variation], weights[i_variation] if histogram["weighted"] else 1.)
+
+    # fill_histograms_columnar_variations(): same as fill_histograms_variations(), for the events of a chunk. variations_mask: (variations, events), see columnar_pass_region_variations().
+    def fill_histograms_columnar_variations(self, region, chunk, variations_mask):
+        if not np.any(variations_mask):
+            return
+        weights = np.broadcast_to(np.asarray(chunk.evaluate_variations(region["weight"], region["photon"]), dtype=np.float64), variations_mask.shape)
+        buffers = self._fill_buffers[region["name"]]
+        for histogram in self._histogram_specs:
+            fill_mask = variations_mask
+            if histogram["require"]:
+                fill_mask = fill_mask & np.broadcast_to(chunk.evaluate_variations(histogram["require"], region["photon"]), variations_mask.shape)
+            values = np.broadcast_to(chunk.evaluate_variations(histogram["variable"], region["photon"]), variations_mask.shape)
+            for i_variation, name in enumerate(histogram["variation_names"]):
+                buffers[name].fill_array(values[i_variation][fill_mask[i_variation]], weights[i_variation][fill_mask[i_variation]] if histogram["weighted"] else 1.)
+
+    # fill_trigger_turnons(): for an event in the trigger_denominator selection, fill the denominator and the numerator of every photon trigger it passed
+    def fill_trigger_turnons(self, hlt, photon_pt, pfmet):
+        buffers = self._fill_buffers["trigger_turnon"]
+        buffers["denominator_photon_pt"].fill(photon_pt)
+        buffers["denominator_pfmet"].fill(pfmet)
+        for name, mask in self._turnon_triggers:
+            if hlt & mask:
+                buffers["{}_photon_pt".format(name)].fill(photon_pt)
+                buffers["{}_pfmet".format(name)].fill(pfmet)
+
+    ####################
+    ### Spec helpers ###
+    ####################
+    # compile_expression(): compile a spec expression, reusing the compiled expression if it is already used elsewhere in the spec
+    def compile_expression(self, expression):
+        expression = str(expression)
+        if not expression in self._compiled_expressions:
+            self._compiled_expressions[expression] = CompiledExpression(expression)
+        return self._compiled_expressions[expression]
+
+    # compile_region(): a spec region, as the steps of its cutflow
+    # - "steps": [{"label", "cut"}]: the photon candidate (cut None), then the cuts in spec order.
+    # - "order": order in which pass_region() evaluates the steps (step indices), which is also the order of the cutflow. The order of the steps, unless set by the adaptive cut ordering
+    #   (see set_adaptive_cut_order()). The cuts are ANDed, so the order doesn't change the selection.
+    # - "cutflow_exits": events, sum of weights and sum of squared weights, by number of steps passed (added to the cutflow histograms by flush_cutflows())
+    # - "bit": bit of the region in the passed bits of process_event() (set by start())
+    # - "constant_weight": the weight, if it only depends on the parameters (otherwise None)
+    # - "prefilter_steps": the cuts on pre-filter variables only at the start of the order (step indices), which can skip entries with the scalar pre-filter (see set_prefilter())
+    def compile_region(self, region):
+        steps = [{"label": "photon candidate ({})".format(region["photon"]), "cut": None}]
+        steps.extend({"label": cut.expression, "cut": cut} for cut in [self.compile_expression(cut) for cut in region.get("cuts", [])])
+        for step in steps:
+            step["seconds"], step["evaluations"] = 0., 0 # Adaptive cut ordering warm-up
+        weight = self.compile_expression(region.get("weight", "1."))
+        compiled_region = {
+            "name": region["name"],
+            "photon": region["photon"],
+            "steps": steps,
+            "weight": weight,
+            "constant_weight": None if set(weight.code.co_names) - set(self._parameters) else float(weight.evaluate(dict(self._parameters))),
+            "cutflow_exits": [[0] * (len(steps) + 1), [0.] * (len(steps) + 1), [0.] * (len(steps) + 1)],
+            "cutflow_flushed": [[0] * (len(steps) + 1), [0.] * (len(steps) + 1), [0.] * (len(steps) + 1)], # Already added to the histograms, for cutflow_totals()
+            "warmup": [] if self._adaptive_warmup_events > 0 else None, # [(step results, weight)] of the warm-up events
+        }
+        self.set_cut_order(compiled_region, range(len(steps)))
+        return compiled_region
+
+    # is_prefilter_expression(): the expression only uses pre-filter variables and parameters (see set_prefilter())
+    def is_prefilter_expression(self, expression):
+        return set(expression.code.co_names) <= set(self.prefilter_variables) | set(self._parameters)
+
+    # compile_photon_candidate(): (required bits, vetoed bits, "first" or "last") for a spec photon candidate
+    def compile_photon_candidate(self, photon):
+        if isinstance(photon["id"], dict):
+            required = photon_id_mask(*[getattr(PhotonIDBits, bit) for bit in photon["id"].get("require", [])])
+            vetoed = photon_id_mask(*[getattr(PhotonIDBits, bit) for bit in photon["id"].get("veto", [])])
+        else:
+            required, vetoed = photon_selections[photon["id"]]
+        choose = photon.get("choose", "first")
+        if not choose in ["first", "last"]:
+            raise ValueError("[MonoPhotonHistogrammer::compile_photon_candidate] ERROR : choose must be first or last, not {}".format(choose))
+        return required, vetoed, choose
 
     #########################
     ### Selection helpers ###
     #########################
+    # Trigger groups: single AND of HLTPho with the precompiled masks from photon_triggers.py
     def pass_signal_triggers(self):
-        return (
-            self.photonTriggerResult(PhotonTriggers.kHLT_Photon175) 
-            or self.photonTriggerResult(PhotonTriggers.kHLT_Photon250_NoHE) 
-            or self.photonTriggerResult(PhotonTriggers.kHLT_Photon300_NoHE) 
-            or self.photonTriggerResult(PhotonTriggers.kHLT_Photon500) 
-            or self.photonTriggerResult(PhotonTriggers.kHLT_Photon600) 
-            or self.photonTriggerResult(PhotonTriggers.kHLT_Photon165_HE10)
-            or self.photonTriggerResult(PhotonTriggers.kHLT_DoublePhoton60)
-        )
+        return (self._data.HLTPho & signal_trigger_mask) != 0
 
     def pass_backup_triggers(self):
-        return (
-            self.photonTriggerResult(PhotonTriggers.kHLT_Photon75)
-            or self.photonTriggerResult(PhotonTriggers.kHLT_Photon90) 
-            or self.photonTriggerResult(PhotonTriggers.kHLT_Photon120)
+        return (self._data.HLTPho & backup_trigger_mask) != 0
+
+    ##################################
+    ### Columnar selection helpers ###
+    ##################################
+    # Vectorized versions of the selection helpers above, evaluated on a chunk of events from RootChunkReader.
+    def columnar_signal_triggers(self, events):
+        return (events["HLTPho"] & signal_trigger_mask) != 0
+
+    def columnar_backup_triggers(self, events):
+        return (events["HLTPho"] & backup_trigger_mask) != 0
+
+    # columnar_photon_id_words(): ID words of all photons of the chunk, as a jagged array (see photon_id.py)
+    def columnar_photon_id_words(self, events):
+        photons = events["phoEt"]
+        return photons.with_content(photon_id_words(
+            photons.content,
+            events["phoSCEta"].content,
+            events["phoHoverE"].content,
+            events["phoSigmaIEtaIEtaFull5x5"].content,
+            events["phohasPixelSeed"].content,
+            events["phoPFChIso"].content,
+            events["phoPFNeuIso"].content,
+            events["phoPFPhoIso"].content,
+            photons.broadcast(events["rho"])
+        ))
+
+    def columnar_electron_id_loose(self, events):
+        abs_eta = np.abs(events["eleSCEta"].content)
+        rho = events["elePt"].broadcast(events["rho"])
+        EA = np.array([0.1752, 0.1862, 0.1411, 0.1534, 0.1903, 0.2243, 0.2687, 0.])[np.searchsorted([1.0, 1.479, 2.0, 2.2, 2.3, 2.4, 2.5], abs_eta, side="left")]
+        EAcorrIso = (events["elePFChIso"].content + np.maximum(0., events["elePFNeuIso"].content + events["elePFPhoIso"].content - rho * EA)) / events["elePt"].content
+
+        barrel = abs_eta <= 1.479
+        endcap = (abs_eta > 1.479) & (abs_eta < 2.5)
+        def cut(barrel_pass, endcap_pass):
+            return (barrel & barrel_pass) | (endcap & endcap_pass)
+
+        sieie = events["eleSigmaIEtaIEtaFull5x5"].content
+        deta = np.abs(events["eledEtaAtVtx"].content)
+        dphi = np.abs(events["eledPhiAtVtx"].content)
+        hovere = events["eleHoverE"].content
+        ooemoop = events["eleEoverPInv"].content
+        d0 = np.abs(events["eleD0"].content)
+        dz = np.abs(events["eleDz"].content)
+        return cut(sieie < 0.0103, sieie < 0.0301) \
+            & cut(deta < 0.0105, deta < 0.00814) \
+            & cut(dphi < 0.115, dphi < 0.182) \
+            & cut(hovere < 0.104, hovere < 0.0897) \
+            & cut(EAcorrIso < 0.0893, EAcorrIso < 0.121) \
+            & cut(ooemoop < 0.102, ooemoop < 0.126) \
+            & cut(d0 < 0.0261, d0 < 0.118) \
+            & cut(dz < 0.41, dz < 0.822)
+
+    def columnar_muon_id_loose(self, events):
+        return (events["muIsPFMuon"].content != 0) \
+            & ((events["muIsGlobalMuon"].content != 0) | (events["muIsTrackerMuon"].content != 0))
+
+    # photon_id_word(): ID word of photon i, with one bit per ID criterion (see photon_id.py)
+    def photon_id_word(self, i):
+        return photon_id_word(
+            self._data.phoEt[i],
+            self._data.phoSCEta[i],
+            self._data.phoHoverE[i],
+            self._data.phoSigmaIEtaIEtaFull5x5[i],
+            self._data.phohasPixelSeed[i],
+            self._data.phoPFChIso[i],
+            self._data.phoPFNeuIso[i],
+            self._data.phoPFPhoIso[i],
+            self._data.rho
         )
 
-    # Signal region selection
-    # - Returns (pass/fail, selected photon index)
-    def pass_selection_SR(self):
-        # Choose the photon of interest for the signal region.
-        # The photons in the ntuple are ordered by pT, so the following logic selects the highest-pT photon satisfying the |eta| and ID requirements.
-        i_ph_sr = -1
-        for i in xrange(self._data.nPho):
-            if abs(self._data.phoSCEta[i]) < 1.4442 and self.photon_id(i):
-                i_ph_sr = i
-                break
-        if i_ph_sr == -1:
-            return False, -1
-
-        # Number of loose electrons, for electron veto
-        n_electrons = 0
-        for i in xrange(self._data.nEle):
-            dR_el_ph = math.sqrt((self._data.eleEta[i] - self._data.phoEta[i_ph_sr])**2 + (math.acos(math.cos(self._data.elePhi[i] - self._data.phoPhi[i_ph_sr])))**2)
-            if self.electron_id_loose(i) and self._data.elePt[i] > 10. and dR_el_ph > 0.5:
-                n_electrons += 1
-
-        # Number of loose muons, for muon veto
-        n_muons = 0
-        for i in xrange(self._data.nMu):
-            dR_mu_ph = math.sqrt((self._data.muEta[i] - self._data.phoEta[i_ph_sr])**2 + (math.acos(math.cos(self._data.muPhi[i] - self._data.phoPhi[i_ph_sr])))**2)
-            if self.muon_id_loose(i) and self._data.muPt[i] > 10. and dR_mu_ph > 0.5:
-                n_muons += 1
-
-        # Require MET away from leading 4 jets
-        pass_dphi_jet_MET = True
-        for i in xrange(min(4, self._data.nJet)):
-            if math.acos(math.cos(self._data.jetPhi[i] - self._data.pfMETPhi)) < 0.5 and self._data.jetPt[i] > 30.:
-                pass_dphi_jet_MET = False
-                break
-
-        return (
-            self.pass_signal_triggers()
-            and (self._data.metFilters == 0)
-            and (self._data.phoEt[i_ph_sr] > 175.)
-            and (self._data.pfMET > 170.)
-            and math.acos(math.cos(self._data.phoPhi[i_ph_sr] - self._data.pfMETPhi)) > 2.
-            and n_electrons == 0
-            and n_muons == 0
-            and pass_dphi_jet_MET
-        ), i_ph_sr
-
-    def pass_selection_CR_electronfakes(self):
-        i_ph_electronfakes = -1
-        for i in xrange(self._data.nPho):
-            if abs(self._data.phoSCEta[i]) < 1.4442 and self.photon_id_electrondenominator(i):
-                i_ph_electronfakes = i
-        if i_ph_electronfakes == -1:
-            return False, -1
-
-        # Number of loose electrons, for electron veto
-        n_electrons = 0
-        for i in xrange(self._data.nEle):
-            dR_el_ph = math.sqrt((self._data.eleEta[i] - self._data.phoEta[i_ph_electronfakes])**2 + (math.acos(math.cos(self._data.elePhi[i] - self._data.phoPhi[i_ph_electronfakes])))**2)
-            if self.electron_id_loose(i) and self._data.elePt[i] > 10. and dR_el_ph > 0.5:
-                n_electrons += 1
-
-        # Number of loose muons, for muon veto
-        n_muons = 0
-        for i in xrange(self._data.nMu):
-            dR_mu_ph = math.sqrt((self._data.muEta[i] - self._data.phoEta[i_ph_electronfakes])**2 + (math.acos(math.cos(self._data.muPhi[i] - self._data.phoPhi[i_ph_electronfakes])))**2)
-            if self.muon_id_loose(i) and self._data.muPt[i] > 10. and dR_mu_ph > 0.5:
-                n_muons += 1
-
-        # Require MET away from leading 4 jets
-        pass_dphi_jet_MET = True
-        for i in xrange(min(4, self._data.nJet)):
-            if math.acos(math.cos(self._data.jetPhi[i] - self._data.pfMETPhi)) < 0.5 and self._data.jetPt[i] > 30.:
-                pass_dphi_jet_MET = False
-                break
-
-        return (
-            self.pass_signal_triggers()
-            and (self._data.metFilters == 0)
-            and (self._data.phoEt[i_ph_electronfakes] > 175.)
-            and (self._data.pfMET > 170.)
-            and math.acos(math.cos(self._data.phoPhi[i_ph_electronfakes] - self._data.pfMETPhi)) > 2.
-            and n_electrons == 0
-            and n_muons == 0
-            and pass_dphi_jet_MET
-        ), i_ph_electronfakes
-
-    def pass_selection_CR_jetfakes(self):
-        i_ph_jetfakes = -1
-        for i in xrange(self._data.nPho):
-            if abs(self._data.phoSCEta[i]) < 1.4442 and self.photon_id_qcddenominator(i):
-                i_ph_jetfakes = i
-        if i_ph_jetfakes == -1:
-            return False, -1
-
-        # Number of loose electrons, for electron veto
-        n_electrons = 0
-        for i in xrange(self._data.nEle):
-            dR_el_ph = math.sqrt((self._data.eleEta[i] - self._data.phoEta[i_ph_jetfakes])**2 + (math.acos(math.cos(self._data.elePhi[i] - self._data.phoPhi[i_ph_jetfakes])))**2)
-            if self.electron_id_loose(i) and self._data.elePt[i] > 10. and dR_el_ph > 0.5:
-                n_electrons += 1
-
-        # Number of loose muons, for muon veto
-        n_muons = 0
-        for i in xrange(self._data.nMu):
-            dR_mu_ph = math.sqrt((self._data.muEta[i] - self._data.phoEta[i_ph_jetfakes])**2 + (math.acos(math.cos(self._data.muPhi[i] - self._data.phoPhi[i_ph_jetfakes])))**2)
-            if self.muon_id_loose(i) and self._data.muPt[i] > 10. and dR_mu_ph > 0.5:
-                n_muons += 1
-
-        # Require MET away from leading 4 jets
-        pass_dphi_jet_MET = True
-        for i in xrange(min(4, self._data.nJet)):
-            if math.acos(math.cos(self._data.jetPhi[i] - self._data.pfMETPhi)) < 0.5 and self._data.jetPt[i] > 30.:
-                pass_dphi_jet_MET = False
-                break
-
-        return (
-            self.pass_signal_triggers()
-            and (self._data.metFilters == 0)
-            and (self._data.phoEt[i_ph_jetfakes] > 175.)
-            and (self._data.pfMET > 170.)
-            and math.acos(math.cos(self._data.phoPhi[i_ph_jetfakes] - self._data.pfMETPhi)) > 2.
-            and n_electrons == 0
-            and n_muons == 0
-            and pass_dphi_jet_MET
-        ), i_ph_jetfakes
+    # pass_photon_id(): photon i passes the ID of the named photon selection (without the |eta| requirement)
+    def pass_photon_id(self, i, selection):
+        required, vetoed = photon_selections[selection]
+        return pass_photon_selection(self.photon_id_word(i), required & ~photon_id_mask(PhotonIDBits.kBarrel), vetoed)
 
     # Photon ID
     # Corresponds to "SPRING15 selection 25ns" / barrel / medium WP
     # https://twiki.cern.ch/twiki/bin/view/CMS/CutBasedPhotonIdentificationRun2Archive
     def photon_id(self, i):
-        return (self._data.phoHoverE[i] < 0.05) \
-            and (self._data.phoSigmaIEtaIEtaFull5x5[i] < 0.0102) \
-            and (self._data.phohasPixelSeed[i] == 0) \
-            and self.photon_medium_isolation(i)
+        return self.pass_photon_id(i, "nominal")
 
     # Photon ID for electron fake denominator (same as nominal, except phohasPixelSeed == 1)
     def photon_id_electrondenominator(self, i):
-        return (self._data.phoHoverE[i] < 0.05) \
-            and (self._data.phoSigmaIEtaIEtaFull5x5[i] < 0.0102) \
-            and (self._data.phohasPixelSeed[i] == 1) \
-            and self.photon_medium_isolation(i)
+        return self.pass_photon_id(i, "electrondenominator")
 
     # Photon ID for the QCD denominator (fail loose iso, pass very loose iso)
     def photon_id_qcddenominator(self, i):
-        return (self._data.phoHoverE[i] < 0.05) \
-            and (self._data.phoSigmaIEtaIEtaFull5x5[i] < 0.0102) \
-            and (self._data.phohasPixelSeed[i] == 0) \
-            and not self.photon_loose_isolation(i) \
-            and self.photon_veryloose_isolation(i)
+        return self.pass_photon_id(i, "qcddenominator")
 
     def photon_medium_isolation(self, i):
-        return (max(0., self._data.phoPFChIso[i]  - self._data.rho * self.EAcharged(self._data.phoSCEta[i])) < 1.37) \
-            and (max(0., self._data.phoPFNeuIso[i] - self._data.rho * self.EAneutral(self._data.phoSCEta[i])) < (1.06 + (0.014 * self._data.phoEt[i]) + (0.000019 * self._data.phoEt[i]**2))) \
-            and (max(0., self._data.phoPFPhoIso[i] - self._data.rho * self.EAphoton(self._data.phoSCEta[i])) < (0.28 + (0.0053 * self._data.phoEt[i])))
+        return self.photon_id_word(i) >> PhotonIDBits.kMediumIso & 1
 
     def photon_loose_isolation(self, i):
-        return (max(0., self._data.phoPFChIso[i]  - self._data.rho * self.EAcharged(self._data.phoSCEta[i])) < 3.32) \
-            and (max(0., self._data.phoPFNeuIso[i] - self._data.rho * self.EAneutral(self._data.phoSCEta[i])) < (1.92 + (0.014 * self._data.phoEt[i]) + (0.000019 * self._data.phoEt[i]**2))) \
-            and (max(0., self._data.phoPFPhoIso[i] - self._data.rho * self.EAphoton(self._data.phoSCEta[i])) < (0.81 + (0.0053 * self._data.phoEt[i])))
+        return self.photon_id_word(i) >> PhotonIDBits.kLooseIso & 1
 
     def photon_veryloose_isolation(self, i):
-        photon_Et = self._data.phoEt[i]
-        photon_eta = self._data.phoSCEta[i]
-        maxPFCharged= min(0.20 * photon_Et, 5.0*(3.32))
-        maxPFNeutral= min(0.20 * photon_Et, 5.0*(1.92 + (0.014 * photon_Et) + (0.000019 * photon_Et**2)))
-        maxPFPhoton = min(0.20 * photon_Et, 5.0*(0.81 + (0.0053 * photon_Et)))
-
-        return (max(0., self._data.phoPFChIso[i]  - self._data.rho * self.EAcharged(self._data.phoSCEta[i])) < maxPFCharged) \
-            and (max(0., self._data.phoPFNeuIso[i] - self._data.rho * self.EAneutral(self._data.phoSCEta[i])) < maxPFNeutral) \
-            and (max(0., self._data.phoPFPhoIso[i] - self._data.rho * self.EAphoton(self._data.phoSCEta[i])) < maxPFPhoton)
-
+        return self.photon_id_word(i) >> PhotonIDBits.kVeryLooseIso & 1
 
-    # Effective area to be needed in PF Iso for photon ID
+    # Effective area to be needed in PF Iso for photon ID (tables in photon_id.py)
     # https:#indico.cern.ch/event/455258/contribution/0/attachments/1173322/1695132/SP15_253rd.pdf -- slide-5
     def EAcharged(self, eta):
-        if (abs(eta) >= 0.0   and abs(eta) < 1.0):
-            return 0.0456
-        elif (abs(eta) >= 1.0   and abs(eta) < 1.479):
-            return 0.0500
-        elif (abs(eta) >= 1.479 and abs(eta) < 2.0):
-            return 0.0340
-        elif (abs(eta) >= 2.0   and abs(eta) < 2.2):
-            return 0.0383
-        elif (abs(eta) >= 2.2   and abs(eta) < 2.3):
-            return 0.0339
-        elif (abs(eta) >= 2.3   and abs(eta) < 2.4):
-            return 0.0303
-        else:
-            return 0.0240
+        return ea_charged[effective_area_bin(eta)]
 
     def EAneutral(self, eta):
-        if (abs(eta) >= 0.0   and abs(eta) < 1.0):
-            return 0.0599
-        elif (abs(eta) >= 1.0   and abs(eta) < 1.479):
-            return 0.0819
-        elif (abs(eta) >= 1.479 and abs(eta) < 2.0):
-            return 0.0696
-        elif (abs(eta) >= 2.0   and abs(eta) < 2.2):
-            return 0.0360
-        elif (abs(eta) >= 2.2   and abs(eta) < 2.3):
-            return 0.0360
-        elif (abs(eta) >= 2.3   and abs(eta) < 2.4):
-            return 0.0462
-        else:
-            return 0.0656
+        return ea_neutral[effective_area_bin(eta)]
 
     def EAphoton(self, eta):
-        if (abs(eta) >= 0.0   and abs(eta) < 1.0):
-            return 0.1271
-        elif (abs(eta) >= 1.0   and abs(eta) < 1.479):
-            return 0.1101
-        elif (abs(eta) >= 1.479 and abs(eta) < 2.0):
-            return 0.0756
-        elif (abs(eta) >= 2.0   and abs(eta) < 2.2):
-            return 0.1175
-        elif (abs(eta) >= 2.2   and abs(eta) < 2.3):
-            return 0.1498
-        elif (abs(eta) >= 2.3   and abs(eta) < 2.4):
-            return 0.1857
-        else:
-            return 0.2183
-         
+        return ea_photon[effective_area_bin(eta)]
+
     # photonTriggerResult(): returns True if the event passed the specified trigger.
     # See the definition of the PhotonTrigger enum above
     def photonTriggerResult(self, trigName):
@@ -487,8 +1468,232 @@ class MonoPhotonHistogrammer:
     #################
     
     # add_file(): add an input file to run over (see the TChain documentation).
+    # - The file can be restricted to an entry range, written as "<path>#<first entry>-<last entry>" (see job_splitter.py)
     def add_file(self, filename):
-        self._data.Add(filename)
+        path, first_entry, last_entry = split_entry_range(filename)
+        self._data.Add(path)
+        self._input_files.append(filename)
+        self._entry_ranges.append((first_entry, last_entry))
+
+    # entries_to_process(): (number of entries, iterable of TChain entry numbers) to run over, given the entry ranges of the input files and max_events
+    def entries_to_process(self, max_events=-1):
+        total_entries = self._data.GetEntries()
+        if all(first_entry == 0 and last_entry is None for first_entry, last_entry in self._entry_ranges):
+            chain_ranges = [(0, total_entries)]
+        else:
+            # Entry ranges are converted to TChain entry numbers with the tree offsets (TChain::GetEntries() has loaded all of them)
+            tree_offsets = self._data.GetTreeOffset()
+            chain_ranges = []
+            for i_tree, (first_entry, last_entry) in enumerate(self._entry_ranges):
+                tree_entries = tree_offsets[i_tree + 1] - tree_offsets[i_tree]
+                if last_entry is None or last_entry > tree_entries:
+                    last_entry = tree_entries
+                chain_ranges.append((tree_offsets[i_tree] + first_entry, tree_offsets[i_tree] + last_entry))
+
+        limit_nevents = 0
+        limited_ranges = []
+        for start, stop in chain_ranges:
+            if max_events > 0:
+                stop = min(stop, start + max_events - limit_nevents)
+            if stop > start:
+                limited_ranges.append((start, stop))
+                limit_nevents += stop - start
+        return limit_nevents, itertools.chain(*[xrange(start, stop) for start, stop in limited_ranges])
+
+    # staged_entries_to_process(): like entries_to_process(), for input files read through the staging area (see set_staging())
+    # - The files are read one at a time from their local copies: self._data is switched to a TChain of each local copy in turn, and its entry numbers are yielded.
+    #   The staging area copies the next files in the background meanwhile.
+    def staged_entries_to_process(self, max_events=-1):
+        chain = self._data
+        paths = [split_entry_range(input_file)[0] for input_file in self._input_files]
+        n_entries = 0
+        try:
+            for i_file, (path, local_path) in enumerate(self._staging.iterate(paths)):
+                first_entry, last_entry = self._entry_ranges[i_file]
+                self._data = TChain(self._tree_name)
+                self._data.Add(local_path)
+                self._data.SetBranchStatus("*", 0)
+                for branch in self._active_branches:
+                    self._data.SetBranchStatus(branch, 1)
+                tree_entries = self._data.GetEntries()
+                if last_entry is None or last_entry > tree_entries:
+                    last_entry = tree_entries
+                print "[MonoPhotonHistogrammer::staged_entries_to_process] INFO : File {} / {}: {} ({} entries)".format(i_file + 1, len(paths), path, last_entry - first_entry)
+                self._staged_file_index = i_file
+                for entry in xrange(first_entry, last_entry):
+                    if max_events > 0 and n_entries >= max_events:
+                        return
+                    n_entries += 1
+                    yield entry
+        finally:
+            self._data = chain
+
+    # checkpoint_key(): identifies what a checkpoint was made from (selection, input files and max_events). A checkpoint is only resumed by a run with the same key.
+    def checkpoint_key(self, max_events):
+        return hashlib.sha1("{}\n{}\n{}".format(self.selection_hash(), json.dumps(self._input_files), max_events)).hexdigest()
+
+    # write_checkpoint(): write the histograms, the number of events processed and the number of entries done to the checkpoint file (see set_checkpoint())
+    # - Written to a temporary file and renamed, so an interruption while writing leaves the previous checkpoint intact.
+    def write_checkpoint(self, checkpoint_key, n_entries_done):
+        self.flush_prefilter()
+        flush_fill_buffers(self._fill_buffers)
+        self.flush_cutflows(end_warmup=False)
+        tmp_path = "{}.tmp".format(self._checkpoint_path)
+        checkpoint_file = TFile(tmp_path, "RECREATE")
+        for selection in self._selections:
+            for histogram in self._histograms[selection].itervalues():
+                histogram.Write()
+        state = {"key": checkpoint_key, "entries_done": n_entries_done, "events_processed": self._events_processed}
+        TNamed("checkpoint_state", json.dumps(state)).Write()
+        checkpoint_file.Close()
+        os.rename(tmp_path, self._checkpoint_path)
+        print "[MonoPhotonHistogrammer::write_checkpoint] INFO : Checkpoint after {} events".format(self._events_processed)
+
+    # load_checkpoint(): restore the histograms and the number of events processed from the checkpoint file. Returns the number of entries done (0 if there is no usable checkpoint).
+    # - The histograms are added to the empty histograms booked by start(), which restores their contents, errors and statistics exactly.
+    def load_checkpoint(self, checkpoint_key):
+        if not os.path.isfile(self._checkpoint_path):
+            return 0
+        checkpoint_file = TFile(self._checkpoint_path, "READ")
+        state = json.loads(checkpoint_file.Get("checkpoint_state").GetTitle())
+        if state["key"] != checkpoint_key:
+            print "[MonoPhotonHistogrammer::load_checkpoint] WARNING : Checkpoint {} was made with a different selection, input files or max_events. Starting from the beginning.".format(self._checkpoint_path)
+            checkpoint_file.Close()
+            return 0
+        # The cut orders of the interrupted run, from its cutflow labels (checkpoints are written after the warm-up), so that the cutflows go on in the same order
+        for region in self._regions:
+            if region["warmup"] is not None:
+                cutflow = checkpoint_file.Get("{}_cutflow".format(region["name"]))
+                step_indices = dict((step["label"], i_step) for i_step, step in enumerate(region["steps"]))
+                self.set_cut_order(region, [step_indices[cutflow.GetXaxis().GetBinLabel(i)] for i in xrange(2, len(region["steps"]) + 2)])
+                region["warmup"] = None
+        for selection in self._selections:
+            for histogram in self._histograms[selection].itervalues():
+                histogram.Add(checkpoint_file.Get(histogram.GetName()))
+        checkpoint_file.Close()
+        self._events_processed = state["events_processed"]
+        print "[MonoPhotonHistogrammer::load_checkpoint] INFO : Resuming from checkpoint {} ({} events processed)".format(self._checkpoint_path, self._events_processed)
+        return state["entries_done"]
+
+    # add_skim_normalization(): for a skimmed input file (see skim()), the number of events of the original ntuples, and the number of events in the skim.
+    # - The difference is added to the events_processed histogram in finish(), so that the MC normalization is the same as without the skim.
+    # - Only correct when running over all events of the skim (no max_events).
+    def add_skim_normalization(self, events_processed, events_kept):
+        self._events_removed_by_skim += events_processed - events_kept
+
+    # activate_branches(): switch off all branches of the TChain, except the ones the analysis reads (default: self.analysis_branches)
+    def activate_branches(self, branches=None):
+        if branches is None:
+            branches = self.analysis_branches
+        self._active_branches = sorted(set(branches))
+        self._data.SetBranchStatus("*", 0)
+        for branch in self._active_branches:
+            self._data.SetBranchStatus(branch, 1)
+        print "[MonoPhotonHistogrammer::activate_branches] INFO : Activated {} branches".format(len(self._active_branches))
+
+    # trace_branches(): run the selections over the first n_events events with all branches on, and record which branches are actually read.
+    # - Returns the set of branch names. Branches missing from self.analysis_branches are reported, since they would be read as stale values by run().
+    # - Only branches read by the events in the trace are seen, e.g. lepton branches are only read for events with a photon candidate. Use enough events!
+    def trace_branches(self, n_events=1000):
+        self._data.SetBranchStatus("*", 1)
+        data = self._data
+        histograms = self._histograms
+        recorder = BranchAccessRecorder(data)
+        self._data = recorder
+        fill_buffers = self._fill_buffers
+        self._fill_buffers = dict((selection, dict((name, NullHistogram()) for name in histograms[selection])) for selection in histograms)
+        self._histograms = self._fill_buffers
+        regions = self._regions
+        self._regions = copy.deepcopy(regions) # Cutflow counts, without the warm-up
+        for region in self._regions:
+            region["warmup"] = None
+        try:
+            for i in xrange(min(n_events, data.GetEntries())):
+                data.GetEntry(i)
+                self.process_event()
+        finally:
+            self._data = data
+            self._histograms = histograms
+            self._fill_buffers = fill_buffers
+            self._regions = regions
+        traced_branches = set(name for name in recorder.accessed if data.GetBranch(name))
+
+        missing_branches = traced_branches - set(self.analysis_branches)
+        if missing_branches:
+            print "[MonoPhotonHistogrammer::trace_branches] WARNING : Branches read by the analysis, but not in analysis_branches: {}".format(", ".join(sorted(missing_branches)))
+        print "[MonoPhotonHistogrammer::trace_branches] INFO : Traced {} branches over {} events".format(len(traced_branches), min(n_events, data.GetEntries()))
+        return traced_branches
+
+    # selection_hash(): hash of everything that determines the histograms of an input file: the selection code, the spec and the options (see histogram_cache.py)
+    def selection_hash(self):
+        config = {"spec": self._spec, "trigger_turnons": self._trigger_turnons, "is_data": self._is_data, "tree_name": self._tree_name}
+        if self._variations:
+            config["variations"] = self._variations
+        if self._adaptive_warmup_events > 0: # The cutflows follow the cut order
+            config["cut_order"] = open(self._cut_order_path).read() if self._cut_order_path and os.path.isfile(self._cut_order_path) else None
+        return selection_hash(self.selection_code_files(), config)
+
+    # region_hash(): hash of what decides the regions passed by an entry and their photons: the selection code and the spec without its histograms (see selection_sidecar.py)
+    def region_hash(self):
+        config = {"spec": dict((key, value) for key, value in self._spec.iteritems() if key != "histograms"), "is_data": self._is_data, "tree_name": self._tree_name}
+        return selection_hash(self.selection_code_files(), config)
+
+    # selection_code_files(): source files of the analysis code, for selection_hash() and region_hash()
+    def selection_code_files(self):
+        code_modules = [sys.modules[name] for name in [__name__, PhotonTriggers.__module__, PhotonIDBits.__module__, CompiledExpression.__module__, make_fill_buffers.__module__, RootChunkReader.__module__]]
+        return source_files(*code_modules)
+
+    # set_spec(): use a different analysis spec (dict, see analysis_spec.load_spec()). Call before start().
+    def set_spec(self, spec):
+        self._spec = spec
+
+    # set_checkpoint(): during run(), write a checkpoint (see write_checkpoint()) every every_events events or every_seconds seconds, whichever comes first. Call before run().
+    # - resume: continue from the checkpoint if there is one. The final histograms are the same as without the interruption.
+    # - The checkpoint is deleted by finish().
+    def set_checkpoint(self, checkpoint_path, every_events=100000, every_seconds=600., resume=False):
+        self._checkpoint_path = checkpoint_path
+        self._checkpoint_every_events = every_events
+        self._checkpoint_every_seconds = every_seconds
+        self._resume = resume
+
+    # set_adaptive_cut_order(): evaluate the steps of each region in the order of increasing cost per rejection, measured on the first warmup_events events (see adapt_cut_order()).
+    # - The selections and histograms are the same. The cutflows follow the order, so cutflows are only added up (--jobs, --combine_outputs) if they have the same order:
+    #   with cut_order_path, the orders are learned once and saved there, and later runs read them instead of warming up again.
+    # - Call before start().
+    def set_adaptive_cut_order(self, warmup_events=2000, cut_order_path=None):
+        self._adaptive_warmup_events = warmup_events
+        self._cut_order_path = cut_order_path
+
+    # set_prefilter(): in run(), read the scalar branches (prefilter_branches) of block_size entries at a time in bulk, and only load the entries passing the scalar cuts of at least one region.
+    # - The histograms are the same. Only the scalar cuts at the start of a region's cut order can skip entries, as the skipped entries are counted in the cutflow at the first one they fail.
+    #   The photon candidate is the first step of the spec order, so this needs the adaptive cut order (see set_adaptive_cut_order()). Entries are not skipped during its warm-up.
+    # - Call before start().
+    def set_prefilter(self, block_size=100000):
+        self._prefilter_block_size = block_size
+
+    # set_sidecar_dir(): in run(), write a selection sidecar (see selection_sidecar.py) into sidecar_dir for each input file processed completely, for later rehist() runs. Call before run().
+    def set_sidecar_dir(self, sidecar_dir):
+        self._sidecar_dir = sidecar_dir
+
+    # set_catalogue(): take the size and checksum of remote input files from a FileCatalogue (see file_catalogue.py) for the selection sidecars, instead of asking the server
+    def set_catalogue(self, catalogue):
+        self._catalogue = catalogue
+
+    # set_variations(): also fill the histograms with some spec parameters changed, in the same event loop. variations: [{"name" : ..., "parameters" : {parameter : value}}] (see analysis_spec.default_variations).
+    # - Only the regions whose cuts or weight use a varied parameter are filled again, into <region>_<histogram>_<variation>. The cutflows are those of the nominal parameters.
+    # - The varied parameters are numpy arrays over the variations, so each cut or weight using them is evaluated once per event for all variations, and everything else is shared with the nominal selection.
+    # - Call before start(). Not available with rehist().
+    def set_variations(self, variations):
+        self._variations = variations
+
+    # set_staging(): read the input files of run() from local copies, made ahead of time by a staging area (staging.StagingArea). Call before run().
+    def set_staging(self, staging):
+        self._staging = staging
+
+    # set_trigger_turnons(): also fill photon pT and MET histograms for all photon triggers (PhotonTriggers), with the trigger_denominator selection (backup triggers) as the reference.
+    # - Gives the turn-on curves of every path in one pass. Call before start().
+    def set_trigger_turnons(self, trigger_turnons=True):
+        self._trigger_turnons = trigger_turnons
 
     # set_output_path(): specify the output path for saving.
     def set_output_path(self, output_path):
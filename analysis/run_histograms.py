@@ -1,13 +1,276 @@
 import os
 import sys
-from ROOT import TFile
+import time
+import glob
+import pipes
+import shutil
+import multiprocessing
+from ROOT import TFile, TH1D
 
 # Load python modules
 from MonoPhoton.DASAnalysis import input_samples
 from MonoPhoton.DASAnalysis.cross_sections import cross_sections
+from MonoPhoton.DASAnalysis.analysis_spec import load_spec, load_variations
+from MonoPhoton.DASAnalysis.histogram_cache import HistogramCache, merge_histogram_files
+from MonoPhoton.DASAnalysis.task_scheduler import run_tasks, submission_order
+from MonoPhoton.DASAnalysis.file_catalogue import FileCatalogue, default_remote_max_age
+from MonoPhoton.DASAnalysis.job_splitter import split_entry_range, write_throughput
+from MonoPhoton.DASAnalysis.staging import StagingArea
+from MonoPhoton.DASAnalysis.shared_histograms import SharedHistograms, SlotTurns, histogram_layout
+from MonoPhoton.DASAnalysis.metrics import metrics_path, merge_metrics_files, summary_table
 sys.path.append(os.path.expandvars("$CMSSW_BASE/src/MonoPhoton/DASAnalysis/analysis"))
 from monophoton_histogrammer import MonoPhotonHistogrammer
 
+# make_histogrammer(): histogrammer for a subsample, configured from the command line arguments
+def make_histogrammer(subsample, args):
+	histogrammer = MonoPhotonHistogrammer(is_data=("data" in subsample.lower()))
+	if args.spec:
+		histogrammer.set_spec(load_spec(args.spec))
+	if args.variations:
+		histogrammer.set_variations(load_variations(args.variations))
+	histogrammer.set_trigger_turnons(args.trigger_turnons)
+	if args.adaptive_cuts:
+		histogrammer.set_adaptive_cut_order(args.adaptive_warmup, cut_order_path=args.cut_order)
+	if args.prefilter:
+		histogrammer.set_prefilter()
+	if args.sidecar_dir:
+		histogrammer.set_sidecar_dir(args.sidecar_dir)
+	if args.catalogue:
+		histogrammer.set_catalogue(FileCatalogue(args.catalogue))
+	if args.stage_dir:
+		histogrammer.set_staging(StagingArea(args.stage_dir, quota=args.stage_quota * 1.e9, read_ahead=args.read_ahead, latency=args.stage_latency))
+	return histogrammer
+
+# learn_cut_order(): for --adaptive_cuts, learn the cut order of the regions on the first --adaptive_warmup events of a subsample, and save it to --cut_order (unless it exists already)
+# - All subsamples and input files are then processed with the same order, so that their cutflows can be added up.
+def learn_cut_order(subsample, args):
+	if os.path.isfile(args.cut_order):
+		print "[run_histograms] INFO : Using the cut order in {}".format(args.cut_order)
+		return
+	print "[run_histograms] INFO : Learning the cut order on subsample {}".format(subsample)
+	histogrammer = make_histogrammer(subsample, args)
+	for input_file in input_samples.subsample_files[subsample]:
+		histogrammer.add_file(input_file)
+	histogrammer.start()
+	histogrammer.run(max_events=args.adaptive_warmup)
+	histogrammer.flush_cutflows() # Ends the warm-up if the subsample has fewer events
+
+# get_input_metadata(): (summed hEvents, events processed by the skims, events kept by the skims) for a list of input files
+# - From the file catalogue if --catalogue is given (see file_catalogue.py), otherwise by opening each file.
+# - The skim numbers are 0 for input files that are not skims.
+# - For files split into entry ranges (see job_splitter.py), hEvents and the skim numbers are only counted with the range starting at entry 0, so they are not double counted after merging.
+def get_input_metadata(input_files, args):
+	if args.catalogue:
+		catalogue = FileCatalogue(args.catalogue)
+		skims = [info for info in catalogue.files_info(input_files) if info["skim_events_processed"] is not None and info["first_entry"] == 0]
+		return catalogue.sum_hEvents(input_files), sum(info["skim_events_processed"] for info in skims), sum(info["entries"] for info in skims)
+
+	hEvents = None
+	skim_events_processed = 0
+	skim_events_kept = 0
+	for input_file in input_files:
+		path, first_entry, last_entry = split_entry_range(input_file)
+		if first_entry != 0:
+			continue
+
+		# Keep track of the number of generated events corresponding to the MC sample file
+		f = TFile.Open(path, "READ")
+		if not hEvents:
+			hEvents = f.Get("ggNtuplizer/hEvents").Clone()
+			hEvents.SetDirectory(0)
+		else:
+			hEvents.Add(f.Get("ggNtuplizer/hEvents"))
+
+		# For skims, keep track of the events removed by the skim, for the normalization (events_processed)
+		h_skim_events_processed = f.Get("ggNtuplizer/skim_events_processed")
+		if h_skim_events_processed:
+			skim_events_processed += int(h_skim_events_processed.GetBinContent(1))
+			skim_events_kept += f.Get("ggNtuplizer/EventTree").GetEntries()
+		f.Close()
+	return hEvents, skim_events_processed, skim_events_kept
+
+# run_histogrammer(): event loop, with run() or, with --columnar, run_columnar() (reading from --columnar_cache if given)
+# - With --rehist, rehist() from the selection sidecars in --sidecar_dir if all input files have one (otherwise run(), which writes them)
+def run_histogrammer(histogrammer, args):
+	if args.columnar:
+		histogrammer.run_columnar(max_events=args.max_events, cache_dir=args.columnar_cache)
+	elif args.rehist and histogrammer.has_sidecars(args.sidecar_dir):
+		histogrammer.rehist(args.sidecar_dir, max_events=args.max_events)
+	else:
+		histogrammer.run(max_events=args.max_events)
+
+# process_input_file(): histograms of a single input file, plus its hEvents, written to output_path
+def process_input_file(subsample, input_file, args, output_path):
+	histogrammer = make_histogrammer(subsample, args)
+	histogrammer.add_file(input_file)
+	hEvents, skim_events_processed, skim_events_kept = get_input_metadata([input_file], args)
+	histogrammer.add_skim_normalization(skim_events_processed, skim_events_kept)
+
+	histogrammer.set_output_path(output_path)
+	histogrammer.start()
+	run_histogrammer(histogrammer, args)
+	histogrammer.finish()
+
+	if hEvents:
+		f = TFile(output_path, "UPDATE")
+		hEvents.Write()
+		f.Close()
+	return output_path
+
+# get_file_histograms(): path of a file with the histograms of input_file (see process_input_file())
+# - With --cache_dir, taken from the per-file histogram cache if there is an up-to-date entry (see histogram_cache.py). Otherwise, the file is processed into tmp_path, and moved into the cache.
+def get_file_histograms(subsample, input_file, args, tmp_path):
+	if not args.cache_dir:
+		return process_input_file(subsample, input_file, args, tmp_path)
+	cache = HistogramCache(args.cache_dir, max_size=args.cache_size * 1.e9)
+	cache_key = cache.key(input_file, make_histogrammer(subsample, args).selection_hash(), FileCatalogue(args.catalogue) if args.catalogue else None)
+	cached_path = cache.get(cache_key)
+	if cached_path:
+		print "[run_histograms] INFO : Using cached histograms for {}".format(input_file)
+		return cached_path
+	process_input_file(subsample, input_file, args, tmp_path)
+	return cache.put(cache_key, tmp_path)
+
+# run_file_task(): task function for task_scheduler.run_tasks() (--jobs). Speculative attempts of the same task write to different temporary files.
+def run_file_task(task, attempt):
+	subsample, input_file, args, tmp_prefix = task
+	return get_file_histograms(subsample, input_file, args, "{}_attempt{}.root".format(tmp_prefix, attempt))
+
+# run_shared_file_task(): task function for --jobs --shared_histograms. The histograms of the input file are added to the shared-memory accumulators (see shared_histograms.py)
+# - _shared_state is (SharedHistograms, SlotTurns, [subsamples]), set before the worker processes are forked (see run_shared_tasks())
+_shared_state = None
+def run_shared_file_task(task, attempt):
+	subsample, input_file, args, tmp_prefix = task
+	shared_histograms, slot_turns, groups = _shared_state
+	histogrammer = make_histogrammer(subsample, args)
+	histogrammer.add_file(input_file)
+	hEvents, skim_events_processed, skim_events_kept = get_input_metadata([input_file], args)
+	histogrammer.add_skim_normalization(skim_events_processed, skim_events_kept)
+	histogrammer.start()
+	run_histogrammer(histogrammer, args)
+	slot = slot_turns.wait(tmp_prefix)
+	shared_histograms.add(slot, groups.index(subsample), histogrammer.output_histograms(), histogrammer.total_events_processed())
+	slot_turns.done(tmp_prefix)
+	histogrammer.write_metrics(metrics_path("{}_attempt{}.root".format(tmp_prefix, attempt)))
+	return input_file
+
+# run_shared_tasks(): run the tasks with run_shared_file_task() on n_jobs processes. Returns the SharedHistograms, with one group per subsample of groups.
+# - A second attempt of a task (speculative, or after its worker died) would add the file twice, so there are none: a task failing stops the run.
+def run_shared_tasks(tasks, groups, layout_histograms, n_jobs, costs=None):
+	global _shared_state
+	if costs is None:
+		costs = [1.] * len(tasks)
+	shared_histograms = SharedHistograms(histogram_layout(layout_histograms), len(groups), n_jobs)
+	_shared_state = (shared_histograms, SlotTurns([tasks[task_id][3] for task_id in submission_order(costs)], n_jobs), groups)
+	run_tasks(run_shared_file_task, tasks, n_jobs, costs=costs, speculation_factor=None, crash_retries=0)
+	return shared_histograms
+
+# merge_task_metrics(): metrics of the per-file tasks of a subsample (--jobs), merged into subsample_histograms_<subsample>.metrics.json. For speculative tasks, the metrics of the first attempt are used.
+def merge_task_metrics(subsample, tmp_prefixes, args):
+	task_metrics = []
+	for tmp_prefix in tmp_prefixes:
+		task_metrics.extend(sorted(glob.glob("{}_attempt*.metrics.json".format(tmp_prefix)))[:1])
+	merge_metrics_files(task_metrics, metrics_path("{}/subsample_histograms_{}.root".format(args.output_dir, subsample)))
+
+# combine_sample(): add up the subsample histograms of a sample into histograms_<sample>.root, scaled to luminosity (--combine_outputs)
+# - The histograms are scaled and added one subsample at a time, in the order of input_samples.subsamples[sample], exactly as before:
+#   the floating point sums (and so the output file) do not depend on how many samples are combined in parallel.
+# - Each subsample file is opened once, and closed (freeing its histograms) before the next one.
+def combine_sample(sample, args):
+	subsample_path = lambda subsample: "{}/subsample_histograms_{}.root".format(args.output_dir, subsample)
+
+	# Jobs from the job splitter are normalized together with the other jobs of their parent subsample: {parent subsample : [subsamples]}
+	parent_jobs = {}
+	for subsample in input_samples.subsamples[sample]:
+		parent_jobs.setdefault(input_samples.parent_subsamples.get(subsample, subsample), []).append(subsample)
+
+	# For MC samples, the luminosity normalization factor of each parent subsample
+	lumi_sfs = {}
+	if sample != "data":
+		for parent, jobs in parent_jobs.iteritems():
+			input_nevents = 0
+			for job in jobs:
+				job_file = TFile(subsample_path(job))
+				input_nevents += job_file.Get("events_processed").Integral()
+				job_file.Close()
+			if args.catalogue:
+				# Cross-check against the catalogue: the two differ if the subsample was run with --max_events, or the input files changed since
+				catalogue_nevents = FileCatalogue(args.catalogue).events_processed([input_file for job in jobs for input_file in input_samples.subsample_files[job]])
+				if catalogue_nevents != input_nevents:
+					print "[run_histograms] WARNING : For subsample {}, the catalogue has {} events, but the histograms were made from {} events. Normalizing to the events processed.".format(parent, catalogue_nevents, input_nevents)
+			lumi_sfs[parent] = 2260. * cross_sections[parent] / input_nevents
+			print "For subsample {}, lumi sf = {} * {} / {} = {}".format(parent, 2260., cross_sections[parent], input_nevents, lumi_sfs[parent])
+
+	# Add up subsample histograms, and scale to luminosity
+	hists = {}
+	for i, subsample in enumerate(input_samples.subsamples[sample]):
+		subsample_file = TFile(subsample_path(subsample))
+		lumi_sf = lumi_sfs.get(input_samples.parent_subsamples.get(subsample, subsample), 1.)
+
+		# First subsample: make a list of histograms to include (from the keys, without reading the histograms)
+		if i == 0:
+			hist_names = [key.GetName() for key in subsample_file.GetListOfKeys() if "TH" in key.GetClassName()]
+
+		for hist_name in hist_names:
+			subsample_hist = subsample_file.Get(hist_name)
+			if not subsample_hist:
+				print "ERROR : Couldn't find histogram {} in file {}".format(hist_name, subsample_file.GetPath())
+			subsample_hist.Scale(lumi_sf)
+			if i == 0:
+				hists[hist_name] = subsample_hist.Clone()
+				hists[hist_name].SetDirectory(0)
+			else:
+				hists[hist_name].Add(subsample_hist)
+		subsample_file.Close()
+	# End loop over subsamples
+
+	sample_file = TFile("{}/histograms_{}.root".format(args.output_dir, sample), "RECREATE")
+	for hist_name, hist in hists.iteritems():
+		hist.Write()
+	sample_file.Close()
+	print "[run_histograms] INFO : Wrote {}/histograms_{}.root".format(args.output_dir, sample)
+
+def combine_sample_task(task):
+	combine_sample(*task)
+
+# Options that the condor jobs don't take from the submission: the input and action selection (set by the job itself), --resume (always on), the catalogue refresh
+# (done on the submit machine, never in the jobs), and options of the other actions
+condor_ignored_options = ["help", "samples", "subsamples", "all", "run", "condor_run", "condor_dryrun", "skim", "convert_columnar", "metrics_summary", "combine_outputs", "output_dir", "checkpoint", "resume", "refresh_catalogue", "catalogue_max_age", "no_catalogue_refresh", "skim_compression", "float32"]
+# Options that only work on the submit machine, with the reason
+condor_unsupported_options = {
+	"cache_dir": "the histogram cache is on the submit machine",
+	"sidecar_dir": "the selection sidecars are on the submit machine",
+	"rehist": "the selection sidecars are on the submit machine",
+	"columnar_cache": "the columnar cache is on the submit machine",
+	"jobs": "each condor job runs on one core",
+	"shared_histograms": "each condor job runs on one core",
+}
+# Options naming files read by the jobs, which have to be inside $CMSSW_BASE/src to be in the tarball
+condor_file_options = ["spec", "variations", "cut_order", "catalogue"]
+
+# condor_run_arguments(): command line arguments of the condor jobs, from the parsed arguments of the submission. Every option of --run that differs from its default is forwarded.
+# - Raises ValueError for options that can't be used in a condor job (see condor_unsupported_options), or files outside the tarball
+def condor_run_arguments(parser, args):
+	cmssw_src = os.path.expandvars("$CMSSW_BASE/src")
+	arguments = []
+	for action in parser._actions:
+		value = getattr(args, action.dest, None)
+		if action.dest in condor_ignored_options or value == action.default:
+			continue
+		option = action.option_strings[0]
+		if action.dest in condor_unsupported_options:
+			raise ValueError("[condor_run_arguments] ERROR : {} can't be used with condor: {}".format(option, condor_unsupported_options[action.dest]))
+		if action.nargs == 0: # store_true
+			arguments.append(option)
+		elif action.dest in condor_file_options and not (action.dest == "variations" and value == "default"):
+			relative_path = os.path.relpath(os.path.abspath(value), cmssw_src)
+			if relative_path.startswith("..") or not os.path.exists(value):
+				raise ValueError("[condor_run_arguments] ERROR : {} {} has to be an existing file inside $CMSSW_BASE/src, to be in the tarball{}".format(option, value, " (learn the cut order first, with --run --adaptive_cuts --cut_order)" if action.dest == "cut_order" else ""))
+			arguments.append("{} $CMSSW_BASE/src/{}".format(option, pipes.quote(relative_path)))
+		else:
+			arguments.append("{} {}".format(option, pipes.quote(str(value))))
+	return " ".join(arguments)
+
 if __name__ == "__main__":
 	# Command line arguments
 	import argparse
@@ -22,12 +285,69 @@ if __name__ == "__main__":
 	action_group.add_argument('--run', action='store_true', help="Run the histogrammer")
 	action_group.add_argument('--condor_run', action='store_true', help="Run the histogrammer on condor")
 	action_group.add_argument('--condor_dryrun', action='store_true', help="Setup the histogrammer on condor, but don't run")
+	action_group.add_argument('--skim', action='store_true', help="Write skims (events passing any region, analysis branches only) of the subsamples to --skim_dir, instead of histograms")
+	action_group.add_argument('--convert_columnar', action='store_true', help="Convert the analysis branches of the subsamples into the columnar cache --columnar_cache (see columnar_cache.py), for --run --columnar")
+	action_group.add_argument('--metrics_summary', action='store_true', help="Print a summary table of the performance metrics (*.metrics.json) in --output_dir, and write it to metrics_summary.txt")
 	action_group.add_argument('--combine_outputs', action='store_true', help="Combine outputs (subsamples into samples, plus apply luminosity normalization factors)")
 
 	parser.add_argument('--output_dir', type=str, default=os.path.expandvars("$CMSSW_BASE/../data/histograms/"))
 	parser.add_argument('--max_events', type=int, default=-1, help='Limit number of events processed')
+	parser.add_argument('--trigger_turnons', action='store_true', help='Also fill turn-on histograms for every photon trigger (w.r.t. the backup triggers)')
+	parser.add_argument('--adaptive_cuts', action='store_true', help='Evaluate the cuts of each region in the order of increasing cost per rejection, measured on the first --adaptive_warmup events of the first subsample (same histograms, faster). The cutflows follow that order.')
+	parser.add_argument('--adaptive_warmup', type=int, default=2000, help='Warm-up events for --adaptive_cuts')
+	parser.add_argument('--cut_order', type=str, help='Cut order file for --adaptive_cuts (default: <output_dir>/cut_order.json). Learned if it does not exist, otherwise used as is; delete it to learn again.')
+	parser.add_argument('--prefilter', action='store_true', help='Read pfMET, HLTPho and metFilters in bulk first, and skip the events that fail the scalar cuts at the start of the cut order of every region (same histograms). Needs --adaptive_cuts. Not used with --columnar.')
+	parser.add_argument('--sidecar_dir', type=str, help='For --run: write a selection sidecar (regions passed and chosen photons of each entry, see selection_sidecar.py) of each input file here')
+	parser.add_argument('--rehist', action='store_true', help='For --run: fill the histograms from the selection sidecars in --sidecar_dir, without running the selection (input files without an up-to-date sidecar are run normally). For new variables or binnings.')
+	parser.add_argument('--variations', type=str, help='Also fill the regions with some parameters varied, in the same event loop, as <region>_<histogram>_<variation>: a JSON or YAML list of {"name", "parameters"}, or "default" for analysis_spec.default_variations. Not used with --rehist.')
+	parser.add_argument('--spec', type=str, help='JSON or YAML analysis spec with the regions and histograms (default: analysis_spec.default_spec). For condor, use a path inside $CMSSW_BASE/src, so it is in the tarball (same for --variations, --cut_order and --catalogue).')
+	parser.add_argument('--skim_dir', type=str, default=input_samples.default_skim_dir, help='Directory of the skims, for --skim and --use_skims')
+	parser.add_argument('--use_skims', action='store_true', help='Run over the skims in --skim_dir instead of the original ntuples, where available')
+	parser.add_argument('--cache_dir', type=str, help='Per-input-file histogram cache. Only the input files that changed (or the selection changed) since the last run are processed.')
+	parser.add_argument('--cache_size', type=float, default=20., help='Maximum size of the histogram cache in GB (least recently used entries are deleted first)')
+	parser.add_argument('--jobs', type=int, default=1, help='Number of local processes for --run. All subsamples are split into one task per input file, which are merged afterwards (--max_events then applies per file). For --combine_outputs, number of samples combined in parallel.')
+	parser.add_argument('--shared_histograms', action='store_true', help='For --jobs: accumulate the histograms of all input files in shared memory (one slot per process), instead of one temporary ROOT file per input file. Not used with --cache_dir.')
+	parser.add_argument('--catalogue', type=str, help='SQLite input file catalogue (see file_catalogue.py). Refreshed for the selected subsamples, then used instead of opening every input file for hEvents and the normalization.')
+	parser.add_argument('--refresh_catalogue', action='store_true', help='Check every xrootd file of the catalogue for changes (xrdfs), instead of only those checked more than --catalogue_max_age days ago')
+	parser.add_argument('--catalogue_max_age', type=float, default=default_remote_max_age / 86400., help='Days after which an xrootd file of the catalogue is checked for changes again')
+	parser.add_argument('--no_catalogue_refresh', action='store_true', help='Use the catalogue as it is, without scanning new or changed files (condor jobs)')
+	parser.add_argument('--skim_compression', type=int, default=404, help='ROOT compression setting of the skims (100 * algorithm + level, e.g. 101 = zlib, 207 = LZMA, 404 = LZ4)')
+	parser.add_argument('--stage_dir', type=str, help='Copy the input files to this local scratch directory ahead of processing them (see staging.py), and read the local copies. Copies are kept for later runs, within --stage_quota.')
+	parser.add_argument('--stage_quota', type=float, default=50., help='Maximum size of --stage_dir in GB (least recently used copies are deleted first)')
+	parser.add_argument('--read_ahead', type=int, default=2, help='Number of input files copied to --stage_dir ahead of the one being processed')
+	parser.add_argument('--stage_latency', type=float, default=0., help='Testing: injected latency in seconds per staged file (e.g. with a local directory standing in for xrootd)')
+	parser.add_argument('--columnar', action='store_true', help='For --run: use the columnar event loop (run_columnar)')
+	parser.add_argument('--columnar_cache', type=str, help='Columnar cache directory: written by --convert_columnar, read by --run --columnar')
+	parser.add_argument('--float32', action='store_true', help='For --convert_columnar: store floating point branches as float32')
+	parser.add_argument('--checkpoint', action='store_true', help='For --run: write a checkpoint of the histograms every --checkpoint_events events or --checkpoint_seconds seconds, next to the output file')
+	parser.add_argument('--checkpoint_events', type=int, default=100000, help='Events between checkpoints')
+	parser.add_argument('--checkpoint_seconds', type=float, default=600., help='Seconds between checkpoints')
+	parser.add_argument('--resume', action='store_true', help='For --run: continue from the last checkpoint of an interrupted run, if there is one (implies --checkpoint)')
 	args = parser.parse_args()
 
+	if args.cache_dir and args.max_events > 0:
+		print "[run_histograms] WARNING : The histogram cache only holds complete files, so it is not used with --max_events."
+		args.cache_dir = None
+
+	if args.shared_histograms and args.cache_dir:
+		print "[run_histograms] WARNING : The histogram cache holds one ROOT file per input file, so it is not used with --shared_histograms."
+		args.cache_dir = None
+
+	if args.rehist and not args.sidecar_dir:
+		print "[run_histograms] ERROR : --rehist needs --sidecar_dir"
+		sys.exit(1)
+
+	if args.rehist and args.variations:
+		print "[run_histograms] ERROR : The selection sidecars only hold the nominal selection, so --variations can't be used with --rehist"
+		sys.exit(1)
+
+	if args.adaptive_cuts and not args.cut_order:
+		args.cut_order = "{}/cut_order.json".format(args.output_dir)
+
+	if args.use_skims:
+		missing_skims = input_samples.use_skims(args.skim_dir)
+		print "[run_histograms] INFO : Using skims from {}".format(args.skim_dir)
+
 	# Create list of input samples and subsamples
 	subsamples = []
 	if args.samples:
@@ -44,99 +364,179 @@ if __name__ == "__main__":
 		samples = []
 		subsamples = args.subsamples.split(",")
 
+	if args.catalogue and not args.no_catalogue_refresh:
+		failed_files = FileCatalogue(args.catalogue).refresh(dict((subsample, input_samples.subsample_files[subsample]) for subsample in subsamples), n_jobs=max(args.jobs, 8), remote_max_age=0. if args.refresh_catalogue else args.catalogue_max_age * 86400.)
+		if failed_files:
+			print "[run_histograms] ERROR : Couldn't scan {} input files into the catalogue {}, so they can't be normalized:\n\t{}".format(len(failed_files), args.catalogue, "\n\t".join(failed_files))
+			sys.exit(1)
+
 	# Make a working directory for temporary/intermediate files
 	os.system("mkdir -pv {}".format(args.output_dir))
 
-	if args.run:
+	if args.use_skims:
+		for subsample in subsamples:
+			if subsample in missing_skims:
+				print "[run_histograms] WARNING : No skim for subsample {}, using the original ntuples".format(subsample)
+
+	if args.run and args.adaptive_cuts:
+		learn_cut_order(subsamples[0], args)
+
+	if args.run and args.jobs > 1:
+		# One task per input file, for all subsamples at once (see task_scheduler.py)
+		task_dir = "{}/tasks".format(args.output_dir)
+		os.system("mkdir -pv {}".format(task_dir))
+		tasks = []
+		costs = []
+		catalogue = FileCatalogue(args.catalogue) if args.catalogue else None
+		for subsample in subsamples:
+			for i_file, input_file in enumerate(input_samples.subsample_files[subsample]):
+				tasks.append((subsample, input_file, args, "{}/{}_{}".format(task_dir, subsample, i_file)))
+				info = catalogue.file_info(input_file) if catalogue else None
+				if info:
+					costs.append(info["last_entry"] - info["first_entry"])
+				else:
+					costs.append(os.path.getsize(split_entry_range(input_file)[0]) if os.path.isfile(split_entry_range(input_file)[0]) else 1.)
+		if args.shared_histograms:
+			# Shared-memory accumulators, one slot per worker and one group per subsample (see shared_histograms.py)
+			layout_histogrammer = make_histogrammer(subsamples[0], args)
+			layout_histogrammer.start()
+			shared_histograms = run_shared_tasks(tasks, subsamples, layout_histogrammer.output_histograms(), args.jobs, costs=costs)
+
+			for i_subsample, subsample in enumerate(subsamples):
+				histograms, n_events = shared_histograms.histograms(i_subsample)
+				hEvents = get_input_metadata(input_samples.subsample_files[subsample], args)[0]
+				output_file = TFile("{}/subsample_histograms_{}.root".format(args.output_dir, subsample), "RECREATE")
+				for histogram in histograms:
+					histogram.Write()
+				h_nevents_processed = TH1D("events_processed", "events_processed", 1, 0.5, 1.5)
+				h_nevents_processed.SetBinContent(1, n_events)
+				h_nevents_processed.Write()
+				if hEvents:
+					hEvents.Write()
+				output_file.Close()
+				merge_task_metrics(subsample, [task[3] for task in tasks if task[0] == subsample], args)
+		else:
+			file_histograms = run_tasks(run_file_task, tasks, args.jobs, costs=costs)
+
+			# Merge the per-file histograms of each subsample, in input file order
+			for subsample in subsamples:
+				merge_histogram_files([path for task, path in zip(tasks, file_histograms) if task[0] == subsample], "{}/subsample_histograms_{}.root".format(args.output_dir, subsample))
+				merge_task_metrics(subsample, [task[3] for task in tasks if task[0] == subsample], args)
+			if args.cache_dir:
+				HistogramCache(args.cache_dir, max_size=args.cache_size * 1.e9).evict()
+		shutil.rmtree(task_dir)
+
+	elif args.run and args.cache_dir:
 		for subsample in subsamples:
 			print "[run_histograms] INFO : Processing subsample {}".format(subsample)
-			histogrammer = MonoPhotonHistogrammer(is_data=("data" in subsample.lower()))
-			hEvents = None
+			tmp_prefixes = ["{}/cache_tmp_{}".format(args.output_dir, i_file) for i_file in xrange(len(input_samples.subsample_files[subsample]))]
+			file_histograms = [get_file_histograms(subsample, input_file, args, "{}.root".format(tmp_prefix)) for input_file, tmp_prefix in zip(input_samples.subsample_files[subsample], tmp_prefixes)]
+			merge_histogram_files(file_histograms, "{}/subsample_histograms_{}.root".format(args.output_dir, subsample))
+
+			# Metrics of the files that were processed (not taken from the cache)
+			task_metrics = [metrics_path("{}.root".format(tmp_prefix)) for tmp_prefix in tmp_prefixes]
+			merge_metrics_files(task_metrics, metrics_path("{}/subsample_histograms_{}.root".format(args.output_dir, subsample)))
+			for path in task_metrics:
+				if os.path.isfile(path):
+					os.remove(path)
+		HistogramCache(args.cache_dir, max_size=args.cache_size * 1.e9).evict()
+
+	elif args.run or args.skim:
+		for subsample in subsamples:
+			print "[run_histograms] INFO : Processing subsample {}".format(subsample)
+			histogrammer = make_histogrammer(subsample, args)
 			for input_file in input_samples.subsample_files[subsample]:
 				histogrammer.add_file(input_file)
+			hEvents, skim_events_processed, skim_events_kept = get_input_metadata(input_samples.subsample_files[subsample], args)
+			histogrammer.add_skim_normalization(skim_events_processed, skim_events_kept)
 
-				# Keep track of the number of generated events corresponding to the MC sample file 
-				f = TFile.Open(input_file, "READ")
-				if not hEvents:
-					hEvents = f.Get("ggNtuplizer/hEvents").Clone()
-					hEvents.SetDirectory(0)
-				else:
-					hEvents.Add(f.Get("ggNtuplizer/hEvents"))
-				f.Close()
+			if args.skim:
+				os.system("mkdir -pv {}".format(args.skim_dir))
+				histogrammer.start()
+				histogrammer.skim(input_samples.get_skim_path(subsample, args.skim_dir), max_events=args.max_events, hEvents=hEvents, compression=args.skim_compression)
+				continue
 
 			os.system("mkdir -pv {}".format(args.output_dir))
 			histogrammer.set_output_path("{}/subsample_histograms_{}.root".format(args.output_dir, subsample))
-
+			if args.checkpoint or args.resume:
+				histogrammer.set_checkpoint("{}/subsample_histograms_{}.checkpoint.root".format(args.output_dir, subsample), every_events=args.checkpoint_events, every_seconds=args.checkpoint_seconds, resume=args.resume)
 			histogrammer.start()
-			histogrammer.run(max_events=args.max_events)
+			run_start = time.time()
+			run_histogrammer(histogrammer, args)
 			histogrammer.finish()
 
+			# Measured throughput, for the job splitter (see job_splitter.py)
+			write_throughput(args.output_dir, subsample, input_samples.parent_subsamples.get(subsample, subsample), histogrammer._events_processed, time.time() - run_start)
+
 			# Add to the output file the histogram for keeping track of the number of input events
 			# WARNING : David thinks these histograms have 2x the number of events...??? For now, used events_processed instead?
-			f = TFile("{}/subsample_histograms_{}.root".format(args.output_dir, subsample), "UPDATE")
-			hEvents.Write()
-			f.Close()
+			if hEvents:
+				f = TFile("{}/subsample_histograms_{}.root".format(args.output_dir, subsample), "UPDATE")
+				hEvents.Write()
+				f.Close()
+
+	elif args.convert_columnar:
+		if not args.columnar_cache:
+			print "[run_histograms] ERROR : --convert_columnar needs --columnar_cache"
+			sys.exit(1)
+		for subsample in subsamples:
+			print "[run_histograms] INFO : Converting subsample {}".format(subsample)
+			histogrammer = make_histogrammer(subsample, args)
+			for input_file in input_samples.subsample_files[subsample]:
+				histogrammer.add_file(input_file)
+			histogrammer.write_columnar_cache(args.columnar_cache, float32=args.float32)
 
 	elif args.condor_run or args.condor_dryrun:
+		try:
+			run_arguments = condor_run_arguments(parser, args)
+		except ValueError as error:
+			print error
+			sys.exit(1)
+
 		# Make a tarball of the CMSSW area
 		os.system("csub --tar_only --cmssw")
 
-		# Submit one HTCondor job per subsample
-		# - It would be a lot faster to split the subsamples into subjobs, too, but we'll keep things simple for the DAS exercise.
+		# Submit one HTCondor job per subsample, all in one cluster (csub --task_list): one submission file, one condor_submit, one tarball transfer
+		# - The jobs write checkpoints (--resume), which condor saves when a job is evicted and brings back when it restarts (csub --transfer_on_evict)
+		# - Subsamples made by the job splitter (analysis/inputs/split_data.py) have a target run time, and their own JobFlavour. Other subsamples use espresso.
+		# - The jobs get the same --run options as the submission (see condor_run_arguments()). The catalogue is refreshed here, and used as it is by the jobs.
+		# - --condor_dryrun prepares the submission file without submitting it
+		run_script_path = "{}/run_histograms.sh".format(args.output_dir)
+		run_script = open(run_script_path, 'w')
+		run_script.write("#!/bin/bash\n")
+		run_script.write("python $CMSSW_BASE/src/MonoPhoton/DASAnalysis/analysis/run_histograms.py --run --resume --output_dir . --subsamples $1 {}{}\n".format(run_arguments, " --no_catalogue_refresh" if args.catalogue else ""))
+		run_script.close()
+
+		task_list_path = "{}/condor_tasks.txt".format(args.output_dir)
+		task_list = open(task_list_path, 'w')
 		for subsample in subsamples:
-			run_script_path = "{}/run_{}.sh".format(args.output_dir, subsample)
-			run_script = open(run_script_path, 'w')
-			run_script.write("#!/bin/bash\n")
-			run_script.write("python $CMSSW_BASE/src/MonoPhoton/DASAnalysis/analysis/run_histograms.py --run --output_dir . --subsamples {} --max_events {}\n".format(subsample, args.max_events))
-			run_script.close()
+			task_list.write("{} {} {}\n".format(subsample, input_samples.job_flavours.get(subsample, "espresso"), subsample))
+		task_list.close()
 
-			csub_script_path = "{}/csub_{}.sh".format(args.output_dir, subsample)
-			csub_script = open(csub_script_path, 'w')
-			csub_script.write("#!/bin/bash\n")
-			csub_script.write("csub {} --cmssw --no_retar -t espresso -d {}\n".format(run_script_path, args.output_dir))
-			csub_script.close()
+		csub_script_path = "{}/csub_histograms.sh".format(args.output_dir)
+		csub_script = open(csub_script_path, 'w')
+		csub_script.write("#!/bin/bash\n")
+		csub_script.write("csub {} --task_list {} --cmssw --no_retar --transfer_on_evict -d {}{}\n".format(run_script_path, task_list_path, args.output_dir, " --no_submit" if args.condor_dryrun else ""))
+		csub_script.close()
+		os.system("source {}".format(csub_script_path))
 
-			if args.condor_run:
-				os.system("source {}".format(csub_script_path))
+	elif args.metrics_summary:
+		table = summary_table(args.output_dir)
+		print table
+		with open("{}/metrics_summary.txt".format(args.output_dir), 'w') as f:
+			f.write(table + "\n")
 
 	elif args.combine_outputs:
 		print cross_sections
-		# Add up subsample histograms, and scale to luminosity
-		for sample in samples:
-			sample_file = TFile("{}/histograms_{}.root".format(args.output_dir, sample), "RECREATE")
-			hists = {}
-
-			for i, subsample in enumerate(input_samples.subsamples[sample]):
-				subsample_file = TFile("{}/subsample_histograms_{}.root".format(args.output_dir, subsample))
-
-				# For MC samples, get the luminosity normalization factor
-				if sample != "data":
-					input_nevents = subsample_file.Get("events_processed").Integral()
-					lumi_sf = 2260. * cross_sections[subsample] / input_nevents
-					print "For subsample {}, lumi sf = {} * {} / {} = {}".format(subsample, 2260., cross_sections[subsample], input_nevents, lumi_sf)
-				else:
-					lumi_sf = 1.
-
-				# First subsample: create the output sample file, and make a list of histograms to include
-				if i == 0:
-					hist_names = []
-					for key in subsample_file.GetListOfKeys():
-						if "TH" in key.GetClassName():
-							hist_names.append(key.ReadObj().GetName())
-					
-				for hist_name in hist_names:
-					subsample_hist = subsample_file.Get(hist_name)
-					if not subsample_hist:
-						print "ERROR : Couldn't find histogram {} in file {}".format(hist_name, subsample_file.GetPath())
-					subsample_hist.Scale(lumi_sf)
-					if i == 0:
-						hists[hist_name] = subsample_hist.Clone()
-						hists[hist_name].SetDirectory(0)
-					else:
-						hists[hist_name].Add(subsample_hist)
-			# End loop over subsamples
-
-			sample_file.cd()
-			for hist_name, hist in hists.iteritems():
-				hist.Write()
+		# One process per sample (see combine_sample())
+		if args.jobs > 1 and len(samples) > 1:
+			pool = multiprocessing.Pool(min(args.jobs, len(samples)), maxtasksperchild=1)
+			try:
+				pool.map(combine_sample_task, [(sample, args) for sample in samples], chunksize=1)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			for sample in samples:
+				combine_sample(sample, args)
 
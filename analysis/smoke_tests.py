@@ -0,0 +1,255 @@
+# Smoke tests of the run machinery, without EOS or condor access: small reproducible checks on local files (see benchmark.py for the performance side)
+#     staging    : StagingArea (see staging.py) with file:// sources: LRU eviction within the quota, copies in use never evicted, no partial copy ever used, stale copies replaced
+#     checkpoint : on synthetic ggNtuples (see synthetic_ntuples.py), a run killed after a checkpoint and resumed (run_histograms.py --resume) gives the histograms of an uninterrupted run,
+#                  for the plain, pre-filtered and adaptive event loops. Needs ROOT.
+#     condor     : the csub submission of run_histograms.py --condor_run (one cluster from a task list, outputs transferred on eviction), submitted to a mock condor_submit
+# - Each test runs in a fresh process, in its own directory under --work_dir (deleted first). The script exits with code 1 if any test fails.
+#
+# Example:
+#   python smoke_tests.py --work_dir /tmp/monophoton_smoke_tests --tests staging,checkpoint,condor
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+import multiprocessing
+
+from MonoPhoton.DASAnalysis import staging
+from MonoPhoton.DASAnalysis import synthetic_ntuples
+sys.path.append(os.path.expandvars("$CMSSW_BASE/src/MonoPhoton/DASAnalysis/analysis"))
+
+all_tests = ["staging", "checkpoint", "condor"]
+
+csub_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "csub")
+
+# Mock condor_submit: records its arguments and keeps a copy of the submission file
+mock_condor_submit = """import sys, shutil
+with open("condor_submit_calls.txt", "a") as f:
+	f.write(" ".join(sys.argv[1:]) + "\\n")
+shutil.copyfile(sys.argv[-1], "submitted.jdl")
+print "1 job(s) submitted to cluster 1."
+"""
+
+# check(): fail the current test with a message unless condition holds
+def check(condition, message):
+	if not condition:
+		raise AssertionError(message)
+
+# write_source_files(): n_files files of size bytes each (different contents) in source_dir. Returns their file:// URLs.
+def write_source_files(source_dir, n_files, size):
+	os.makedirs(source_dir)
+	paths = []
+	for i_file in xrange(n_files):
+		path = "{}/source_{}.root".format(source_dir, i_file)
+		with open(path, 'wb') as f:
+			f.write(chr(ord("a") + i_file) * size)
+		paths.append("file://" + path)
+	return paths
+
+# same_contents(): whether a staged copy is identical to its file:// source
+def same_contents(local_path, path):
+	with open(local_path, 'rb') as local_file, open(path[len("file://"):], 'rb') as source_file:
+		return local_file.read() == source_file.read()
+
+# test_staging(): StagingArea with file:// sources
+def test_staging(test_dir):
+	size = 100000
+	paths = write_source_files("{}/source".format(test_dir), 5, size)
+
+	# Read-ahead with a quota below the copies in use: the current and the prefetched copies are pinned, so they are never evicted, the others are
+	scratch_dir = "{}/scratch_pinned".format(test_dir)
+	area = staging.StagingArea(scratch_dir, quota=1.5 * size, read_ahead=1)
+	for i_file, (path, local_path) in enumerate(area.iterate(paths)):
+		check(local_path == area.local_path(path), "{} was not staged".format(path))
+		if i_file + 1 < len(paths):
+			area._copies[paths[i_file + 1]][0].wait() # Prefetch done
+		area.evict()
+		check(os.path.isfile(local_path) and same_contents(local_path, path), "The copy of {} in use was evicted or is incomplete".format(path))
+		if i_file + 1 < len(paths):
+			check(os.path.isfile(area.local_path(paths[i_file + 1])), "The prefetched copy of {} was evicted".format(paths[i_file + 1]))
+	remaining = os.listdir(scratch_dir)
+	check(remaining == [os.path.basename(area.local_path(paths[-1]))], "After the last release, only the last copy should fit in the quota: {}".format(remaining))
+
+	# LRU: the least recently used copy is evicted first. A copy from a previous run (here another StagingArea on the same directory) is reused, not copied again.
+	# The sleeps keep the modification times apart on file systems with a 1 s resolution.
+	scratch_dir = "{}/scratch_lru".format(test_dir)
+	area = staging.StagingArea(scratch_dir, quota=3.5 * size, read_ahead=0)
+	for path in paths[:3]:
+		area.stage(path)
+		area.release(path)
+		time.sleep(1.1)
+	inode = os.stat(area.local_path(paths[0])).st_ino
+	area = staging.StagingArea(scratch_dir, quota=3.5 * size, read_ahead=0)
+	for path in [paths[0], paths[3]]:
+		area.stage(path)
+		area.release(path)
+		time.sleep(1.1)
+	staged = [os.path.isfile(area.local_path(path)) for path in paths[:4]]
+	check(staged == [True, False, True, True], "Expected only the copy of {} (least recently used) to be evicted, staged: {}".format(paths[1], staged))
+	check(os.stat(area.local_path(paths[0])).st_ino == inode, "The copy of {} was made again instead of being reused".format(paths[0]))
+
+	# Atomic copies: a copy that fails halfway leaves no partial file behind, and stage() falls back to the source
+	scratch_dir = "{}/scratch_atomic".format(test_dir)
+	area = staging.StagingArea(scratch_dir, quota=10. * size)
+	copy_file = staging.copy_file
+	def failing_copy(path, local_path):
+		with open(local_path, 'wb') as f:
+			f.write("partial")
+		raise IOError("copy interrupted")
+	staging.copy_file = failing_copy
+	try:
+		local_path = area.stage(paths[0])
+	finally:
+		staging.copy_file = copy_file
+	check(local_path == paths[0], "A failed copy should fall back to the source, got {}".format(local_path))
+	check(os.listdir(scratch_dir) == [], "A failed copy left files behind: {}".format(os.listdir(scratch_dir)))
+
+	# The partial copy of a killed process (.part) is never used, and a truncated copy from a previous run is copied again
+	with open("{}.part12345_1".format(area.local_path(paths[1])), 'wb') as f:
+		f.write("partial")
+	with open(area.local_path(paths[2]), 'wb') as f:
+		f.write("truncated")
+	for path in paths[1:3]:
+		local_path = area.stage(path)
+		check(local_path == area.local_path(path) and same_contents(local_path, path), "{} was not staged from the source".format(path))
+		area.release(path)
+	print "[smoke_tests] INFO : staging: OK"
+
+# run_in_process(): call function(*args) in a fresh process. Returns its exit code.
+def run_in_process(function, *args):
+	process = multiprocessing.Process(target=function, args=args)
+	process.start()
+	process.join()
+	return process.exitcode
+
+# run_checkpointed(): run the histogrammer over the input files with checkpoints every checkpoint_events events (resuming from the last one), as run_histograms.py --run --resume does.
+# - kill_after: the process is killed (no cleanup, as in a condor eviction) after this many events
+def run_checkpointed(input_files, output_path, run_args, checkpoint_events=None, kill_after=None):
+	import benchmark
+	import run_histograms
+	histogrammer = run_histograms.make_histogrammer(benchmark.subsample, run_args)
+	for input_file in input_files:
+		histogrammer.add_file(input_file)
+	histogrammer.set_output_path(output_path)
+	if checkpoint_events:
+		histogrammer.set_checkpoint("{}.checkpoint.root".format(output_path), every_events=checkpoint_events, resume=True)
+	if kill_after:
+		process_event = histogrammer.process_event
+		def killed_process_event():
+			if histogrammer._events_processed > kill_after:
+				os._exit(3)
+			return process_event()
+		histogrammer.process_event = killed_process_event
+	histogrammer.start()
+	histogrammer.run()
+	histogrammer.finish()
+
+# test_checkpoint(): checkpoint and resume on synthetic ggNtuples
+def test_checkpoint(test_dir):
+	import benchmark # Imported here, so that the other tests don't need ROOT
+
+	n_events = 5000
+	input_files = synthetic_ntuples.write_ntuples("{}/inputs".format(test_dir), 2, n_events, seed=1)
+	failed = False
+	for loop in ["run", "prefilter", "adaptive"]:
+		run_args = benchmark.run_histograms_args(argparse.Namespace(spec=None), prefilter=(loop == "prefilter"), adaptive_cuts=(loop in ["prefilter", "adaptive"]), adaptive_warmup=2000)
+		reference_path = "{}/{}_reference.root".format(test_dir, loop)
+		output_path = "{}/{}_resumed.root".format(test_dir, loop)
+		checkpoint_path = "{}.checkpoint.root".format(output_path)
+		check(run_in_process(run_checkpointed, input_files, reference_path, run_args) == 0, "{}: the uninterrupted run failed".format(loop))
+
+		# Killed in the second file, after checkpoints in both files (and after the adaptive warm-up), then resumed
+		exit_code = run_in_process(run_checkpointed, input_files, output_path, run_args, 1000, int(1.5 * n_events))
+		check(exit_code == 3, "{}: the killed run exited with code {} instead of 3".format(loop, exit_code))
+		check(os.path.isfile(checkpoint_path), "{}: the killed run left no checkpoint".format(loop))
+		check(run_in_process(run_checkpointed, input_files, output_path, run_args, 1000) == 0, "{}: the resumed run failed".format(loop))
+		check(not os.path.isfile(checkpoint_path), "{}: the checkpoint was not deleted after the resumed run".format(loop))
+
+		differences = benchmark.compare_histograms(benchmark.read_histograms(output_path), benchmark.read_histograms(reference_path), 1.e-9)
+		for difference in differences:
+			print "[smoke_tests] ERROR : checkpoint, {}: {}".format(loop, difference)
+		failed = failed or bool(differences)
+	check(not failed, "The resumed runs don't give the histograms of the uninterrupted runs")
+	print "[smoke_tests] INFO : checkpoint: OK"
+
+# test_condor(): csub --task_list --transfer_on_evict, as called by run_histograms.py --condor_run, with a mock condor_submit
+def test_condor(test_dir):
+	# The tasks are subsamples, as written by run_histograms.py (<task> <JobFlavour> <arguments>)
+	tasks = [("Data_SinglePhoton_Run2016B_0", "workday", "Data_SinglePhoton_Run2016B_0"), ("ZnnG_pt130", "espresso", "ZnnG_pt130")]
+	task_list_path = "{}/condor_tasks.txt".format(test_dir)
+	with open(task_list_path, 'w') as f:
+		for task in tasks:
+			f.write("{} {} {}\n".format(*task))
+	run_script_path = "{}/run_histograms.sh".format(test_dir)
+	with open(run_script_path, 'w') as f:
+		f.write("#!/bin/bash\necho $1\n")
+	mock_path = "{}/mock_condor_submit.py".format(test_dir)
+	with open(mock_path, 'w') as f:
+		f.write(mock_condor_submit)
+
+	# $HOME holds the tarball directory of csub: a fresh one, with no tarball made (--no_retar)
+	submit_dir = "{}/submit".format(test_dir)
+	env = dict(os.environ, HOME=test_dir, CMSSW_VERSION="CMSSW_smoke_test")
+	command = [sys.executable, csub_path, run_script_path, "--task_list", task_list_path, "--cmssw", "--no_retar", "--transfer_on_evict", "-d", submit_dir, "--condor_submit", "{} {}".format(sys.executable, mock_path)]
+	check(subprocess.call(command, env=env) == 0, "csub failed")
+
+	# One condor_submit of one submission file
+	with open("{}/condor_submit_calls.txt".format(submit_dir), 'r') as f:
+		calls = f.read().splitlines()
+	check(len(calls) == 1 and calls[0].endswith(".jdl"), "Expected one condor_submit of one submission file, got {}".format(calls))
+	jdl = {}
+	with open("{}/submitted.jdl".format(submit_dir), 'r') as f:
+		for line in f:
+			if line.startswith("queue"):
+				jdl["queue"] = line.strip()
+			elif "=" in line:
+				key, value = line.split("=", 1)
+				jdl[key.strip()] = value.strip()
+	expected = {
+		"queue": "queue task, flavour, task_arguments from {}".format(task_list_path),
+		"arguments": "$(task_arguments)",
+		"+JobFlavour": "\"$(flavour)\"",
+		"when_to_transfer_output": "on_exit_or_evict",
+	}
+	for key, value in sorted(expected.iteritems()):
+		check(jdl.get(key) == value, "Submission file: {} = {} instead of {}".format(key, jdl.get(key), value))
+	check(all("$(task)." in jdl.get(key, "") for key in ["output", "error", "log"]), "Submission file: the logs are not named after the tasks")
+
+	# The tasks share the run script, the top-level script and one tarball
+	input_files = jdl.get("transfer_input_files", "").split(",")
+	tarballs = [path for path in input_files if path.endswith(".tar.gz")]
+	check(len(tarballs) == 1, "Submission file: expected one tarball in transfer_input_files, got {}".format(input_files))
+	check(run_script_path in input_files and os.path.isfile("{}/{}".format(submit_dir, jdl.get("executable"))), "Submission file: missing run script or top-level script")
+	with open("{}/{}".format(submit_dir, jdl["executable"]), 'r') as f:
+		check("source {} $@\n".format(os.path.basename(run_script_path)) in f.read(), "The top-level script doesn't pass the task arguments to the run script")
+	print "[smoke_tests] INFO : condor: OK"
+
+# run_test(): one test in a child process. Returns True if it passed.
+def run_test(name, args):
+	test_dir = "{}/{}".format(args.work_dir, name)
+	if os.path.isdir(test_dir):
+		shutil.rmtree(test_dir)
+	os.makedirs(test_dir)
+	exit_code = run_in_process(globals()["test_" + name], test_dir)
+	if exit_code != 0:
+		print "[smoke_tests] ERROR : Test {} failed (exit code {})".format(name, exit_code)
+	return exit_code == 0
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Smoke tests of the staging, checkpoints and condor submission')
+	parser.add_argument('--work_dir', type=str, default="/tmp/monophoton_smoke_tests", help='Directory of the test files')
+	parser.add_argument('--tests', type=str, default=",".join(all_tests), help='Tests to run (comma-separated): {}'.format(", ".join(all_tests)))
+	args = parser.parse_args()
+	args.work_dir = os.path.abspath(args.work_dir)
+	tests = args.tests.split(",")
+	for test in tests:
+		if not test in all_tests:
+			print "[smoke_tests] ERROR : Unknown test {}".format(test)
+			sys.exit(1)
+
+	failed = [test for test in tests if not run_test(test, args)]
+	if failed:
+		print "[smoke_tests] ERROR : Failed tests: {}".format(", ".join(failed))
+		sys.exit(1)
+	print "[smoke_tests] INFO : All tests passed ({})".format(", ".join(tests))
@@ -0,0 +1,136 @@
+# Declarative description of the analysis: photon candidates, regions (selections) and histograms.
+# MonoPhotonHistogrammer compiles the spec into a single event loop (see MonoPhotonHistogrammer.start()).
+# - A spec is a python dict (default_spec below), or a JSON/YAML file with the same structure (load_spec()).
+#
+# Structure:
+# - "parameters": {name : number}. Thresholds and weight constants, usable by name in the cut and weight expressions.
+# - "photons": {name : {"id" : photon ID, "choose" : "first" or "last"}}. Photon candidates: the first (highest pT) or last photon passing the ID.
+#       The ID is the name of a photon_id.photon_selections entry, or {"require" : [PhotonIDBits names], "veto" : [PhotonIDBits names]}.
+#       Regions using the same photon candidate share it (and every photon-dependent quantity), so it is only computed once per event.
+# - "regions": [{"name" : ..., "photon" : photon candidate, "cuts" : [expressions], "weight" : expression}]. All cuts are ANDed.
+#       Regions are only filled for events with a photon candidate.
+#       The photon candidate and the cuts are evaluated in order, up to the first one failing (with --adaptive_cuts, in the order of increasing cost per rejection instead, photon cuts after the candidate).
+#       Each region gets <region>_cutflow and <region>_cutflow_weighted histograms with the events passing each step, in that order. If the weight depends on the photon,
+#       the weighted cutflow is only filled from the photon candidate step on (the weight is not defined before it).
+# - "histograms": [{"name" : ..., "variable" : variable name, "bins" : [nbins, xmin, xmax], "xtitle" : axis title, ...}]. Booked once per region.
+#       Optional keys: "title" (TH1 title, default "{region}_{name}"), "weighted" (default true), "require" (boolean variable; only fill where it is true).
+#
+# Parameter variations (run_histograms.py --variations, see load_variations()) fill the regions again with some parameters changed, in the same event loop.
+#
+# Expressions are python expressions over variables and parameters, e.g. "pfmet > pfmet_min" or "r_qcd_constant + r_qcd_slope * photon_pt".
+# They are evaluated both on single events and on NumPy arrays of events (run_columnar), so stick to arithmetic and comparisons (no "and"/"or"/"not": cuts are ANDed, and "x == 0" negates a boolean).
+# Each distinct expression is evaluated at most once per event (per photon candidate if it uses photon variables), however many regions use it.
+#
+# Event variables:  one, pfmet, pfmet_phi, met_filters, signal_triggers, backup_triggers, njets, has_jet, leading_jet_pt, leading_jet_eta, dphi_jet_met_pass
+# Photon variables: photon_pt, photon_eta, photon_SCeta, photon_phi, photon_SCphi, dphi_photon_met, n_electrons, n_muons
+import os
+import json
+import math
+import copy
+
+event_variable_names = ["one", "pfmet", "pfmet_phi", "met_filters", "signal_triggers", "backup_triggers", "njets", "has_jet", "leading_jet_pt", "leading_jet_eta", "dphi_jet_met_pass"]
+photon_variable_names = ["photon_pt", "photon_eta", "photon_SCeta", "photon_phi", "photon_SCphi", "dphi_photon_met", "n_electrons", "n_muons"]
+
+# Event selection shared by the signal region and the background control regions
+_monophoton_cuts = [
+    "signal_triggers",
+    "met_filters == 0",
+    "photon_pt > photon_pt_min",
+    "pfmet > pfmet_min",
+    "dphi_photon_met > dphi_photon_met_min",
+    "n_electrons == 0",
+    "n_muons == 0",
+    "dphi_jet_met_pass",
+]
+
+default_spec = {
+    "parameters": {
+        "photon_pt_min": 175.,
+        "pfmet_min": 170.,
+        "dphi_photon_met_min": 2.,
+        "pfmet_trigger_min": 140.,
+        "r_electronfakes": 0.0184,
+        "r_qcd_constant": 0.079,
+        "r_qcd_slope": 0.00014,
+    },
+    "photons": {
+        # The photons in the ntuple are ordered by pT, so "first" is the highest-pT photon satisfying the |eta| and ID requirements.
+        "nominal": {"id": "nominal", "choose": "first"},
+        # Electron fake selection: different photon selection with pixel seed required
+        "electronfakes": {"id": "electrondenominator", "choose": "last"},
+        # Jet fake selection: different photon selection with very loose && !loose isolation
+        "jetfakes": {"id": "qcddenominator", "choose": "last"},
+    },
+    "regions": [
+        {"name": "sr", "photon": "nominal", "cuts": _monophoton_cuts, "weight": "1."},
+        {"name": "cr_electronfakes", "photon": "electronfakes", "cuts": _monophoton_cuts, "weight": "r_electronfakes"},
+        {"name": "cr_jetfakes", "photon": "jetfakes", "cuts": _monophoton_cuts, "weight": "r_qcd_constant + r_qcd_slope * photon_pt"},
+        # Trigger selections, for computing trigger efficiency
+        {"name": "trigger_denominator", "photon": "nominal", "cuts": ["backup_triggers", "pfmet > pfmet_trigger_min"], "weight": "1."},
+        {"name": "trigger_numerator", "photon": "nominal", "cuts": ["backup_triggers", "pfmet > pfmet_trigger_min", "signal_triggers"], "weight": "1."},
+    ],
+    "histograms": [
+        {"name": "events_passed", "variable": "one", "bins": [1, 0.5, 1.5], "weighted": False},
+        {"name": "events_passed_weighted", "variable": "one", "bins": [1, 0.5, 1.5]},
+        {"name": "photon_pt", "variable": "photon_pt", "bins": [200, 0., 1000.], "xtitle": "#gamma p_{T} [GeV]"},
+        {"name": "photon_eta", "variable": "photon_eta", "bins": [60, -1.5, 1.5], "xtitle": "#gamma #eta"},
+        {"name": "photon_SCeta", "variable": "photon_SCeta", "bins": [60, -1.5, 1.5], "xtitle": "#gamma #eta_{SC}"},
+        {"name": "photon_phi", "variable": "photon_phi", "bins": [100, -1.1 * math.pi, 1.1 * math.pi], "xtitle": "#gamma #phi"},
+        {"name": "photon_SCphi", "variable": "photon_SCphi", "bins": [120, -1.1 * math.pi, 1.1 * math.pi], "xtitle": "#gamma #phi_{SC}"},
+        {"name": "pfmet", "variable": "pfmet", "bins": [100, 0., 1000.], "xtitle": "PF MET [GeV]", "title": "{region}_photon_pfmet"},
+        {"name": "dphi_photon_met", "variable": "dphi_photon_met", "bins": [100, 0., math.pi], "xtitle": "#Delta#phi(#gamma, PF MET)"},
+        {"name": "njets", "variable": "njets", "bins": [21, -0.5, 20.5], "xtitle": "n_{jets}"},
+        {"name": "leading_jet_pt", "variable": "leading_jet_pt", "bins": [50, 0., 1000.], "xtitle": "Leading jet p_{T} [GeV]", "require": "has_jet"},
+        {"name": "leading_jet_eta", "variable": "leading_jet_eta", "bins": [50, -5., 5.], "xtitle": "Leading jet #eta", "require": "has_jet"},
+    ],
+}
+
+# load_spec(): load a spec from a JSON or YAML file. Missing top-level sections are taken from default_spec.
+def load_spec(path):
+    with open(path, 'r') as f:
+        if os.path.splitext(path)[1] in [".yaml", ".yml"]:
+            import yaml
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    for section in default_spec:
+        if not section in spec:
+            spec[section] = copy.deepcopy(default_spec[section])
+    return spec
+
+# Variations of the default spec parameters, for MonoPhotonHistogrammer.set_variations(): [{"name" : ..., "parameters" : {parameter : value}}]
+# - Every region whose cuts or weight use a varied parameter gets its histograms again for each variation, as <region>_<histogram>_<variation>.
+# - The fake rate scale factors by +-10%, and the photon pT and MET thresholds by +-10 GeV.
+default_variations = [
+    {"name": "r_electronfakes_up", "parameters": {"r_electronfakes": 0.0184 * 1.1}},
+    {"name": "r_electronfakes_down", "parameters": {"r_electronfakes": 0.0184 * 0.9}},
+    {"name": "r_qcd_up", "parameters": {"r_qcd_constant": 0.079 * 1.1, "r_qcd_slope": 0.00014 * 1.1}},
+    {"name": "r_qcd_down", "parameters": {"r_qcd_constant": 0.079 * 0.9, "r_qcd_slope": 0.00014 * 0.9}},
+    {"name": "photon_pt_min_up", "parameters": {"photon_pt_min": 185.}},
+    {"name": "photon_pt_min_down", "parameters": {"photon_pt_min": 165.}},
+    {"name": "pfmet_min_up", "parameters": {"pfmet_min": 180.}},
+    {"name": "pfmet_min_down", "parameters": {"pfmet_min": 160.}},
+]
+
+# load_variations(): load parameter variations from a JSON or YAML file (a list like default_variations), or default_variations for "default"
+def load_variations(path):
+    if path == "default":
+        return copy.deepcopy(default_variations)
+    with open(path, 'r') as f:
+        if os.path.splitext(path)[1] in [".yaml", ".yml"]:
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+# CompiledExpression: a spec expression, compiled once
+# - photon_dependent: the expression uses photon variables, so its value depends on the photon candidate
+class CompiledExpression:
+    def __init__(self, expression):
+        self.expression = str(expression)
+        self.code = compile(self.expression, "<spec expression>", "eval")
+        self.photon_dependent = any(name in photon_variable_names for name in self.code.co_names)
+
+    def evaluate(self, namespace):
+        return eval(self.code, _expression_globals, namespace)
+
+_expression_globals = {"__builtins__": {}, "abs": abs, "True": True, "False": False}
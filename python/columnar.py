@@ -0,0 +1,132 @@
+# Columnar (chunked NumPy) access to ggNtuples
+# - Reads the ggNtuplizer/EventTree branches in entry-range chunks, instead of one GetEntry() per event.
+# - Per-object branches (std::vector<...>) are returned as Jagged arrays: a flat array of values, plus per-event offsets.
+# - The helpers below implement the handful of jagged operations the histogrammer needs (first/last object passing a mask, counting, picking one object per event).
+
+import numpy as np
+
+from MonoPhoton.DASAnalysis.job_splitter import split_entry_range
+
+try:
+    import uproot
+except ImportError:
+    uproot = None
+
+class Jagged(object):
+    def __init__(self, offsets, content):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.content = np.asarray(content)
+
+    @classmethod
+    def from_counts(cls, counts, content):
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(offsets, content)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    # parents: event index of each flat element
+    @property
+    def parents(self):
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.counts)
+
+    # local_index: position of each flat element inside its event
+    @property
+    def local_index(self):
+        return np.arange(len(self.content), dtype=np.int64) - np.repeat(self.offsets[:-1], self.counts)
+
+    # with_content(): a jagged array with the same structure, but different (flat) values
+    def with_content(self, content):
+        return Jagged(self.offsets, content)
+
+    # broadcast(): repeat one value per event onto each object of the event
+    def broadcast(self, per_event_values):
+        return np.repeat(per_event_values, self.counts)
+
+    # any(), count(): per-event reductions of a flat boolean mask
+    def count(self, mask):
+        return np.bincount(self.parents[mask], minlength=len(self))
+
+    def any(self, mask):
+        return self.count(mask) > 0
+
+    # first_index(), last_index(): local index of the first/last object passing the mask, or -1 if none
+    def first_index(self, mask):
+        result = np.full(len(self), -1, dtype=np.int64)
+        positions = np.flatnonzero(mask)
+        if len(positions):
+            events, first = np.unique(self.parents[positions], return_index=True)
+            result[events] = positions[first] - self.offsets[events]
+        return result
+
+    def last_index(self, mask):
+        result = np.full(len(self), -1, dtype=np.int64)
+        positions = np.flatnonzero(mask)[::-1]
+        if len(positions):
+            events, last = np.unique(self.parents[positions], return_index=True)
+            result[events] = positions[last] - self.offsets[events]
+        return result
+
+    # take(): value of the object at local_index in each event (default where the index is out of range)
+    def take(self, local_index, default=np.nan):
+        local_index = np.asarray(local_index)
+        valid = (local_index >= 0) & (local_index < self.counts)
+        result = np.full(len(self), default, dtype=np.result_type(self.content.dtype, type(default)))
+        result[valid] = self.content[self.offsets[:-1][valid] + local_index[valid]]
+        return result
+
+    # slice_events(): jagged array restricted to events [start, stop)
+    def slice_events(self, start, stop):
+        offsets = self.offsets[start:stop + 1]
+        return Jagged(offsets - offsets[0], self.content[offsets[0]:offsets[-1]])
+
+# RootChunkReader: iterates over the entries of a list of ROOT files in chunks, returning {branch : array or Jagged}
+# - Floating point branches are converted to float64, so that the vectorized selection sees the same numbers as PyROOT.
+class RootChunkReader(object):
+    def __init__(self, input_files, tree_name="ggNtuplizer/EventTree"):
+        if uproot is None:
+            raise ImportError("[RootChunkReader::__init__] ERROR : Columnar reading requires uproot, which is not available in this environment.")
+        self._input_files = list(input_files)
+        self._tree_name = tree_name
+
+    # iterate(): yields (chunk_start, chunk_stop, arrays), where chunk_start/stop count the entries processed so far (over all files)
+    # - Input files can be restricted to an entry range, "<path>#<first entry>-<last entry>" (see job_splitter.py)
+    def iterate(self, branches, chunk_size=100000, max_events=-1):
+        global_offset = 0
+        for input_file in self._input_files:
+            path, first_entry, last_entry = split_entry_range(input_file)
+            tree = uproot.open(path)[self._tree_name]
+            if last_entry is None or last_entry > tree.numentries:
+                last_entry = tree.numentries
+            for start in xrange(first_entry, last_entry, chunk_size):
+                stop = min(start + chunk_size, last_entry)
+                if max_events > 0:
+                    stop = min(stop, start + max_events - (global_offset + start - first_entry))
+                if stop <= start:
+                    return
+                arrays = tree.arrays(branches, entrystart=start, entrystop=stop, namedecode="utf-8")
+                yield global_offset + start - first_entry, global_offset + stop - first_entry, dict((branch, convert_array(arrays[branch])) for branch in branches)
+            global_offset += last_entry - first_entry
+            if max_events > 0 and global_offset >= max_events:
+                return
+
+# convert_array(): converts an uproot array into a numpy array (scalar branches) or Jagged (vector branches)
+def convert_array(array):
+    if hasattr(array, "counts"):
+        content = np.asarray(array.flatten())
+        if content.dtype.kind == "f":
+            content = content.astype(np.float64)
+        return Jagged.from_counts(np.asarray(array.counts), content)
+    array = np.asarray(array)
+    if array.dtype.kind == "f":
+        array = array.astype(np.float64)
+    return array
+
+# delta_phi(): |delta phi| mapped onto [0, pi], i.e. the vectorized version of acos(cos(delta phi))
+def delta_phi(phi1, phi2):
+    return np.arccos(np.cos(phi1 - phi2))
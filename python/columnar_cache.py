@@ -0,0 +1,135 @@
+# Columnar cache of ggNtuples: the analysis branches of each input file, converted once into NumPy .npy files
+# - Later runs memory-map the .npy files (np.load(mmap_mode="r")), so there is no ROOT decompression and no PyROOT object overhead, and the chunks are views into the page cache.
+# - Scalar branches are one <branch>.npy array. Per-object branches (std::vector<...>) are <branch>.offsets.npy (int64, one more than the number of events) plus <branch>.content.npy (flat values),
+#   i.e. the same layout as columnar.Jagged.
+# - float32: floating point branches are stored as float32 (half the size). The ggNtuple branches are floats, so no precision is lost; CachedChunkReader converts them back to float64
+#   by default, so that run_columnar() gives the same histograms as with RootChunkReader.
+# - One directory per input file, with a meta.json (source file, file_fingerprint(), number of entries, branches). Written to a temporary directory and renamed, so a cache entry is either complete or missing.
+#   An entry whose source file changed (different fingerprint) is not used.
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+from MonoPhoton.DASAnalysis.columnar import Jagged, RootChunkReader
+from MonoPhoton.DASAnalysis.histogram_cache import file_fingerprint
+from MonoPhoton.DASAnalysis.job_splitter import split_entry_range
+
+# cache_entry_dir(): directory of the cache entry of an input file (entry ranges share the entry of the whole file)
+def cache_entry_dir(cache_dir, input_file):
+    path = split_entry_range(input_file)[0]
+    return os.path.join(cache_dir, "{}_{}".format(hashlib.sha1(path).hexdigest()[:16], os.path.splitext(os.path.basename(path))[0]))
+
+# load_cache_meta(): meta.json of the cache entry of an input file, or None if there is no up-to-date entry
+def load_cache_meta(cache_dir, input_file, branches=None):
+    meta_path = os.path.join(cache_entry_dir(cache_dir, input_file), "meta.json")
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta["fingerprint"] != file_fingerprint(split_entry_range(input_file)[0]):
+        return None
+    if branches is not None and not set(branches) <= set(meta["branches"]):
+        return None
+    return meta
+
+# convert_file(): write the cache entry of an input file (the whole file, also for entry ranges)
+def convert_file(cache_dir, input_file, branches, tree_name="ggNtuplizer/EventTree", float32=False, chunk_size=100000):
+    path = split_entry_range(input_file)[0]
+    entry_dir = cache_entry_dir(cache_dir, path)
+    chunks = dict((branch, []) for branch in branches)
+    entries = 0
+    for chunk_start, chunk_stop, arrays in RootChunkReader([path], tree_name=tree_name).iterate(branches, chunk_size=chunk_size):
+        entries = chunk_stop
+        for branch in branches:
+            chunks[branch].append(arrays[branch])
+
+    tmp_dir = "{}.tmp{}".format(entry_dir, os.getpid())
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    branch_types = {}
+    for branch in branches:
+        if chunks[branch] and isinstance(chunks[branch][0], Jagged):
+            counts = np.concatenate([chunk.counts for chunk in chunks[branch]])
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            np.save(os.path.join(tmp_dir, "{}.offsets.npy".format(branch)), offsets)
+            np.save(os.path.join(tmp_dir, "{}.content.npy".format(branch)), downcast(np.concatenate([chunk.content for chunk in chunks[branch]]), float32))
+            branch_types[branch] = "jagged"
+        else:
+            np.save(os.path.join(tmp_dir, "{}.npy".format(branch)), downcast(np.concatenate(chunks[branch]) if chunks[branch] else np.empty(0), float32))
+            branch_types[branch] = "scalar"
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as f:
+        json.dump({"source": path, "fingerprint": file_fingerprint(path), "entries": entries, "branches": branch_types, "float32": float32}, f, indent=1, sort_keys=True)
+    if os.path.isdir(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.rename(tmp_dir, entry_dir)
+    print "[convert_file] INFO : Converted {} ({} entries) into {}".format(path, entries, entry_dir)
+    return entry_dir
+
+def downcast(array, float32):
+    if float32 and array.dtype.kind == "f":
+        return array.astype(np.float32)
+    return array
+
+# CachedChunkReader: same interface as columnar.RootChunkReader, reading from the columnar cache
+# - Input files without an up-to-date cache entry are read from ROOT (with a warning).
+# - upcast: convert float32 branches back to float64 (one copy per chunk). With upcast=False, float32 chunks are views into the memory-mapped files, and the selection runs in float32.
+class CachedChunkReader(object):
+    def __init__(self, input_files, cache_dir, tree_name="ggNtuplizer/EventTree", upcast=True):
+        self._input_files = list(input_files)
+        self._cache_dir = cache_dir
+        self._tree_name = tree_name
+        self._upcast = upcast
+
+    # iterate(): yields (chunk_start, chunk_stop, arrays), as RootChunkReader.iterate()
+    def iterate(self, branches, chunk_size=100000, max_events=-1):
+        global_offset = 0
+        for input_file in self._input_files:
+            remaining = max_events - global_offset if max_events > 0 else -1
+            meta = load_cache_meta(self._cache_dir, input_file, branches)
+            if meta is None:
+                print "[CachedChunkReader::iterate] WARNING : No columnar cache entry for {}, reading it from ROOT".format(input_file)
+                file_chunks = RootChunkReader([input_file], tree_name=self._tree_name).iterate(branches, chunk_size=chunk_size, max_events=remaining)
+            else:
+                file_chunks = self.iterate_entry(input_file, meta, branches, chunk_size, remaining)
+            file_entries = 0
+            for chunk_start, chunk_stop, arrays in file_chunks:
+                file_entries = chunk_stop
+                yield global_offset + chunk_start, global_offset + chunk_stop, arrays
+            global_offset += file_entries
+            if max_events > 0 and global_offset >= max_events:
+                return
+
+    # iterate_entry(): chunks of one cache entry, restricted to the entry range of the input file
+    def iterate_entry(self, input_file, meta, branches, chunk_size, max_events):
+        entry_dir = cache_entry_dir(self._cache_dir, input_file)
+        columns = {}
+        for branch in branches:
+            if meta["branches"][branch] == "jagged":
+                columns[branch] = Jagged(np.load(os.path.join(entry_dir, "{}.offsets.npy".format(branch)), mmap_mode="r"), np.load(os.path.join(entry_dir, "{}.content.npy".format(branch)), mmap_mode="r"))
+            else:
+                columns[branch] = np.load(os.path.join(entry_dir, "{}.npy".format(branch)), mmap_mode="r")
+
+        path, first_entry, last_entry = split_entry_range(input_file)
+        if last_entry is None or last_entry > meta["entries"]:
+            last_entry = meta["entries"]
+        if max_events > 0:
+            last_entry = min(last_entry, first_entry + max_events)
+        for start in xrange(first_entry, last_entry, chunk_size):
+            stop = min(start + chunk_size, last_entry)
+            arrays = {}
+            for branch in branches:
+                if isinstance(columns[branch], Jagged):
+                    arrays[branch] = columns[branch].slice_events(start, stop)
+                    arrays[branch].content = self.upcast(arrays[branch].content)
+                else:
+                    arrays[branch] = self.upcast(columns[branch][start:stop])
+            yield start - first_entry, stop - first_entry, arrays
+
+    def upcast(self, array):
+        if self._upcast and array.dtype == np.float32:
+            return array.astype(np.float64)
+        return array
@@ -0,0 +1,248 @@
+# Input file catalogue: per-file metadata of the ntuples, in a local SQLite database
+# - Filled once (in parallel) by opening each input file, then refreshed incrementally: only new files, local files whose size/mtime changed, and xrootd files whose size or
+#   checksum changed (asked with xrdfs, see remote_fingerprint()) are opened again. refresh(force=True) rescans everything.
+# - Asking the server costs two round trips per file, so a known xrootd file is only checked when its last scan or check is older than remote_max_age
+#   (default_remote_max_age, or 0 to check them all). xrootd files the server can't stat are kept as they are.
+# - Files that couldn't be scanned are removed from the catalogue, and returned by refresh(): their metadata would be missing or stale.
+# - Lets the runner, the job splitter and the normalization use the number of entries, the hEvents sums, sizes and cluster boundaries without reopening the files over xrootd.
+#
+# Input files restricted to an entry range ("<path>#<first>-<last>", see job_splitter.py) share the catalogue entry of the whole file.
+#
+# Per file: subsample, entries, size, mtime (local files), ROOT file UUID, checksum (adler32, local files or xrootd), TTree cluster boundaries,
+#   hEvents (class, binning and bin contents), the number of events processed by the skim (skims only, see MonoPhotonHistogrammer.skim()), and the time of the last scan
+#   (or of the last check, for xrootd files).
+import os
+import json
+import time
+import zlib
+import sqlite3
+import subprocess
+import multiprocessing
+
+from MonoPhoton.DASAnalysis.job_splitter import split_entry_range
+
+default_catalogue_path = os.path.expandvars("$CMSSW_BASE/../data/catalogue.sqlite")
+
+# Seconds after which refresh() checks a known xrootd file for changes again
+default_remote_max_age = 7 * 86400.
+
+# scan_file(): open an input file and read its metadata. Returns a dict with the catalogue columns.
+def scan_file(path, tree_name="ggNtuplizer/EventTree"):
+    from ROOT import TFile
+    f = TFile.Open(path, "READ")
+    if not f or f.IsZombie():
+        raise IOError("[scan_file] ERROR : Couldn't open {}".format(path))
+    tree = f.Get(tree_name)
+    entries = tree.GetEntries()
+
+    # Cluster boundaries: entry numbers where the TTree baskets of all branches start, i.e. the natural split points for entry ranges
+    cluster_boundaries = []
+    cluster_iterator = tree.GetClusterIterator(0)
+    cluster_start = cluster_iterator.Next()
+    while cluster_start < entries:
+        cluster_boundaries.append(cluster_start)
+        cluster_start = cluster_iterator.Next()
+    cluster_boundaries.append(entries)
+
+    hEvents = f.Get("ggNtuplizer/hEvents")
+    h_skim_events_processed = f.Get("ggNtuplizer/skim_events_processed")
+    info = {
+        "path": path,
+        "entries": entries,
+        "size": os.path.getsize(path) if os.path.isfile(path) else f.GetSize(),
+        "mtime": os.path.getmtime(path) if os.path.isfile(path) else None,
+        "uuid": f.GetUUID().AsString(),
+        "cluster_boundaries": cluster_boundaries,
+        "hevents": {
+            "class": hEvents.ClassName(),
+            "title": hEvents.GetTitle(),
+            "bins": [hEvents.GetNbinsX(), hEvents.GetXaxis().GetXmin(), hEvents.GetXaxis().GetXmax()],
+            "contents": [hEvents.GetBinContent(i) for i in xrange(hEvents.GetNbinsX() + 2)],
+            "sumw2": [hEvents.GetSumw2().At(i) for i in xrange(hEvents.GetNbinsX() + 2)] if hEvents.GetSumw2N() else None,
+            "entries": hEvents.GetEntries(),
+        } if hEvents else None,
+        "skim_events_processed": int(h_skim_events_processed.GetBinContent(1)) if h_skim_events_processed else None,
+    }
+    f.Close()
+    info["checksum"] = file_checksum(path)
+    return info
+
+# file_checksum(): adler32 of a file, computed locally or asked from the xrootd server (None if not available)
+def file_checksum(path):
+    if os.path.isfile(path):
+        checksum = 1
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                checksum = zlib.adler32(block, checksum)
+        return "{:08x}".format(checksum & 0xffffffff)
+    if path.startswith("root://"):
+        server, remote_path = path[len("root://"):].split("/", 1)
+        try:
+            output = subprocess.check_output(["xrdfs", server, "query", "checksum", "/" + remote_path.lstrip("/")], stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        fields = output.split()
+        if len(fields) == 2 and fields[0] == "adler32":
+            return fields[1]
+    return None
+
+# remote_size(): size in bytes of a root:// file from the xrootd server (xrdfs stat), or None if the server can't stat it
+def remote_size(path):
+    server, remote_path = path[len("root://"):].split("/", 1)
+    try:
+        output = subprocess.check_output(["xrdfs", server, "stat", "/" + remote_path.lstrip("/")], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == "Size:":
+            return int(fields[1])
+    return None
+
+# remote_fingerprint(): (size, adler32 checksum or None) of a root:// file from the xrootd server, or None if the server can't stat it
+def remote_fingerprint(path):
+    size = remote_size(path)
+    if size is None:
+        return None
+    return size, file_checksum(path)
+
+def _scan_file_safe(path):
+    try:
+        return path, scan_file(path), None
+    except Exception as error:
+        return path, None, str(error)
+
+class FileCatalogue(object):
+    def __init__(self, path=default_catalogue_path):
+        self._path = path
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, subsample TEXT, entries INTEGER, size INTEGER, mtime REAL, uuid TEXT, checksum TEXT,
+            cluster_boundaries TEXT, hevents TEXT, skim_events_processed INTEGER, scanned REAL)""")
+        self._connection.commit()
+
+    # refresh(): scan the files of {subsample : [input files]} that are missing from the catalogue, or stale (see above), on n_jobs processes
+    # - force: rescan all files
+    # - remote_max_age: known xrootd files are checked for changes if they were scanned or checked longer ago than this (seconds). None: never checked.
+    # - Returns the files that couldn't be scanned (removed from the catalogue)
+    def refresh(self, subsample_files, n_jobs=8, force=False, remote_max_age=default_remote_max_age):
+        known = dict((row[0], (row[1], row[2], row[3], row[4])) for row in self._connection.execute("SELECT path, size, mtime, checksum, scanned FROM files"))
+        file_subsamples = {}
+        to_scan = []
+        remote_known = []
+        for subsample, input_files in subsample_files.iteritems():
+            for input_file in set(split_entry_range(input_file)[0] for input_file in input_files):
+                if input_file in file_subsamples:
+                    continue
+                file_subsamples[input_file] = subsample
+                if force or not input_file in known:
+                    to_scan.append(input_file)
+                elif os.path.isfile(input_file):
+                    stat = os.stat(input_file)
+                    if (stat.st_size, stat.st_mtime) != known[input_file][:2]:
+                        to_scan.append(input_file)
+                elif input_file.startswith("root://") and remote_max_age is not None and time.time() - (known[input_file][3] or 0.) >= remote_max_age:
+                    remote_known.append(input_file)
+        failed = []
+        if not to_scan and not remote_known:
+            return failed
+        pool = multiprocessing.Pool(max(1, min(n_jobs, len(to_scan) + len(remote_known))))
+        try:
+            if remote_known:
+                print "[FileCatalogue::refresh] INFO : Checking {} xrootd files for changes".format(len(remote_known))
+                for path, fingerprint in zip(remote_known, pool.map(remote_fingerprint, remote_known)):
+                    size, mtime, checksum, scanned = known[path]
+                    if fingerprint and (fingerprint[0] != size or (fingerprint[1] and checksum and fingerprint[1] != checksum)):
+                        to_scan.append(path)
+                    elif fingerprint:
+                        self._connection.execute("UPDATE files SET scanned = ? WHERE path = ?", (time.time(), path))
+            if to_scan:
+                print "[FileCatalogue::refresh] INFO : Scanning {} files on {} processes".format(len(to_scan), n_jobs)
+            for i, (path, info, error) in enumerate(pool.imap_unordered(_scan_file_safe, to_scan)):
+                if error:
+                    print "[FileCatalogue::refresh] WARNING : {}".format(error)
+                    self._connection.execute("DELETE FROM files WHERE path = ?", (path,))
+                    failed.append(path)
+                    continue
+                self.insert(info, file_subsamples[path])
+                if (i + 1) % 100 == 0:
+                    self._connection.commit()
+                    print "[FileCatalogue::refresh] INFO : Scanned {} / {} files".format(i + 1, len(to_scan))
+        finally:
+            pool.close()
+            pool.join()
+            self._connection.commit()
+        return sorted(failed)
+
+    def insert(self, info, subsample):
+        self._connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            info["path"], subsample, info["entries"], info["size"], info["mtime"], info["uuid"], info["checksum"],
+            json.dumps(info["cluster_boundaries"]), json.dumps(info["hevents"]), info["skim_events_processed"], time.time()))
+
+    # file_info(): catalogue entry of an input file, as a dict (None if not in the catalogue)
+    # - For entry ranges, the entry of the whole file, plus "first_entry" and "last_entry"
+    def file_info(self, input_file):
+        path, first_entry, last_entry = split_entry_range(input_file)
+        cursor = self._connection.execute("SELECT * FROM files WHERE path = ?", (path,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        info = dict(zip([column[0] for column in cursor.description], row))
+        info["cluster_boundaries"] = json.loads(info["cluster_boundaries"])
+        info["hevents"] = json.loads(info["hevents"])
+        info["first_entry"] = first_entry
+        info["last_entry"] = last_entry if last_entry is not None else info["entries"]
+        return info
+
+    def files_info(self, paths):
+        infos = []
+        for path in paths:
+            info = self.file_info(path)
+            if not info:
+                raise KeyError("[FileCatalogue::files_info] ERROR : {} is not in the catalogue {}. Refresh the catalogue first.".format(path, self._path))
+            infos.append(info)
+        return infos
+
+    # events_processed(): number of events of the original ntuples corresponding to a list of input files (for skims, including the events removed by the skim)
+    # - Entry ranges count their own entries. For skims, the events removed by the skim are counted with the range starting at entry 0.
+    def events_processed(self, paths):
+        events_processed = 0
+        for info in self.files_info(paths):
+            events_processed += info["last_entry"] - info["first_entry"]
+            if info["skim_events_processed"] is not None and info["first_entry"] == 0:
+                events_processed += info["skim_events_processed"] - info["entries"]
+        return events_processed
+
+    # sum_hEvents(): sum of the ggNtuplizer/hEvents histograms of a list of input files, rebuilt from the catalogue (same as adding up the histograms from the files)
+    # - The hEvents of a file split into entry ranges is counted once, with the range starting at entry 0
+    def sum_hEvents(self, paths):
+        import ROOT
+        hEvents = None
+        for info in self.files_info(paths):
+            h = info["hevents"]
+            if not h or info["first_entry"] != 0:
+                continue
+            if not hEvents:
+                hEvents = getattr(ROOT, h["class"])("hEvents", h["title"], *h["bins"])
+                hEvents.SetDirectory(0)
+                contents = [0.] * len(h["contents"])
+                sumw2 = None
+                entries = 0.
+            if h["sumw2"] and sumw2 is None:
+                sumw2 = list(contents) # As TH1::Add(): a histogram without Sumw2 has sumw2 = contents
+            for i in xrange(len(contents)):
+                contents[i] += h["contents"][i]
+                if sumw2 is not None:
+                    sumw2[i] += h["sumw2"][i] if h["sumw2"] else h["contents"][i]
+            entries += h["entries"]
+        if hEvents:
+            if sumw2 is not None:
+                hEvents.Sumw2()
+            for i in xrange(len(contents)):
+                hEvents.SetBinContent(i, contents[i])
+                if sumw2 is not None:
+                    hEvents.GetSumw2().SetAt(sumw2[i], i)
+            hEvents.SetEntries(entries)
+        return hEvents
@@ -0,0 +1,48 @@
+# Buffered histogram filling
+# - Each PyROOT TH1::Fill() call is a Python->C++ crossing, which costs more than the filling itself.
+# - FillBuffer collects (value, weight) pairs in preallocated arrays, and hands them to ROOT in a single TH1::FillN() call when the buffer is full, or when flush() is called.
+# - TH1::FillN() does exactly the same per-entry bookkeeping as TH1::Fill(x, w) (bin contents, Sumw2, under/overflow, statistics), so the histograms are identical to unbuffered filling.
+import numpy as np
+
+class FillBuffer(object):
+    def __init__(self, histogram, size=10000):
+        self._histogram = histogram
+        self._values = np.empty(size, dtype=np.float64)
+        self._weights = np.empty(size, dtype=np.float64)
+        self._n = 0
+
+    @property
+    def histogram(self):
+        return self._histogram
+
+    # fill(): buffer a single entry
+    def fill(self, value, weight=1.):
+        self._values[self._n] = value
+        self._weights[self._n] = weight
+        self._n += 1
+        if self._n == len(self._values):
+            self.flush()
+
+    # fill_array(): fill an array of entries (e.g. from the columnar event loop). The pending entries are flushed first, to keep the filling order.
+    def fill_array(self, values, weights):
+        self.flush()
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        weights = np.ascontiguousarray(np.broadcast_to(weights, values.shape), dtype=np.float64)
+        if len(values):
+            self._histogram.FillN(len(values), values, weights)
+
+    # flush(): fill the buffered entries into the histogram
+    def flush(self):
+        if self._n:
+            self._histogram.FillN(self._n, self._values, self._weights)
+            self._n = 0
+
+# make_fill_buffers(): {selection : {histogram name : FillBuffer}} for a {selection : {histogram name : histogram}} dictionary
+def make_fill_buffers(histograms, size=10000):
+    return dict((selection, dict((name, FillBuffer(histogram, size)) for name, histogram in histograms[selection].iteritems())) for selection in histograms)
+
+# flush_fill_buffers(): flush all buffers of a make_fill_buffers() dictionary
+def flush_fill_buffers(fill_buffers):
+    for selection_buffers in fill_buffers.itervalues():
+        for fill_buffer in selection_buffers.itervalues():
+            fill_buffer.flush()
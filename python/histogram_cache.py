@@ -0,0 +1,125 @@
+# Per-input-file histogram cache
+# - run_histograms.py --cache_dir runs the histogrammer on one input file at a time, and stores the output histograms of each file here.
+# - Entries are keyed by the input file (path, plus size/mtime for local files or size/checksum for remote files, see file_fingerprint()) and a hash of the selection code and config (see selection_hash()).
+#   Changing the spec, the selection code or an input file makes the old entries stale: they are simply never looked up again, and are evicted eventually.
+# - Reruns only process the missing files, and merge the rest from the cache. Extending an input list only processes the new files.
+# - The cache size is bounded: the least recently used entries are deleted first (see HistogramCache.evict()).
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from MonoPhoton.DASAnalysis.job_splitter import split_entry_range
+from MonoPhoton.DASAnalysis.file_catalogue import remote_fingerprint
+
+# file_fingerprint(): identifies the contents of an input file, without reading it
+# - Local files: size and mtime.
+# - Remote files (xrootd): size and adler32 checksum, from the file catalogue if given (see file_catalogue.py), otherwise asked from the server (see remote_fingerprint()).
+#   Only if the server has no checksum, the file is opened for the UUID written into it when it was created (the catalogue has it too).
+# - For entry ranges (see job_splitter.py), the file itself. The range is part of the cache key through the input file name.
+def file_fingerprint(input_file, catalogue=None):
+    path = split_entry_range(input_file)[0]
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return "{}:{}".format(stat.st_size, int(stat.st_mtime))
+    info = catalogue.file_info(path) if catalogue else None
+    if info:
+        return "{}:adler32:{}".format(info["size"], info["checksum"]) if info["checksum"] else "{}:{}".format(info["size"], info["uuid"])
+    fingerprint = remote_fingerprint(path) if path.startswith("root://") else None
+    if fingerprint and fingerprint[1]:
+        return "{}:adler32:{}".format(*fingerprint)
+    from ROOT import TFile
+    f = TFile.Open(path, "READ")
+    if not f:
+        raise IOError("[file_fingerprint] ERROR : Couldn't open {}".format(path))
+    fingerprint = "{}:{}".format(f.GetSize(), f.GetUUID().AsString())
+    f.Close()
+    return fingerprint
+
+# source_files(): paths of the .py source files of a list of modules
+def source_files(*modules):
+    return [os.path.splitext(module.__file__)[0] + ".py" for module in modules]
+
+# selection_hash(): hash of the selection code (source files) and configuration (any JSON-serializable object, e.g. the spec)
+def selection_hash(code_files, config):
+    selection_hash = hashlib.sha1()
+    for code_file in sorted(code_files):
+        with open(code_file, 'rb') as f:
+            selection_hash.update(f.read())
+    selection_hash.update(json.dumps(config, sort_keys=True))
+    return selection_hash.hexdigest()
+
+class HistogramCache(object):
+    def __init__(self, cache_dir, max_size=20e9):
+        self._cache_dir = cache_dir
+        self._max_size = max_size # Bytes
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+    # key(): cache key of the histograms of input_file for the given selection_hash(). catalogue: FileCatalogue for the fingerprint of remote files, or None.
+    def key(self, input_file, selection_hash, catalogue=None):
+        return hashlib.sha1("{}\n{}\n{}".format(input_file, file_fingerprint(input_file, catalogue), selection_hash)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self._cache_dir, "{}.root".format(key))
+
+    # get(): path of the cached histogram file, or None. Marks the entry as recently used.
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        os.utime(path, None)
+        return path
+
+    # put(): move a histogram file into the cache. The move is atomic, so an interrupted run never leaves a partial entry.
+    def put(self, key, histogram_file):
+        tmp_path = self.path(key) + ".tmp{}".format(os.getpid())
+        shutil.move(histogram_file, tmp_path)
+        os.rename(tmp_path, self.path(key))
+        return self.path(key)
+
+    # evict(): delete the least recently used entries, until the cache fits in max_size
+    # - Also deletes the temporary files of put() older than stale_tmp_seconds, left behind by killed processes (e.g. abandoned speculative attempts, see task_scheduler.py)
+    def evict(self, stale_tmp_seconds=3600.):
+        entries = []
+        for filename in os.listdir(self._cache_dir):
+            path = os.path.join(self._cache_dir, filename)
+            if filename.endswith(".root"):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+            elif ".root.tmp" in filename and time.time() - os.path.getmtime(path) > stale_tmp_seconds:
+                os.remove(path)
+                print "[HistogramCache::evict] INFO : Deleted the stale temporary file {}".format(path)
+        total_size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            os.remove(path)
+            total_size -= size
+            print "[HistogramCache::evict] INFO : Evicted {}".format(path)
+        return total_size
+
+# merge_histogram_files(): add up the histograms of several files (in order), and write them to output_path
+def merge_histogram_files(input_paths, output_path):
+    from ROOT import TFile
+    merged_histograms = {}
+    histogram_names = []
+    for input_path in input_paths:
+        input_file = TFile.Open(input_path, "READ")
+        for key in input_file.GetListOfKeys():
+            if not "TH" in key.GetClassName():
+                continue
+            histogram = key.ReadObj()
+            if key.GetName() in merged_histograms:
+                merged_histograms[key.GetName()].Add(histogram)
+            else:
+                merged_histograms[key.GetName()] = histogram.Clone()
+                merged_histograms[key.GetName()].SetDirectory(0)
+                histogram_names.append(key.GetName())
+        input_file.Close()
+
+    output_file = TFile(output_path, "RECREATE")
+    for histogram_name in histogram_names:
+        merged_histograms[histogram_name].Write()
+    output_file.Close()
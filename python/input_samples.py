@@ -10,6 +10,8 @@ import os
 import sys
 from glob import glob
 
+from MonoPhoton.DASAnalysis.job_splitter import load_jobs
+
 background_samples = ["WGJets", "ZLLGJets", "ZNuNuGJets", "WToMuNu", "WToTauNu", "GJets"] # WToENu
 signal_samples = ["ADD1", "ADD2", "ADD3"]
 all_samples = ["data"] + background_samples + signal_samples
@@ -36,16 +38,57 @@ def get_input_txt(subsample):
 	return os.path.expandvars("$CMSSW_BASE/src/MonoPhoton/DASAnalysis/analysis/inputs/{}.txt".format(subsample))
 
 prefix = "root://cmseos.fnal.gov//store/user/cmsdas/2018/long_exercises/MonoPhoton/ggNtpls"
-subsample_files = {}
-for sample in all_samples:
-	for subsample in subsamples[sample]:
-		subsample_files[subsample] = []
+
+# subsample_files: {subsample : [input files]}. Each inputs/<subsample>.txt is only read when the subsample is first used, not at import time.
+# - Subsamples of the samples without an inputs/<subsample>.txt have no input files. Other names (e.g. a mistyped --subsamples) raise KeyError.
+class SubsampleFiles(dict):
+	def __missing__(self, subsample):
 		input_txt = get_input_txt(subsample)
+		if not os.path.isfile(input_txt) and not any(subsample in sample_subsamples for sample_subsamples in subsamples.itervalues()):
+			raise KeyError(subsample)
+		self[subsample] = []
 		if os.path.isfile(input_txt):
 			with open(input_txt, 'r') as f:
 				for line in f:
-					subsample_files[subsample].append(line.strip())
+					self[subsample].append(line.strip())
+		return self[subsample]
+subsample_files = SubsampleFiles()
+
+# Jobs from the job splitter (analysis/inputs/split_data.py, see job_splitter.py): the jobs replace the subsamples of their sample.
+# - job_flavours: {job : condor JobFlavour}
+# - parent_subsamples: {job : subsample the job was made from}, for the cross section and normalization
+jobs_json = os.path.expandvars("$CMSSW_BASE/src/MonoPhoton/DASAnalysis/analysis/inputs/jobs.json")
+job_flavours = {}
+parent_subsamples = {}
+unsplit_subsamples = dict((sample, list(subsamples[sample])) for sample in subsamples) # The subsamples before the jobs are applied, i.e. the ones with an inputs/<subsample>.txt
+if os.path.isfile(jobs_json):
+	jobs_file = load_jobs(jobs_json)
+	for sample, jobs in jobs_file["samples"].iteritems():
+		subsamples[sample] = jobs
+		for job in jobs:
+			subsample_files[job] = jobs_file["jobs"][job]["inputs"]
+			job_flavours[job] = jobs_file["jobs"][job]["flavour"]
+			parent_subsamples[job] = jobs_file["jobs"][job]["parent"]
+
+all_subsamples = [subsample for sample in all_samples for subsample in subsamples[sample]]
+
+# Skims: reduced ntuples with only the events passing one of the analysis regions, and only the branches the analysis reads (see MonoPhotonHistogrammer.skim()).
+# - One skim file per subsample, written by run_histograms.py --skim
+default_skim_dir = os.path.expandvars("$CMSSW_BASE/../data/skims")
+
+def get_skim_path(subsample, skim_dir=default_skim_dir):
+	return "{}/skim_{}.root".format(skim_dir, subsample)
 
+# use_skims(): point subsample_files at the skims in skim_dir, for the subsamples that have one. Returns the list of subsamples without a skim.
+def use_skims(skim_dir=default_skim_dir):
+	missing_skims = []
+	for subsample in all_subsamples:
+		skim_path = get_skim_path(subsample, skim_dir)
+		if os.path.isfile(skim_path):
+			subsample_files[subsample] = [skim_path]
+		else:
+			missing_skims.append(subsample)
+	return missing_skims
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+# Job splitting with a target wall time (replaces the fixed 100 files per job of analysis/inputs/split_data.py)
+# - Each input file is a piece of work with a cost in seconds: entries / measured throughput of the sample, plus a fixed overhead per file open.
+# - Files longer than the target are cut into entry ranges at TTree cluster boundaries (from the file catalogue, see file_catalogue.py).
+# - The pieces are packed into jobs of at most the target wall time (first-fit decreasing), and each job gets the shortest condor JobFlavour that fits its estimate.
+# - The jobs are written to a JSON file, which input_samples.py loads: the jobs replace the subsamples of the sample they were made from.
+#
+# Entry ranges are written as "<path>#<first entry>-<last entry>" (last entry excluded), see make_entry_range(). They are understood by MonoPhotonHistogrammer.add_file().
+import os
+import json
+import glob
+
+# Condor JobFlavours and their maximum wall times in seconds
+job_flavours = [
+    ("espresso", 20 * 60),
+    ("microcentury", 60 * 60),
+    ("longlunch", 2 * 60 * 60),
+    ("workday", 8 * 60 * 60),
+    ("tomorrow", 24 * 60 * 60),
+    ("testmatch", 3 * 24 * 60 * 60),
+    ("nextweek", 7 * 24 * 60 * 60),
+]
+
+default_events_per_second = 500. # For samples without a throughput measurement
+file_overhead_seconds = 5. # Opening a remote file, reading the headers, etc.
+
+def make_entry_range(path, first_entry, last_entry):
+    return "{}#{}-{}".format(path, first_entry, last_entry)
+
+# split_entry_range(): (path, first entry, last entry) of an input file. last entry is None for whole files.
+def split_entry_range(input_file):
+    if not "#" in input_file:
+        return input_file, 0, None
+    path, entry_range = input_file.rsplit("#", 1)
+    first_entry, last_entry = entry_range.split("-")
+    return path, int(first_entry), int(last_entry)
+
+# choose_flavour(): shortest JobFlavour whose wall time covers the estimated run time, with a safety factor for slow nodes and slow reads
+def choose_flavour(estimated_seconds, safety_factor=1.5):
+    for flavour, max_seconds in job_flavours:
+        if estimated_seconds * safety_factor <= max_seconds:
+            return flavour
+    return job_flavours[-1][0]
+
+# split_into_pieces(): cut files with more than max_entries into entry ranges at cluster boundaries
+# - files_info: [{"path", "entries", "cluster_boundaries"}] (e.g. from FileCatalogue.files_info())
+# - Returns [(file index, path, first entry, last entry)]
+def split_into_pieces(files_info, max_entries):
+    pieces = []
+    for i_file, info in enumerate(files_info):
+        if info["entries"] <= max_entries:
+            pieces.append((i_file, info["path"], 0, info["entries"]))
+            continue
+        first_entry = 0
+        boundaries = info["cluster_boundaries"]
+        for i_boundary in xrange(1, len(boundaries)):
+            if boundaries[i_boundary] - first_entry > max_entries and boundaries[i_boundary - 1] > first_entry:
+                pieces.append((i_file, info["path"], first_entry, boundaries[i_boundary - 1]))
+                first_entry = boundaries[i_boundary - 1]
+        pieces.append((i_file, info["path"], first_entry, info["entries"]))
+    return pieces
+
+# pack_pieces(): first-fit decreasing bin packing of the pieces into jobs of at most capacity seconds. cost(piece) gives the seconds of a piece.
+def pack_pieces(pieces, cost, capacity):
+    jobs = [] # [[total cost, [pieces]]]
+    for piece in sorted(pieces, key=lambda piece: -cost(piece)):
+        for job in jobs:
+            if job[0] + cost(piece) <= capacity:
+                job[0] += cost(piece)
+                job[1].append(piece)
+                break
+        else:
+            jobs.append([cost(piece), [piece]])
+    return jobs
+
+# split_jobs(): jobs for the input files of a subsample (the parent of the jobs), with a target wall time
+# - Returns [{"name", "parent", "inputs", "entries", "estimated_seconds", "flavour"}]. Inputs are whole files or entry ranges, in the order of the input files.
+def split_jobs(parent, files_info, events_per_second, target_seconds):
+    max_entries = max(1, int((target_seconds - file_overhead_seconds) * events_per_second))
+    pieces = split_into_pieces(files_info, max_entries)
+    cost = lambda piece: (piece[3] - piece[2]) / events_per_second + file_overhead_seconds
+    jobs = []
+    for i_job, (estimated_seconds, job_pieces) in enumerate(pack_pieces(pieces, cost, target_seconds)):
+        inputs = []
+        previous = None
+        for i_file, path, first_entry, last_entry in sorted(job_pieces):
+            # Adjacent ranges of the same file are merged
+            if previous and previous[0] == i_file and previous[3] == first_entry:
+                previous = (i_file, path, previous[2], last_entry)
+                inputs[-1] = previous
+                continue
+            previous = (i_file, path, first_entry, last_entry)
+            inputs.append(previous)
+        jobs.append({
+            "name": "{}_job{}".format(parent, i_job),
+            "parent": parent,
+            "inputs": [path if (first_entry == 0 and last_entry == files_info[i_file]["entries"]) else make_entry_range(path, first_entry, last_entry) for i_file, path, first_entry, last_entry in inputs],
+            "entries": sum(last_entry - first_entry for i_file, path, first_entry, last_entry in inputs),
+            "estimated_seconds": estimated_seconds,
+            "flavour": choose_flavour(estimated_seconds),
+        })
+    return jobs
+
+# Throughput measurements: run_histograms.py writes throughput_<subsample>.json to its output directory after each run ({"subsample", "parent", "events", "seconds"}).
+def write_throughput(output_dir, subsample, parent, events, seconds):
+    with open(os.path.join(output_dir, "throughput_{}.json".format(subsample)), 'w') as f:
+        json.dump({"subsample": subsample, "parent": parent, "events": events, "seconds": seconds}, f)
+
+# load_throughputs(): {parent subsample : events per second}, summed over all measurements in the given directories
+def load_throughputs(throughput_dirs):
+    totals = {}
+    for throughput_dir in throughput_dirs:
+        for path in glob.glob(os.path.join(throughput_dir, "throughput_*.json")):
+            with open(path, 'r') as f:
+                measurement = json.load(f)
+            events, seconds = totals.get(measurement["parent"], (0, 0.))
+            totals[measurement["parent"]] = (events + measurement["events"], seconds + measurement["seconds"])
+    return dict((parent, events / seconds) for parent, (events, seconds) in totals.iteritems() if seconds > 0)
+
+# Jobs file: {"samples" : {sample : [job names]}, "jobs" : {job name : {"parent", "inputs", "entries", "estimated_seconds", "flavour"}}}
+def load_jobs(path):
+    if not os.path.isfile(path):
+        return {"samples": {}, "jobs": {}}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# save_jobs(): replace the jobs of a sample in the jobs file (the jobs of other samples are kept)
+def save_jobs(path, sample, jobs):
+    jobs_file = load_jobs(path)
+    for job_name in jobs_file["samples"].get(sample, []):
+        jobs_file["jobs"].pop(job_name, None)
+    jobs_file["samples"][sample] = [job["name"] for job in jobs]
+    for job in jobs:
+        job_info = dict(job)
+        jobs_file["jobs"][job_info.pop("name")] = job_info
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(jobs_file, f, indent=1, sort_keys=True)
+    os.rename(tmp_path, path)
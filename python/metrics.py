@@ -0,0 +1,118 @@
+# Performance metrics of the histogrammer, written as JSON next to each output file (<output>.metrics.json), see MonoPhotonHistogrammer.write_metrics()
+# - phases: wall time in seconds of io (reading events), selection (regions and their cuts), fill (histogram filling) and write (finish())
+# - selections: wall time in seconds spent in the cuts of each region (the event loop is single-threaded, so this is the CPU time of the region, plus its share of the reads it triggers)
+# - files: per input file, events, seconds, events/s and bytes read
+# - cpu_seconds (user + system) and peak_rss_mb of the process
+# run_histograms.py --metrics_summary gathers the metrics files of an output directory into a summary table.
+import os
+import json
+import glob
+import time
+import resource
+
+phases = ["io", "selection", "fill", "write"]
+
+def metrics_path(output_path):
+    return os.path.splitext(output_path)[0] + ".metrics.json"
+
+class RunMetrics(object):
+    def __init__(self):
+        self.phases = dict((phase, 0.) for phase in phases)
+        self.selections = {}
+        self.files = []
+        self._current_file = None
+
+    # start_file(): events from now on belong to input_file (closes the record of the previous file)
+    def start_file(self, input_file, bytes_read):
+        self.end_file(bytes_read)
+        self._current_file = {"file": input_file, "events": 0, "start": time.time(), "bytes_start": bytes_read}
+
+    def count_event(self, n_events=1):
+        self._current_file["events"] += n_events
+
+    def end_file(self, bytes_read):
+        if self._current_file is None:
+            return
+        record = self._current_file
+        seconds = time.time() - record["start"]
+        self.files.append({
+            "file": record["file"],
+            "events": record["events"],
+            "seconds": seconds,
+            "events_per_second": record["events"] / seconds if seconds > 0 else 0.,
+            "bytes_read": bytes_read - record["bytes_start"],
+        })
+        self._current_file = None
+
+    def to_dict(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            "phases": self.phases,
+            "selections": self.selections,
+            "files": self.files,
+            "events": sum(record["events"] for record in self.files),
+            "bytes_read": sum(record["bytes_read"] for record in self.files),
+            "cpu_seconds": usage.ru_utime + usage.ru_stime,
+            "peak_rss_mb": usage.ru_maxrss / 1024., # ru_maxrss is in kB on Linux
+        }
+
+    def write(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+        os.rename(tmp_path, path)
+
+# merge_metrics_files(): metrics of several runs that make up one output file (e.g. the per-file tasks of run_histograms.py --jobs): times, files and events are added up, peak RSS is the maximum
+def merge_metrics_files(input_paths, output_path):
+    merged = None
+    for input_path in input_paths:
+        if not os.path.isfile(input_path):
+            continue
+        with open(input_path, 'r') as f:
+            metrics = json.load(f)
+        if merged is None:
+            merged = metrics
+            continue
+        for key in ["phases", "selections"]:
+            for name, seconds in metrics[key].iteritems():
+                merged[key][name] = merged[key].get(name, 0.) + seconds
+        merged["files"].extend(metrics["files"])
+        for key in ["events", "bytes_read", "cpu_seconds"]:
+            merged[key] += metrics[key]
+        merged["peak_rss_mb"] = max(merged["peak_rss_mb"], metrics["peak_rss_mb"])
+    if merged is not None:
+        with open(output_path, 'w') as f:
+            json.dump(merged, f, indent=1, sort_keys=True)
+    return merged
+
+# summary_table(): text table of the metrics files in a directory, one row per output file (sorted by total time), plus the total
+def summary_table(output_dir, pattern="subsample_histograms_*.metrics.json"):
+    rows = []
+    for path in sorted(glob.glob(os.path.join(output_dir, pattern))):
+        with open(path, 'r') as f:
+            metrics = json.load(f)
+        name = os.path.basename(path)[:-len(".metrics.json")].replace("subsample_histograms_", "")
+        rows.append((name, metrics))
+    rows.sort(key=lambda row: -sum(row[1]["phases"].values()))
+
+    header = "{:<40} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8}  {}".format("subsample", "events", "total [s]", "io [s]", "sel. [s]", "fill [s]", "write [s]", "ev/s", "MB read", "RSS [MB]", "slowest selection")
+    lines = [header, "-" * len(header)]
+    totals = dict((phase, 0.) for phase in phases)
+    total_events = 0
+    total_bytes = 0
+    for name, metrics in rows + [("TOTAL", None)]:
+        if metrics is None:
+            total_seconds = sum(totals.values())
+            lines.append("-" * len(header))
+            lines.append("{:<40} {:>10} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.0f} {:>9.1f} {:>8}".format(name, total_events, total_seconds, totals["io"], totals["selection"], totals["fill"], totals["write"], total_events / total_seconds if total_seconds > 0 else 0., total_bytes / 1.e6, ""))
+            continue
+        total_seconds = sum(metrics["phases"].values())
+        slowest = max(metrics["selections"].iteritems(), key=lambda item: item[1]) if metrics["selections"] else ("", 0.)
+        lines.append("{:<40} {:>10} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.0f} {:>9.1f} {:>8.0f}  {} ({:.1f}s)".format(
+            name[:40], metrics["events"], total_seconds, metrics["phases"]["io"], metrics["phases"]["selection"], metrics["phases"]["fill"], metrics["phases"]["write"],
+            metrics["events"] / total_seconds if total_seconds > 0 else 0., metrics["bytes_read"] / 1.e6, metrics["peak_rss_mb"], slowest[0], slowest[1]))
+        for phase in phases:
+            totals[phase] += metrics["phases"][phase]
+        total_events += metrics["events"]
+        total_bytes += metrics["bytes_read"]
+    return "\n".join(lines)
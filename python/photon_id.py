@@ -0,0 +1,118 @@
+# Photon ID word: one bit per photon ID criterion, computed once per photon.
+# Corresponds to "SPRING15 selection 25ns" / barrel
+# https://twiki.cern.ch/twiki/bin/view/CMS/CutBasedPhotonIdentificationRun2Archive
+# The photon selections of the analysis are then (required bits, vetoed bits) pairs, see photon_selections below.
+import bisect
+import numpy as np
+
+# Bit positions in the photon ID word. Plain ints rather than an Enum, since they are used in the event loop.
+class PhotonIDBits:
+    kBarrel        = 0 # |SC eta| < 1.4442
+    kHoverE        = 1 # H/E < 0.05
+    kSigmaIEtaIEta = 2 # sigma_ietaieta (full 5x5) < 0.0102
+    kPixelSeed     = 3 # has pixel seed
+    kMediumIso     = 4 # medium WP PF isolation
+    kLooseIso      = 5 # loose WP PF isolation
+    kVeryLooseIso  = 6 # very loose PF isolation (loose WP x 5, capped at 20% of Et)
+
+def photon_id_mask(*bits):
+    mask = 0
+    for bit in bits:
+        mask |= 1 << bit
+    return mask
+
+# Photon selections: name : (required bits, vetoed bits)
+photon_selections = {
+    # Nominal photon ID (medium WP, no pixel seed)
+    "nominal": (
+        photon_id_mask(PhotonIDBits.kBarrel, PhotonIDBits.kHoverE, PhotonIDBits.kSigmaIEtaIEta, PhotonIDBits.kMediumIso),
+        photon_id_mask(PhotonIDBits.kPixelSeed)
+    ),
+    # Electron fake denominator (same as nominal, except with pixel seed)
+    "electrondenominator": (
+        photon_id_mask(PhotonIDBits.kBarrel, PhotonIDBits.kHoverE, PhotonIDBits.kSigmaIEtaIEta, PhotonIDBits.kMediumIso, PhotonIDBits.kPixelSeed),
+        0
+    ),
+    # QCD denominator (fail loose iso, pass very loose iso)
+    "qcddenominator": (
+        photon_id_mask(PhotonIDBits.kBarrel, PhotonIDBits.kHoverE, PhotonIDBits.kSigmaIEtaIEta, PhotonIDBits.kVeryLooseIso),
+        photon_id_mask(PhotonIDBits.kPixelSeed, PhotonIDBits.kLooseIso)
+    ),
+}
+
+# pass_photon_selection(): bit test of a photon ID word (or array of words) against (required bits, vetoed bits)
+def pass_photon_selection(word, required, vetoed):
+    return (word & (required | vetoed)) == required
+
+# Isolation working points: constant terms of the (charged, neutral, photon) isolation cuts
+isolation_working_points = {
+    "medium": (1.37, 1.06, 0.28),
+    "loose": (3.32, 1.92, 0.81),
+}
+
+# Effective areas for the PF isolation, in bins of |SC eta|. Bin i covers [ea_eta_edges[i-1], ea_eta_edges[i]).
+# https://indico.cern.ch/event/455258/contribution/0/attachments/1173322/1695132/SP15_253rd.pdf -- slide-5
+ea_eta_edges = [1.0, 1.479, 2.0, 2.2, 2.3, 2.4]
+ea_charged   = [0.0456, 0.0500, 0.0340, 0.0383, 0.0339, 0.0303, 0.0240]
+ea_neutral   = [0.0599, 0.0819, 0.0696, 0.0360, 0.0360, 0.0462, 0.0656]
+ea_photon    = [0.1271, 0.1101, 0.0756, 0.1175, 0.1498, 0.1857, 0.2183]
+
+# effective_area_bin(): binary search for the effective area bin of a photon
+def effective_area_bin(eta):
+    return bisect.bisect_right(ea_eta_edges, abs(eta))
+
+# neutral_isolation_cut(), photon_isolation_cut(): Et-dependent isolation cuts (work on numbers and arrays)
+def neutral_isolation_cut(constant, et):
+    return constant + (0.014 * et) + (0.000019 * et**2)
+
+def photon_isolation_cut(constant, et):
+    return constant + (0.0053 * et)
+
+# photon_id_word(): ID word of a single photon
+def photon_id_word(et, sc_eta, hovere, sieie, has_pixel_seed, ch_iso, neu_iso, pho_iso, rho):
+    ea_bin = effective_area_bin(sc_eta)
+    corrected_ch_iso = max(0., ch_iso - rho * ea_charged[ea_bin])
+    corrected_neu_iso = max(0., neu_iso - rho * ea_neutral[ea_bin])
+    corrected_pho_iso = max(0., pho_iso - rho * ea_photon[ea_bin])
+
+    word = 0
+    if abs(sc_eta) < 1.4442:
+        word |= 1 << PhotonIDBits.kBarrel
+    if hovere < 0.05:
+        word |= 1 << PhotonIDBits.kHoverE
+    if sieie < 0.0102:
+        word |= 1 << PhotonIDBits.kSigmaIEtaIEta
+    if has_pixel_seed != 0:
+        word |= 1 << PhotonIDBits.kPixelSeed
+
+    ch_cut, neu_cut, pho_cut = isolation_working_points["medium"]
+    if corrected_ch_iso < ch_cut and corrected_neu_iso < neutral_isolation_cut(neu_cut, et) and corrected_pho_iso < photon_isolation_cut(pho_cut, et):
+        word |= 1 << PhotonIDBits.kMediumIso
+
+    ch_cut, neu_cut, pho_cut = isolation_working_points["loose"]
+    if corrected_ch_iso < ch_cut and corrected_neu_iso < neutral_isolation_cut(neu_cut, et) and corrected_pho_iso < photon_isolation_cut(pho_cut, et):
+        word |= 1 << PhotonIDBits.kLooseIso
+    if corrected_ch_iso < min(0.20 * et, 5.0 * ch_cut) and corrected_neu_iso < min(0.20 * et, 5.0 * neutral_isolation_cut(neu_cut, et)) and corrected_pho_iso < min(0.20 * et, 5.0 * photon_isolation_cut(pho_cut, et)):
+        word |= 1 << PhotonIDBits.kVeryLooseIso
+    return word
+
+# photon_id_words(): vectorized photon_id_word(), over arrays of photons (rho is broadcast onto the photons by the caller)
+def photon_id_words(et, sc_eta, hovere, sieie, has_pixel_seed, ch_iso, neu_iso, pho_iso, rho):
+    ea_bin = np.searchsorted(ea_eta_edges, np.abs(sc_eta), side="right")
+    corrected_ch_iso = np.maximum(0., ch_iso - rho * np.asarray(ea_charged)[ea_bin])
+    corrected_neu_iso = np.maximum(0., neu_iso - rho * np.asarray(ea_neutral)[ea_bin])
+    corrected_pho_iso = np.maximum(0., pho_iso - rho * np.asarray(ea_photon)[ea_bin])
+
+    words = np.zeros(len(et), dtype=np.int32)
+    words |= (np.abs(sc_eta) < 1.4442) << PhotonIDBits.kBarrel
+    words |= (hovere < 0.05) << PhotonIDBits.kHoverE
+    words |= (sieie < 0.0102) << PhotonIDBits.kSigmaIEtaIEta
+    words |= (has_pixel_seed != 0) << PhotonIDBits.kPixelSeed
+
+    ch_cut, neu_cut, pho_cut = isolation_working_points["medium"]
+    words |= ((corrected_ch_iso < ch_cut) & (corrected_neu_iso < neutral_isolation_cut(neu_cut, et)) & (corrected_pho_iso < photon_isolation_cut(pho_cut, et))) << PhotonIDBits.kMediumIso
+
+    ch_cut, neu_cut, pho_cut = isolation_working_points["loose"]
+    words |= ((corrected_ch_iso < ch_cut) & (corrected_neu_iso < neutral_isolation_cut(neu_cut, et)) & (corrected_pho_iso < photon_isolation_cut(pho_cut, et))) << PhotonIDBits.kLooseIso
+    words |= ((corrected_ch_iso < np.minimum(0.20 * et, 5.0 * ch_cut)) & (corrected_neu_iso < np.minimum(0.20 * et, 5.0 * neutral_isolation_cut(neu_cut, et))) & (corrected_pho_iso < np.minimum(0.20 * et, 5.0 * photon_isolation_cut(pho_cut, et)))) << PhotonIDBits.kVeryLooseIso
+    return words
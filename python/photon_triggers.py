@@ -32,3 +32,29 @@ class PhotonTriggers(Enum):
     kHLT_Photon120_R9Id90_HE10_IsoM                                                     = 28
     kHLT_Photon165_R9Id90_HE10_IsoM                                                     = 29
     kHLT_ECALHT800                                                                      = 30
+
+# Trigger groups used by the analysis, compiled once into OR-masks over the HLTPho word.
+# A group check is then a single AND, on one event (HLTPho & mask != 0) or on an array of events.
+def trigger_mask(*triggers):
+    mask = 0
+    for trigger in triggers:
+        mask |= 1 << trigger.value
+    return mask
+
+signal_triggers = [
+    PhotonTriggers.kHLT_Photon175,
+    PhotonTriggers.kHLT_Photon250_NoHE,
+    PhotonTriggers.kHLT_Photon300_NoHE,
+    PhotonTriggers.kHLT_Photon500,
+    PhotonTriggers.kHLT_Photon600,
+    PhotonTriggers.kHLT_Photon165_HE10,
+    PhotonTriggers.kHLT_DoublePhoton60,
+]
+signal_trigger_mask = trigger_mask(*signal_triggers)
+
+backup_triggers = [
+    PhotonTriggers.kHLT_Photon75,
+    PhotonTriggers.kHLT_Photon90,
+    PhotonTriggers.kHLT_Photon120,
+]
+backup_trigger_mask = trigger_mask(*backup_triggers)
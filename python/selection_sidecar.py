@@ -0,0 +1,67 @@
+# Selection sidecars: per input file, the regions passed by each entry and the chosen photon of each photon candidate
+# - Written by MonoPhotonHistogrammer.run() for the input files it processed completely (see set_sidecar_dir()). MonoPhotonHistogrammer.rehist() then reads only the entries
+#   that passed a region, with the stored photons, and fills the spec histograms without running the selection (no photon ID, no cuts): new variables or binnings in a fraction of the time.
+# - One directory per input file (the whole file, also for entry ranges), with:
+#     pass_bits.npy          : one byte per entry (wider with more than 8 regions), bit i = region i of the spec
+#     photon_<candidate>.npy : int16 per entry, index of the chosen photon of the candidate (-1 where no region with that candidate passed)
+#     meta.json              : source file, file_fingerprint(), entries, region hash, regions, photon candidates, and the cutflows of the file (or None)
+# - The region hash identifies the selection code and the spec without its histograms (see MonoPhotonHistogrammer.region_hash()).
+#   A sidecar made with different selection code, regions or parameters, or of an input file that changed since, is not used.
+# - Written to a temporary directory and renamed, so a sidecar is either complete or missing.
+import os
+import json
+import shutil
+import numpy as np
+
+from MonoPhoton.DASAnalysis.columnar_cache import cache_entry_dir
+from MonoPhoton.DASAnalysis.histogram_cache import file_fingerprint
+from MonoPhoton.DASAnalysis.job_splitter import split_entry_range
+
+# pass_bits_dtype(): smallest unsigned integer type with one bit per region
+def pass_bits_dtype(n_regions):
+    for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
+        if n_regions <= 8 * np.dtype(dtype).itemsize:
+            return dtype
+    raise ValueError("[pass_bits_dtype] ERROR : Selection sidecars hold at most 64 regions, not {}".format(n_regions))
+
+# load_sidecar_meta(): meta.json of the sidecar of an input file, or None if there is no up-to-date sidecar for region_hash
+# - catalogue: FileCatalogue for the fingerprint of remote files (see file_fingerprint()), or None
+def load_sidecar_meta(sidecar_dir, input_file, region_hash, catalogue=None):
+    meta_path = os.path.join(cache_entry_dir(sidecar_dir, input_file), "meta.json")
+    if not os.path.isfile(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta["region_hash"] != region_hash or meta["fingerprint"] != file_fingerprint(split_entry_range(input_file)[0], catalogue):
+        return None
+    return meta
+
+# load_sidecar(): (meta, pass bits, {photon candidate : photon indices}) of an input file, memory-mapped, or None if there is no up-to-date sidecar
+def load_sidecar(sidecar_dir, input_file, region_hash, catalogue=None):
+    meta = load_sidecar_meta(sidecar_dir, input_file, region_hash, catalogue)
+    if meta is None:
+        return None
+    entry_dir = cache_entry_dir(sidecar_dir, input_file)
+    pass_bits = np.load(os.path.join(entry_dir, "pass_bits.npy"), mmap_mode="r")
+    photons = dict((candidate, np.load(os.path.join(entry_dir, "photon_{}.npy".format(candidate)), mmap_mode="r")) for candidate in meta["photons"])
+    return meta, pass_bits, photons
+
+# write_sidecar(): write the sidecar of an input file
+# - regions: region names, in bit order. photons: {photon candidate : photon indices}. cutflows: {region : {"labels", "exits"}} of the file, or None.
+def write_sidecar(sidecar_dir, input_file, region_hash, regions, pass_bits, photons, cutflows, catalogue=None):
+    path = split_entry_range(input_file)[0]
+    entry_dir = cache_entry_dir(sidecar_dir, path)
+    tmp_dir = "{}.tmp{}".format(entry_dir, os.getpid())
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, "pass_bits.npy"), pass_bits)
+    for candidate, indices in photons.iteritems():
+        np.save(os.path.join(tmp_dir, "photon_{}.npy".format(candidate)), indices)
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as f:
+        json.dump({"source": path, "fingerprint": file_fingerprint(path, catalogue), "entries": len(pass_bits), "region_hash": region_hash, "regions": regions, "photons": sorted(photons), "cutflows": cutflows}, f, indent=1, sort_keys=True)
+    if os.path.isdir(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.rename(tmp_dir, entry_dir)
+    print "[write_sidecar] INFO : Wrote the selection sidecar of {} ({} entries, {} passing) into {}".format(path, len(pass_bits), np.count_nonzero(pass_bits), entry_dir)
+    return entry_dir
@@ -0,0 +1,119 @@
+# Histogram accumulators in shared memory, for the local process pool (run_histograms.py --jobs --shared_histograms)
+# - Per histogram: bin contents, Sumw2, number of entries and the TH1 statistics (sum w, sum w^2, sum wx, sum wx^2), as float64 arrays in one multiprocessing.RawArray.
+# - The array has one slot per worker process, and one group per output file (subsample) in each slot. Each task adds to a fixed slot, in a fixed order (see SlotTurns),
+#   so the slots are written without locks, and the floating point sums (and so the output) don't depend on the scheduling.
+#   The parent sums the slots of a group, and turns the result into the TH1D objects that finish() would have written.
+# - Nothing is pickled or written to temporary ROOT files, and the memory is n_slots x n_groups x the size of the histograms, whatever the number of input files.
+# - An add is not undone if its worker dies halfway: a task must not be run again (no speculative attempts or crash retries), the run has to stop instead.
+#
+# The bin contents can differ from a serial run in the last bits of the floating point sums (the files are added up in a different order).
+import array
+import multiprocessing
+import numpy as np
+
+# Per histogram, after the contents and Sumw2 (n cells each): entries, sum w, sum w^2, sum wx, sum wx^2, Sumw2 flag
+n_extra = 6
+
+# histogram_layout(): [{"name", "title", "xtitle", "bins", "labels"}] of a list of TH1 (fixed bin widths). labels: bin labels (e.g. cutflows), or None.
+def histogram_layout(histograms):
+    return [{
+        "name": histogram.GetName(),
+        "title": histogram.GetTitle(),
+        "xtitle": histogram.GetXaxis().GetTitle(),
+        "bins": [histogram.GetNbinsX(), histogram.GetXaxis().GetXmin(), histogram.GetXaxis().GetXmax()],
+        "labels": [histogram.GetXaxis().GetBinLabel(i) for i in xrange(1, histogram.GetNbinsX() + 1)] if histogram.GetXaxis().GetLabels() else None,
+    } for histogram in histograms]
+
+class SharedHistograms(object):
+    # - layout: histogram_layout() of the histograms to accumulate (the same for all groups)
+    # - n_groups: number of output files (e.g. subsamples). Each group also has a counter (the number of events processed).
+    # - Create before the worker processes are forked.
+    def __init__(self, layout, n_groups, n_slots):
+        self._layout = layout
+        self._offsets = [] # Start of each histogram in a group
+        group_size = 0
+        for histogram in layout:
+            self._offsets.append(group_size)
+            group_size += 2 * (histogram["bins"][0] + 2) + n_extra
+        self._counter_offset = group_size
+        group_size += 1
+        self._shape = (n_slots, n_groups, group_size)
+        self._raw = multiprocessing.RawArray('d', n_slots * n_groups * group_size)
+        print "[SharedHistograms::__init__] INFO : {} slots x {} groups x {} histograms ({:.1f} MB)".format(n_slots, n_groups, len(layout), 8. * len(self._raw) / 1.e6)
+
+    def arrays(self):
+        return np.frombuffer(self._raw, dtype=np.float64).reshape(self._shape)
+
+    # add(): add histograms (in layout order) and a number of events to the group of a slot. Only the holder of the slot may call it.
+    def add(self, slot, group, histograms, n_events):
+        view = self.arrays()[slot, group]
+        for histogram_layout, offset, histogram in zip(self._layout, self._offsets, histograms):
+            if histogram.GetName() != histogram_layout["name"]:
+                raise ValueError("[SharedHistograms::add] ERROR : Histogram {} doesn't match the layout ({})".format(histogram.GetName(), histogram_layout["name"]))
+            n_cells = histogram_layout["bins"][0] + 2
+            contents = np.fromiter((histogram.GetBinContent(i) for i in xrange(n_cells)), dtype=np.float64, count=n_cells)
+            if histogram.GetSumw2N():
+                sumw2 = np.fromiter((histogram.GetSumw2().At(i) for i in xrange(n_cells)), dtype=np.float64, count=n_cells)
+            else:
+                sumw2 = contents # As TH1::Add(): without Sumw2, the errors are sqrt(contents)
+            stats = array.array('d', [0.] * 4)
+            histogram.GetStats(stats)
+            view[offset:offset + n_cells] += contents
+            view[offset + n_cells:offset + 2 * n_cells] += sumw2
+            extra = view[offset + 2 * n_cells:offset + 2 * n_cells + n_extra]
+            extra[0] += histogram.GetEntries()
+            extra[1:5] += np.asarray(stats)
+            extra[5] = max(extra[5], 1. if histogram.GetSumw2N() else 0.)
+        view[self._counter_offset] += n_events
+
+    # histograms(): (TH1D histograms, number of events) of a group, summed over the slots
+    def histograms(self, group):
+        from ROOT import TH1D
+        total = self.arrays()[:, group].sum(axis=0)
+        histograms = []
+        for histogram_layout, offset in zip(self._layout, self._offsets):
+            n_cells = histogram_layout["bins"][0] + 2
+            histogram = TH1D(histogram_layout["name"], histogram_layout["title"], *histogram_layout["bins"])
+            histogram.SetDirectory(0)
+            histogram.GetXaxis().SetTitle(histogram_layout["xtitle"])
+            if histogram_layout["labels"]:
+                for i, label in enumerate(histogram_layout["labels"]):
+                    histogram.GetXaxis().SetBinLabel(i + 1, label)
+            extra = total[offset + 2 * n_cells:offset + 2 * n_cells + n_extra]
+            if extra[5]:
+                histogram.Sumw2()
+            for i in xrange(n_cells):
+                histogram.SetBinContent(i, total[offset + i])
+                if extra[5]:
+                    histogram.GetSumw2().SetAt(total[offset + n_cells + i], i)
+            # After SetBinContent(), which resets the statistics
+            histogram.PutStats(array.array('d', extra[1:5]))
+            histogram.SetEntries(extra[0])
+            histograms.append(histogram)
+        return histograms, total[self._counter_offset]
+
+# SlotTurns: the slot of each task in a SharedHistograms, and the order of the adds to each slot
+# - keys: a key of each task, in submission order (see task_scheduler.submission_order()). The task at position p adds to slot p % n_slots, after the task at position p - n_slots.
+#   The worker processes start the tasks in submission order, so that task has started already, and waiting for it can't deadlock.
+# - Create before the worker processes are forked.
+class SlotTurns(object):
+    def __init__(self, keys, n_slots):
+        self._positions = dict((key, position) for position, key in enumerate(keys))
+        self._n_slots = n_slots
+        self._adds_done = multiprocessing.RawArray('l', n_slots) # Per slot, guarded by the condition
+        self._condition = multiprocessing.Condition()
+
+    # wait(): wait for the turn of a task to add to its slot. Returns the slot.
+    def wait(self, key):
+        slot, turn = self._positions[key] % self._n_slots, self._positions[key] // self._n_slots
+        with self._condition:
+            while self._adds_done[slot] < turn:
+                self._condition.wait()
+        return slot
+
+    # done(): the task is done with its slot, which goes to the next task of the slot
+    def done(self, key):
+        slot = self._positions[key] % self._n_slots
+        with self._condition:
+            self._adds_done[slot] += 1
+            self._condition.notify_all()
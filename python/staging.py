@@ -0,0 +1,164 @@
+# Local staging area for remote input files (xrootd), see MonoPhotonHistogrammer.set_staging() and run_histograms.py --stage_dir
+# - While one file is being processed, background threads copy the next read_ahead files to a local scratch directory, so the event loop reads local copies
+#   instead of waiting on remote reads.
+# - The staged copies are kept between runs (reruns over the same files don't copy them again), within a disk quota: the least recently used copies are deleted first.
+#   Copies in use, or being copied, are never deleted.
+# - Copies are written to a temporary file and renamed, so an interrupted copy never leaves a partial file behind.
+#   Eviction runs in the calling thread (stage() and release()), never in the copy threads.
+# - A copy left by a previous run is only reused if it has the size of the source (for root:// URLs, asked from the server with xrdfs stat; copied again if the server can't tell).
+#
+# Sources: root:// URLs are copied with xrdcp. file:// URLs and plain paths are copied with shutil, so a local directory can stand in for the remote storage
+# when testing; latency (seconds per file) can be injected to mimic the remote open.
+import os
+import time
+import shutil
+import hashlib
+import threading
+import subprocess
+
+from MonoPhoton.DASAnalysis.file_catalogue import remote_size
+
+class StagingArea(object):
+    def __init__(self, scratch_dir, quota=50e9, read_ahead=2, latency=0.):
+        self._scratch_dir = scratch_dir
+        self._quota = quota # Bytes
+        self._read_ahead = read_ahead # Number of files copied ahead of the one being processed
+        self._latency = latency # Seconds of injected latency per copy (testing)
+        self._lock = threading.Lock()
+        self._copies = {} # {path : (threading.Event, [local path or None])}, copies started by this process
+        self._pinned = {} # {local path : number of users}, copies in use or being copied
+        self._prefetched = set() # Paths copied (or being copied) by prefetch(), not yet returned by stage()
+        if not os.path.isdir(self._scratch_dir):
+            os.makedirs(self._scratch_dir)
+
+    # local_path(): path of the staged copy of a file. The name is a hash of the full source path (same file names in different datasets don't collide), plus the file name.
+    def local_path(self, path):
+        return os.path.join(self._scratch_dir, "{}_{}".format(hashlib.sha1(path).hexdigest()[:16], os.path.basename(path)))
+
+    # prefetch(): start copying a file in the background, unless it is already staged or being copied
+    def prefetch(self, path):
+        with self._lock:
+            if path in self._copies:
+                return
+            done = threading.Event()
+            result = [None]
+            self._copies[path] = (done, result)
+            self._pin(self.local_path(path)) # Handed over to the first stage() of the file
+            self._prefetched.add(path)
+        thread = threading.Thread(target=self._copy, args=(path, done, result))
+        thread.daemon = True
+        thread.start()
+
+    # stage(): local copy of a file, waiting for the copy if needed. Falls back to the original path if the copy failed.
+    # - The copy stays pinned (not evicted) until release().
+    def stage(self, path):
+        self.prefetch(path)
+        done, result = self._copies[path]
+        wait_start = time.time()
+        done.wait()
+        with self._lock:
+            if path in self._prefetched:
+                self._prefetched.remove(path)
+            else:
+                self._pin(self.local_path(path))
+            local_path = result[0]
+            staged = local_path and os.path.isfile(local_path)
+            if not staged:
+                # Failed, or evicted since it was copied (by another process sharing the scratch directory). Copied again by the next prefetch() or stage().
+                del self._copies[path]
+                self._unpin(self.local_path(path))
+        if not staged:
+            if local_path:
+                return self.stage(path)
+            print "[StagingArea::stage] WARNING : Couldn't stage {}, reading it remotely".format(path)
+            return path
+        os.utime(local_path, None) # Most recently used
+        self.evict()
+        if time.time() - wait_start > 1.:
+            print "[StagingArea::stage] INFO : Waited {:.1f}s for {}".format(time.time() - wait_start, path)
+        return local_path
+
+    # release(): the caller is done with the local copy of a file, which can now be evicted
+    def release(self, path):
+        with self._lock:
+            self._unpin(self.local_path(path))
+        self.evict()
+
+    # iterate(): (path, local path) for each of the paths, in order. The next read_ahead files are copied while the caller processes the current one.
+    def iterate(self, paths):
+        for i, path in enumerate(paths):
+            for next_path in paths[i + 1:i + 1 + self._read_ahead]:
+                self.prefetch(next_path)
+            local_path = self.stage(path)
+            try:
+                yield path, local_path
+            finally:
+                self.release(path)
+
+    # evict(): delete the least recently used copies that are not pinned, until the scratch directory fits in the quota. Returns the remaining size in bytes.
+    def evict(self):
+        with self._lock:
+            entries = []
+            for filename in os.listdir(self._scratch_dir):
+                local_path = os.path.join(self._scratch_dir, filename)
+                if ".part" in filename or not os.path.isfile(local_path):
+                    continue
+                stat = os.stat(local_path)
+                entries.append((stat.st_mtime, stat.st_size, local_path))
+            total_size = sum(size for mtime, size, local_path in entries)
+            for mtime, size, local_path in sorted(entries):
+                if total_size <= self._quota:
+                    break
+                if local_path in self._pinned:
+                    continue
+                os.remove(local_path)
+                total_size -= size
+                print "[StagingArea::evict] INFO : Evicted {}".format(local_path)
+            return total_size
+
+    def _pin(self, local_path):
+        self._pinned[local_path] = self._pinned.get(local_path, 0) + 1
+
+    def _unpin(self, local_path):
+        self._pinned[local_path] -= 1
+        if self._pinned[local_path] == 0:
+            del self._pinned[local_path]
+
+    # _copy(): background thread, copies path to its local path. result[0] is set to the local path on success.
+    def _copy(self, path, done, result):
+        local_path = self.local_path(path)
+        tmp_path = None
+        try:
+            if os.path.isfile(local_path) and os.path.getsize(local_path) == source_size(path):
+                result[0] = local_path # Staged by a previous run
+                return
+            if self._latency > 0:
+                time.sleep(self._latency)
+            tmp_path = "{}.part{}_{}".format(local_path, os.getpid(), threading.current_thread().ident)
+            copy_file(path, tmp_path)
+            os.rename(tmp_path, local_path)
+            result[0] = local_path
+            print "[StagingArea::_copy] INFO : Staged {} ({:.1f} MB)".format(path, os.path.getsize(local_path) / 1.e6)
+        except Exception as error:
+            print "[StagingArea::_copy] WARNING : Copy of {} failed: {}".format(path, error)
+            if tmp_path and os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            done.set()
+
+# source_size(): size in bytes of the source of a copy (None if unknown)
+def source_size(path):
+    if path.startswith("root://"):
+        return remote_size(path)
+    return os.path.getsize(_source_path(path))
+
+def _source_path(path):
+    return path[len("file://"):] if path.startswith("file://") else path
+
+# copy_file(): copy a root:// URL (xrdcp), file:// URL or local path to a local file
+def copy_file(path, local_path):
+    if path.startswith("root://"):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(["xrdcp", "--force", "--silent", path, local_path], stdout=devnull)
+    else:
+        shutil.copyfile(_source_path(path), local_path)
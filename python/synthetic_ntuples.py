@@ -0,0 +1,230 @@
+# Synthetic ggNtuples, for testing and benchmarking the histogrammer without EOS access (see analysis/benchmark.py)
+# - write_ntuple() writes a local ROOT file with ggNtuplizer/EventTree, holding the branches of MonoPhotonHistogrammer.analysis_branches with the ggNtuplizer types
+#   (std::vector<float> / std::vector<int> per object, Int_t counts, ULong64_t HLTPho), and ggNtuplizer/hEvents.
+# - The events are random, but reproducible (seed). The object multiplicities (Poisson means), the kinematic distributions (exponential pT spectra above a threshold,
+#   flat eta and phi) and the ID and isolation variables are set by a config, see default_config. The distributions are not meant to be physical: the default config
+#   is tuned so that every region of the default spec gets events, with a mix of passing and failing cuts.
+# - When run as an executable, writes a set of files into a directory, e.g.
+#       python synthetic_ntuples.py --output_dir /tmp/synthetic --n_files 4 --n_events 50000 --config my_config.json
+import os
+import json
+import copy
+import numpy as np
+
+from MonoPhoton.DASAnalysis.photon_triggers import signal_trigger_mask, backup_trigger_mask
+
+default_config = {
+    # Objects: Poisson means of the multiplicities
+    "n_photons": 1.2,
+    "n_electrons": 0.3,
+    "n_muons": 0.3,
+    "n_jets": 1.5,
+    # pT spectra: threshold + exponential with the given slope [GeV]
+    "photon_pt_min": 20.,
+    "photon_pt_slope": 200.,
+    "electron_pt_min": 10.,
+    "electron_pt_slope": 30.,
+    "muon_pt_min": 5.,
+    "muon_pt_slope": 30.,
+    "jet_pt_min": 30.,
+    "jet_pt_slope": 80.,
+    "pfmet_slope": 200.,
+    # Flat |eta| up to
+    "photon_eta_max": 2.,
+    "electron_eta_max": 2.5,
+    "muon_eta_max": 2.4,
+    "jet_eta_max": 4.7,
+    # Photon ID and isolation: H/E and sigma_ietaieta are flat in [0, max], the isolations exponential with the given scale [GeV]
+    "photon_hoe_max": 0.08,
+    "photon_sieie_min": 0.007,
+    "photon_sieie_max": 0.013,
+    "photon_iso_scale": 2.,
+    "photon_pixel_seed_fraction": 0.2,
+    # Leptons: fraction passing the loose ID flags, and the isolation scale relative to the pT
+    "electron_iso_scale": 0.05,
+    "muon_pf_fraction": 0.8,
+    "muon_global_fraction": 0.7,
+    "lepton_iso_scale": 0.1,
+    # Event: trigger and MET filter rates, rho
+    "signal_trigger_fraction": 0.6,
+    "backup_trigger_fraction": 0.5,
+    "other_trigger_fraction": 0.3, # Each of the other HLTPho bits
+    "met_filters_fail_fraction": 0.05,
+    "rho_mean": 12.,
+}
+
+# Branches and their types: "F" float, "I" int, "l" unsigned 64 bit (scalar branches), "vF"/"vI" std::vector<float>/<int>, with the count branch of the object
+scalar_branches = [("nPho", "I"), ("nEle", "I"), ("nMu", "I"), ("nJet", "I"), ("pfMET", "F"), ("pfMETPhi", "F"), ("HLTPho", "l"), ("metFilters", "I"), ("rho", "F")]
+vector_branches = {
+    "nPho": [("phoEt", "vF"), ("phoEta", "vF"), ("phoPhi", "vF"), ("phoSCEta", "vF"), ("phoSCPhi", "vF"), ("phoHoverE", "vF"), ("phoSigmaIEtaIEtaFull5x5", "vF"), ("phohasPixelSeed", "vI"), ("phoPFChIso", "vF"), ("phoPFNeuIso", "vF"), ("phoPFPhoIso", "vF")],
+    "nEle": [("elePt", "vF"), ("eleEta", "vF"), ("elePhi", "vF"), ("eleSCEta", "vF"), ("elePFChIso", "vF"), ("elePFNeuIso", "vF"), ("elePFPhoIso", "vF"), ("eleSigmaIEtaIEtaFull5x5", "vF"), ("eledEtaAtVtx", "vF"), ("eledPhiAtVtx", "vF"), ("eleHoverE", "vF"), ("eleEoverPInv", "vF"), ("eleD0", "vF"), ("eleDz", "vF"), ("eleMissHits", "vI"), ("eleConvVeto", "vI")],
+    "nMu": [("muPt", "vF"), ("muEta", "vF"), ("muPhi", "vF"), ("muIsPFMuon", "vI"), ("muIsGlobalMuon", "vI"), ("muIsTrackerMuon", "vI"), ("muPFChIso", "vF"), ("muPFNeuIso", "vF"), ("muPFPhoIso", "vF"), ("muPFPUIso", "vF")],
+    "nJet": [("jetPt", "vF"), ("jetEta", "vF"), ("jetPhi", "vF")],
+}
+
+def load_config(path=None, **overrides):
+    config = copy.deepcopy(default_config)
+    if path:
+        with open(path, 'r') as f:
+            config.update(json.load(f))
+    for name, value in overrides.iteritems():
+        if not name in config:
+            raise ValueError("[load_config] ERROR : Unknown config parameter {}".format(name))
+        config[name] = value
+    return config
+
+# generate_events(): {branch : array} for n_events events. Per-object branches are flat arrays over all objects, with the counts in nPho, nEle, nMu and nJet.
+def generate_events(n_events, config, random):
+    events = {}
+    uniform_phi = lambda n: random.uniform(-np.pi, np.pi, n)
+    uniform_eta = lambda n, eta_max: random.uniform(-eta_max, eta_max, n)
+    spectrum = lambda n, pt_min, slope: pt_min + random.exponential(slope, n)
+    flag = lambda n, fraction: (random.uniform(size=n) < fraction).astype(np.int32)
+
+    for count_branch, mean in [("nPho", config["n_photons"]), ("nEle", config["n_electrons"]), ("nMu", config["n_muons"]), ("nJet", config["n_jets"])]:
+        events[count_branch] = random.poisson(mean, n_events).astype(np.int32)
+
+    # Photons, ordered by pT in each event (as in the ggNtuples)
+    n = events["nPho"].sum()
+    events["phoEt"] = sort_by_event(spectrum(n, config["photon_pt_min"], config["photon_pt_slope"]), events["nPho"])
+    events["phoEta"] = uniform_eta(n, config["photon_eta_max"])
+    events["phoSCEta"] = events["phoEta"] + random.normal(0., 0.01, n)
+    events["phoPhi"] = uniform_phi(n)
+    events["phoSCPhi"] = events["phoPhi"] + random.normal(0., 0.01, n)
+    events["phoHoverE"] = random.uniform(0., config["photon_hoe_max"], n)
+    events["phoSigmaIEtaIEtaFull5x5"] = random.uniform(config["photon_sieie_min"], config["photon_sieie_max"], n)
+    events["phohasPixelSeed"] = flag(n, config["photon_pixel_seed_fraction"])
+    for branch in ["phoPFChIso", "phoPFNeuIso", "phoPFPhoIso"]:
+        events[branch] = random.exponential(config["photon_iso_scale"], n)
+
+    # Electrons
+    n = events["nEle"].sum()
+    events["elePt"] = sort_by_event(spectrum(n, config["electron_pt_min"], config["electron_pt_slope"]), events["nEle"])
+    events["eleEta"] = uniform_eta(n, config["electron_eta_max"])
+    events["eleSCEta"] = events["eleEta"] + random.normal(0., 0.01, n)
+    events["elePhi"] = uniform_phi(n)
+    for branch in ["elePFChIso", "elePFNeuIso", "elePFPhoIso"]:
+        events[branch] = random.exponential(config["electron_iso_scale"], n) * events["elePt"]
+    events["eleSigmaIEtaIEtaFull5x5"] = random.uniform(0.005, 0.035, n)
+    events["eledEtaAtVtx"] = random.normal(0., 0.006, n)
+    events["eledPhiAtVtx"] = random.normal(0., 0.08, n)
+    events["eleHoverE"] = random.uniform(0., 0.12, n)
+    events["eleEoverPInv"] = random.exponential(0.05, n)
+    events["eleD0"] = random.normal(0., 0.03, n)
+    events["eleDz"] = random.normal(0., 0.3, n)
+    events["eleMissHits"] = random.poisson(0.3, n).astype(np.int32)
+    events["eleConvVeto"] = flag(n, 0.95)
+
+    # Muons
+    n = events["nMu"].sum()
+    events["muPt"] = sort_by_event(spectrum(n, config["muon_pt_min"], config["muon_pt_slope"]), events["nMu"])
+    events["muEta"] = uniform_eta(n, config["muon_eta_max"])
+    events["muPhi"] = uniform_phi(n)
+    events["muIsPFMuon"] = flag(n, config["muon_pf_fraction"])
+    events["muIsGlobalMuon"] = flag(n, config["muon_global_fraction"])
+    events["muIsTrackerMuon"] = flag(n, config["muon_global_fraction"])
+    for branch in ["muPFChIso", "muPFNeuIso", "muPFPhoIso", "muPFPUIso"]:
+        events[branch] = random.exponential(config["lepton_iso_scale"], n) * events["muPt"]
+
+    # Jets
+    n = events["nJet"].sum()
+    events["jetPt"] = sort_by_event(spectrum(n, config["jet_pt_min"], config["jet_pt_slope"]), events["nJet"])
+    events["jetEta"] = uniform_eta(n, config["jet_eta_max"])
+    events["jetPhi"] = uniform_phi(n)
+
+    # Event: MET, triggers (the signal and backup trigger groups, plus the other photon triggers), MET filters
+    events["pfMET"] = random.exponential(config["pfmet_slope"], n_events)
+    events["pfMETPhi"] = uniform_phi(n_events)
+    hlt = np.zeros(n_events, dtype=np.uint64)
+    other_trigger_mask = ((1 << 31) - 1) & ~(signal_trigger_mask | backup_trigger_mask)
+    for mask, fraction in [(signal_trigger_mask, config["signal_trigger_fraction"]), (backup_trigger_mask, config["backup_trigger_fraction"])]:
+        hlt |= np.where(random.uniform(size=n_events) < fraction, random_bit(mask, n_events, random), np.uint64(0)).astype(np.uint64)
+    for bit in xrange(31):
+        if other_trigger_mask & (1 << bit):
+            hlt |= np.where(random.uniform(size=n_events) < config["other_trigger_fraction"], np.uint64(1 << bit), np.uint64(0)).astype(np.uint64)
+    events["HLTPho"] = hlt
+    events["metFilters"] = np.where(random.uniform(size=n_events) < config["met_filters_fail_fraction"], 1 + random.randint(0, 255, n_events), 0).astype(np.int32)
+    events["rho"] = random.exponential(config["rho_mean"], n_events)
+    return events
+
+# sort_by_event(): sort flat object values in decreasing order within each event
+def sort_by_event(values, counts):
+    event_index = np.repeat(np.arange(len(counts)), counts)
+    return values[np.lexsort((-values, event_index))]
+
+# random_bit(): one random bit of a mask per event
+def random_bit(mask, n_events, random):
+    bits = np.array([1 << bit for bit in xrange(64) if mask & (1 << bit)], dtype=np.uint64)
+    return bits[random.randint(0, len(bits), n_events)]
+
+# write_ntuple(): write n_events synthetic events to ggNtuplizer/EventTree in path, plus ggNtuplizer/hEvents
+# - compression: ROOT compression setting, 100 * algorithm + level (the ggNtuples use the ROOT default, zlib level 1)
+def write_ntuple(path, n_events, config=None, seed=1, compression=101, chunk_size=10000):
+    from ROOT import TFile, TTree, TH1F, std
+    if config is None:
+        config = default_config
+    random = np.random.RandomState(seed)
+
+    output_file = TFile(path, "RECREATE", "", compression)
+    output_directory = output_file.mkdir("ggNtuplizer")
+    output_directory.cd()
+    tree = TTree("EventTree", "Event data")
+    dtypes = {"F": np.float32, "I": np.int32, "l": np.uint64}
+    scalar_buffers = {}
+    for branch, branch_type in scalar_branches:
+        scalar_buffers[branch] = np.zeros(1, dtype=dtypes[branch_type])
+        tree.Branch(branch, scalar_buffers[branch], "{}/{}".format(branch, branch_type))
+    vector_buffers = {}
+    for count_branch, branches in vector_branches.iteritems():
+        for branch, branch_type in branches:
+            vector_buffers[branch] = std.vector("float" if branch_type == "vF" else "int")()
+            tree.Branch(branch, vector_buffers[branch])
+
+    for chunk_start in xrange(0, n_events, chunk_size):
+        events = generate_events(min(chunk_size, n_events - chunk_start), config, random)
+        offsets = dict((count_branch, np.concatenate([[0], np.cumsum(events[count_branch])])) for count_branch in vector_branches)
+        values = dict((branch, events[branch].tolist()) for branches in vector_branches.itervalues() for branch, branch_type in branches)
+        for i in xrange(len(events["nPho"])):
+            for branch, branch_type in scalar_branches:
+                scalar_buffers[branch][0] = events[branch][i]
+            for count_branch, branches in vector_branches.iteritems():
+                start, stop = offsets[count_branch][i], offsets[count_branch][i + 1]
+                for branch, branch_type in branches:
+                    vector = vector_buffers[branch]
+                    vector.clear()
+                    for value in values[branch][start:stop]:
+                        vector.push_back(value)
+            tree.Fill()
+
+    # Same as the ggNtuplizer: bin 1 counts the events processed
+    hEvents = TH1F("hEvents", "total processed and skimmed events", 2, 0, 2)
+    hEvents.SetBinContent(1, n_events)
+    hEvents.SetEntries(n_events)
+    tree.Write()
+    hEvents.Write()
+    output_file.Close()
+    print "[write_ntuple] INFO : Wrote {} synthetic events to {}".format(n_events, path)
+    return path
+
+# write_ntuples(): n_files files of n_events each in output_dir (seeds seed, seed + 1, ...). Existing files are kept, unless overwrite.
+def write_ntuples(output_dir, n_files, n_events, config=None, seed=1, overwrite=False):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    paths = []
+    for i in xrange(n_files):
+        path = os.path.join(output_dir, "synthetic_ggtree_{}.root".format(i))
+        if overwrite or not os.path.isfile(path):
+            write_ntuple(path, n_events, config=config, seed=seed + i)
+        paths.append(path)
+    return paths
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Write synthetic ggNtuples')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--n_files', type=int, default=1)
+    parser.add_argument('--n_events', type=int, default=10000, help='Events per file')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--config', type=str, help='JSON file overriding parameters of default_config')
+    args = parser.parse_args()
+    write_ntuples(args.output_dir, args.n_files, args.n_events, config=load_config(args.config), seed=args.seed, overwrite=True)
@@ -0,0 +1,123 @@
+# Local process-pool scheduler for the histogramming tasks (one task = one input file), see run_histograms.py --jobs
+# - All tasks go into one shared queue, largest first; each worker takes the next task as soon as it is free, so small and large subsamples are interleaved and no core sits idle.
+# - Stragglers: once the queue is empty and workers become idle, tasks running much longer than the typical task (speculation_factor x the median duration) are started a second time.
+#   Whichever attempt finishes first is used, and the other one is abandoned. The task function must therefore be safe to run twice (e.g. write to an attempt-specific path).
+# - Each task runs in a fresh worker process (maxtasksperchild=1), so ROOT objects from one task never leak into the next.
+# - A worker process that dies (e.g. a ROOT segfault) never returns its result. Its attempt is counted as failed once the process has been gone for dead_worker_grace seconds,
+#   and the task is started again (up to crash_retries times per task) if it has no other attempt left.
+import os
+import time
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
+
+_start_queue = None
+
+def _init_worker(start_queue):
+    global _start_queue
+    _start_queue = start_queue
+
+def _run_attempt(function, task_id, attempt, task):
+    _start_queue.put((task_id, attempt, time.time(), os.getpid()))
+    return function(task, attempt)
+
+# submission_order(): task indices in the order run_tasks() submits them, largest cost first (ties in task order). The worker processes start the tasks in this order.
+def submission_order(costs):
+    return sorted(xrange(len(costs)), key=lambda i: -costs[i])
+
+# run_tasks(): run function(task, attempt) for every task on n_jobs processes. Returns the list of results, in the order of tasks.
+# - costs: estimated cost of each task (e.g. file size), for the largest-first ordering. Default: all equal.
+# - speculation_factor: None switches off the speculative attempts (for task functions that are not safe to run twice)
+# - crash_retries: number of times a task is started again after its worker process died. Tasks raising an exception are not retried.
+def run_tasks(function, tasks, n_jobs, costs=None, speculation_factor=2., poll_interval=0.5, crash_retries=1, dead_worker_grace=5.):
+    if costs is None:
+        costs = [1.] * len(tasks)
+    start_queue = SimpleQueue() # Written synchronously, so the start message of a worker that crashes right after is not lost
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(start_queue,), maxtasksperchild=1)
+
+    attempts = {} # {task_id : [AsyncResult]}
+    def submit(task_id):
+        attempts.setdefault(task_id, []).append(pool.apply_async(_run_attempt, (function, task_id, len(attempts.get(task_id, [])), tasks[task_id])))
+    for task_id in submission_order(costs):
+        submit(task_id)
+
+    start_times = {} # {(task_id, attempt) : start time}
+    worker_pids = {} # {(task_id, attempt) : pid of the worker process}
+    dead_since = {} # {(task_id, attempt) : first time its worker process was found gone}
+    failed_attempts = set()
+    crashes = {} # {task_id : number of attempts lost with their worker process}
+    results = {}
+    durations = []
+    n_speculative = 0
+    try:
+        while len(results) < len(tasks):
+            while not start_queue.empty():
+                task_id, attempt, start_time, pid = start_queue.get()
+                start_times[(task_id, attempt)] = start_time
+                worker_pids[(task_id, attempt)] = pid
+
+            # Collect finished attempts. Successful attempts first, so that a task with a good result never fails because of its other attempt.
+            for task_id, task_attempts in attempts.iteritems():
+                if task_id in results:
+                    continue
+                for attempt, async_result in enumerate(task_attempts):
+                    if async_result.ready() and async_result.successful():
+                        results[task_id] = async_result.get()
+                        if (task_id, attempt) in start_times: # Unknown if the start message is not drained yet: not counted in the median
+                            durations.append(time.time() - start_times[(task_id, attempt)])
+                        break
+
+            # Failed attempts: an exception in the task, or a worker process that died
+            live_pids = set(process.pid for process in pool._pool if process.is_alive())
+            for task_id, task_attempts in attempts.items():
+                if task_id in results:
+                    continue
+                for attempt, async_result in enumerate(task_attempts):
+                    key = (task_id, attempt)
+                    if key in failed_attempts:
+                        continue
+                    if async_result.ready():
+                        if async_result.successful(): # Finished since the collection above: collected in the next poll
+                            continue
+                        try:
+                            async_result.get()
+                        except Exception as error:
+                            failure = error
+                        crashed = False
+                    elif key in worker_pids and not worker_pids[key] in live_pids:
+                        # The result of a worker that just exited may still be on its way: only give up after the grace period
+                        if time.time() - dead_since.setdefault(key, time.time()) < dead_worker_grace:
+                            continue
+                        failure = "worker process {} died".format(worker_pids[key])
+                        crashed = True
+                    else:
+                        continue
+                    failed_attempts.add(key)
+                    if not all((task_id, other) in failed_attempts for other in xrange(len(task_attempts))):
+                        print "[run_tasks] WARNING : Attempt {} of task {} failed ({}), waiting for the other attempt".format(attempt, task_id, failure)
+                    elif crashed and crashes.get(task_id, 0) < crash_retries:
+                        crashes[task_id] = crashes.get(task_id, 0) + 1
+                        print "[run_tasks] WARNING : Attempt {} of task {} failed ({}), starting it again".format(attempt, task_id, failure)
+                        submit(task_id)
+                    else:
+                        raise RuntimeError("[run_tasks] ERROR : Task {} failed: {}".format(task_id, failure))
+
+            # Speculative re-dispatch of stragglers, once nothing is waiting in the queue
+            running = [key for key in start_times if not key[0] in results and not key in failed_attempts and not attempts[key[0]][key[1]].ready()]
+            n_waiting = sum(len(task_attempts) for task_attempts in attempts.itervalues()) - len(start_times)
+            if speculation_factor and n_waiting == 0 and durations and len(running) < n_jobs:
+                median_duration = sorted(durations)[len(durations) / 2]
+                for task_id, attempt in sorted(running, key=lambda key: start_times[key]):
+                    if len(running) >= n_jobs:
+                        break
+                    if len(attempts[task_id]) == 1 and time.time() - start_times[(task_id, attempt)] > speculation_factor * median_duration:
+                        print "[run_tasks] INFO : Task {} is running for {:.0f}s (median task {:.0f}s), starting a speculative attempt".format(task_id, time.time() - start_times[(task_id, attempt)], median_duration)
+                        submit(task_id)
+                        running.append((task_id, 1))
+                        n_speculative += 1
+            time.sleep(poll_interval)
+    finally:
+        # Abandoned (or failed) attempts are killed
+        pool.terminate()
+        pool.join()
+    print "[run_tasks] INFO : Ran {} tasks on {} processes ({} speculative attempts)".format(len(tasks), n_jobs, n_speculative)
+    return [results[task_id] for task_id in xrange(len(tasks))]